@@ -0,0 +1,75 @@
+"""
+Benchmark of the segment description enrichment (packages.enrichment.join_descriptions).
+
+Builds a synthetic Detail result with one column per segment and joins all of them against
+their value sets. Fails when the enrichment takes longer than the time budget.
+
+Run from the application directory (it needs the .env and lg_list.json like main.py):
+    python -m benchmarks.bench_enrichment [--rows 1000000] [--budget 2]
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from packages.enrichment import join_descriptions, description_column
+
+# Segment column and value set size, like a typical 8 segment chart of accounts
+segment_sizes: dict = {'COMPANY': 50, 'DIVISION': 20, 'COST_CENTER': 500, 'ACCOUNT': 5000,
+                       'PROJECT': 1000, 'INTERCOMPANY': 50, 'FUTURE1': 10, 'FUTURE2': 10}
+
+
+def build_balances(p_rows: int, p_seed: int = 42) -> tuple:
+    """
+    Returns the synthetic balances and the (segment column, value set) pairs.
+    """
+    rng: np.random.Generator = np.random.default_rng(p_seed)
+    columns: dict = {'LedgerName': 'US Primary Ledger', 'PeriodName': rng.choice(['Jan-24', 'Feb-24', 'Mar-24'], p_rows)}
+    segments: list = []
+    for column_name, size in segment_sizes.items():
+        values: np.ndarray = np.array([f'{i:05d}' for i in range(size)])
+        columns[column_name] = values[rng.integers(0, size, p_rows)]
+        # A few codes without a value set entry, they get no description
+        segments.append((column_name, pd.DataFrame({'Value': values[:-1],
+                                                    'Description': [f'{column_name} {v}' for v in values[:-1]]})))
+    columns['DetailAccountCombination'] = pd.Series(columns['COMPANY']).str.cat(
+        [pd.Series(columns[column_name]) for column_name in list(segment_sizes)[1:]], sep='.')
+    for column_name in ('BeginningBalance', 'PeriodActivity', 'EndingBalance'):
+        columns[column_name] = rng.normal(0, 10000, p_rows).round(2)
+    return pd.DataFrame(columns), segments
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--budget', type=float, default=2.0, help='seconds the enrichment may take')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    df, segments = build_balances(args.rows)
+    timings: list = []
+    for _ in range(args.repeat):
+        started: float = time.perf_counter()
+        enriched: pd.DataFrame = join_descriptions(df, segments)
+        timings.append(time.perf_counter() - started)
+
+    # The enrichment must keep every row in order and describe every code present in its value set
+    assert len(enriched) == len(df) and enriched['DetailAccountCombination'].equals(df['DetailAccountCombination'])
+    for column_name, values_df in segments:
+        described: pd.Series = enriched[column_name].isin(values_df['Value'])
+        assert enriched.loc[described, description_column(column_name)].notna().all()
+        assert enriched.loc[~described, description_column(column_name)].isna().all()
+
+    best: float = min(timings)
+    print(f"rows: {args.rows}, segments: {len(segments)}, best: {best:.3f}s, "
+          f"median: {float(np.median(timings)):.3f}s, {args.rows / best:,.0f} rows/s, budget: {args.budget}s")
+    if best > args.budget:
+        print("FAILED: enrichment exceeded the time budget")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
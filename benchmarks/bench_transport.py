@@ -0,0 +1,102 @@
+"""
+Benchmark of the grid payload formats (packages.transport): the records AG Grid takes (GRID_TRANSPORT=records)
+against the column oriented encoding (GRID_TRANSPORT=columns).
+
+Builds a synthetic Detail result with segment descriptions, encodes it in both formats, serializes it with
+the JSON encoder of Dash and compresses it like Flask-Compress does (gzip level 6, brotli quality 4).
+Reports the payload bytes and the encoding, serialization and compression times, and checks that the
+column oriented payload decodes to the same rows.
+
+Run from the application directory (it needs the .env and lg_list.json like main.py):
+    python -m benchmarks.bench_transport [--rows 100000]
+"""
+import argparse
+import gzip
+import math
+import sys
+import time
+
+import brotli
+import numpy as np
+import pandas as pd
+from plotly.io.json import to_json_plotly
+
+from benchmarks.bench_enrichment import build_balances
+from packages.enrichment import join_descriptions
+from packages.transport import encode_columns
+
+
+def decode_columns(p_payload: dict) -> list:
+    """
+    Python counterpart of decodeRows of the clientside callback, see packages.transport.
+    """
+    columns: list = [column if column is None or isinstance(column, list)
+                     else [None if code < 0 else column['values'][code] for code in column['codes']]
+                     for column in p_payload['data']]
+    return [{name: None if values is None else values[i] for name, values in zip(p_payload['columns'], columns)}
+            for i in range(p_payload['rowCount'])]
+
+
+def _same(p_left, p_right) -> bool:
+    if isinstance(p_left, float) and isinstance(p_right, float):
+        return p_left == p_right or (math.isnan(p_left) and math.isnan(p_right))
+    return p_left == p_right or (p_left is None and isinstance(p_right, float) and math.isnan(p_right))
+
+
+def measure(p_name: str, p_encode, df: pd.DataFrame, p_repeat: int) -> dict:
+    """
+    Best times of p_repeat runs of the encoding, serialization and compression of df.
+    """
+    encode_times, serialize_times = [], []
+    for _ in range(p_repeat):
+        started: float = time.perf_counter()
+        payload = p_encode(df)
+        encoded: float = time.perf_counter()
+        body: bytes = to_json_plotly(payload).encode('utf-8')
+        encode_times.append(encoded - started)
+        serialize_times.append(time.perf_counter() - encoded)
+    started = time.perf_counter()
+    gzipped: bytes = gzip.compress(body, compresslevel=6)
+    gzip_time: float = time.perf_counter() - started
+    started = time.perf_counter()
+    brotlied: bytes = brotli.compress(body, quality=4)
+    brotli_time: float = time.perf_counter() - started
+    return {'format': p_name, 'json_mb': len(body) / 1e6, 'gzip_mb': len(gzipped) / 1e6,
+            'brotli_mb': len(brotlied) / 1e6, 'encode_s': min(encode_times), 'serialize_s': min(serialize_times),
+            'gzip_s': gzip_time, 'brotli_s': brotli_time, 'payload': payload}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    balances, segments = build_balances(args.rows)
+    df: pd.DataFrame = join_descriptions(balances, segments)
+    df.insert(1, 'AccountName', 'Account ' + df['ACCOUNT'])
+    results: list = [measure('records', lambda frame: frame.to_dict("records"), df, args.repeat),
+                     measure('columns', encode_columns, df, args.repeat)]
+
+    # The browser must get the same rows from both formats
+    records: list = results[0]['payload']
+    decoded: list = decode_columns(results[1]['payload'])
+    assert len(decoded) == len(records)
+    for position in np.linspace(0, len(records) - 1, num=min(len(records), 1000), dtype=int):
+        assert all(_same(decoded[position][column], value) for column, value in records[position].items())
+
+    report: pd.DataFrame = pd.DataFrame([{key: value for key, value in result.items() if key != 'payload'}
+                                         for result in results]).set_index('format')
+    print(f"rows: {len(df)}, columns: {len(df.columns)}")
+    print(report.round(3).to_string())
+    records_row, columns_row = report.loc['records'], report.loc['columns']
+    serialize_ratio: float = ((records_row['encode_s'] + records_row['serialize_s'])
+                              / (columns_row['encode_s'] + columns_row['serialize_s']))
+    print(f"columns vs records: {records_row['json_mb'] / columns_row['json_mb']:.1f}x smaller JSON, "
+          f"{records_row['brotli_mb'] / columns_row['brotli_mb']:.1f}x smaller compressed, "
+          f"{serialize_ratio:.1f}x faster to serialize")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
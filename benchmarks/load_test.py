@@ -0,0 +1,481 @@
+"""
+Load test of the Dash callbacks with simulated concurrent users.
+
+Starts the mock Fusion server (benchmarks.mock_fusion) and the application against it, each in its own process
+and in a scratch directory, then runs every concurrency level for --duration seconds. Every simulated user
+repeats a reviewer session: selects a ledger (update_output), loads its periods (get_periods), pulls a random
+selection into the table (display_table) or Pygwalker (display_pygwalker) and polls the job until it finished
+(poll_job, reported as 'job' for the whole pull), with some think time in between. The callbacks are called
+through the Dash HTTP endpoint like the browser calls them.
+
+With --workers N the application runs as a multi-worker deployment instead: the writer process
+(packages.writer) and N web worker processes, the simulated users are spread over the workers.
+
+Reports p50/p95/p99 latency, error rate and throughput per callback and the server RSS per concurrency level.
+The results are saved as JSON in benchmarks/results named after the git revision, --compare prints the change
+against an earlier result. Settings of the .env file, e.g. API_RATE_LIMIT and JOB_WORKERS, apply to the server.
+
+Run from the application directory (it needs lg_list.json like main.py):
+    python -m benchmarks.load_test [--users 1 5 10 25] [--duration 60] [--workers 4]
+                                   [--compare benchmarks/results/<file>.json]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import psutil
+import requests
+
+from packages.endpoints import ledgers_endpoint
+from packages.persist_metadata import load_lg_list_to_dataframe
+
+app_dir: Path = Path(__file__).resolve().parents[1]
+results_dir: Path = app_dir / 'benchmarks' / 'results'
+# Callbacks are found in /_dash-dependencies by one of their outputs, duplicate outputs carry an @hash suffix
+callback_outputs: dict = {
+    'update_output': 'flex_from_dropdown.children',
+    'get_periods': 'periods-store.data',
+    'display_table': 'job-store.data',
+    'display_pygwalker': 'pygwalker_div.children',
+    'poll_job': 'stream-cursor.data',
+}
+flex_dropdown_type = 'flex-dynamic-dropdown'
+
+
+def _output_parts(p_output: str) -> list:
+    return p_output[2:-2].split('...') if p_output.startswith('..') else [p_output]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class DashClient:
+    """
+    Calls the callbacks of a running Dash app over HTTP with the payloads the browser sends.
+    """
+
+    def __init__(self, base_url: str, dependencies: list, timeout: float):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.callbacks: dict = {}
+        for name, output in callback_outputs.items():
+            self.callbacks[name] = next(dependency for dependency in dependencies
+                                        if output in _output_parts(dependency['output']))
+
+    @staticmethod
+    def _argument(spec: dict, p_values: dict):
+        if spec['id'].startswith('{'):
+            # Pattern matching (ALL) argument: one entry per matching component
+            pattern_type: str = json.loads(spec['id'])['type']
+            return [{'id': component_id, 'property': spec['property'], 'value': value}
+                    for component_id, value in p_values.get((pattern_type, spec['property']), [])]
+        return {'id': spec['id'], 'property': spec['property'],
+                'value': p_values.get(f"{spec['id']}.{spec['property']}")}
+
+    def call(self, p_name: str, p_values: dict, p_changed: str) -> dict:
+        """
+        Calls a callback, p_values maps 'component-id.property' (or (pattern type, property) for pattern
+        matching arguments) to the values the browser would send.
+
+        Returns:
+        - dict: {component id: {property: value}} of the response, empty when the callback prevented the update.
+        """
+        dependency: dict = self.callbacks[p_name]
+        outputs: list = [{'id': part.rsplit('.', 1)[0], 'property': part.rsplit('.', 1)[1].split('@')[0]}
+                         for part in _output_parts(dependency['output'])]
+        payload: dict = {
+            'output': dependency['output'],
+            'outputs': outputs if dependency['output'].startswith('..') else outputs[0],
+            'inputs': [self._argument(spec, p_values) for spec in dependency['inputs']],
+            'state': [self._argument(spec, p_values) for spec in dependency['state']],
+            'changedPropIds': [p_changed],
+        }
+        response: requests.Response = self.session.post(f'{self.base_url}/_dash-update-component', json=payload,
+                                                        timeout=self.timeout)
+        if response.status_code == 204:
+            return {}
+        response.raise_for_status()
+        return response.json().get('response', {})
+
+
+def _flex_dropdowns(p_children) -> list:
+    """
+    Returns (component id, option values) of the segment dropdowns in the update_output response.
+    """
+    dropdowns: list = []
+
+    def visit(node):
+        if isinstance(node, dict):
+            props = node.get('props')
+            if isinstance(props, dict) and isinstance(props.get('id'), dict) \
+                    and props['id'].get('type') == flex_dropdown_type:
+                dropdowns.append((props['id'], [option['value'] for option in props.get('options') or []]))
+            for value in node.values():
+                visit(value)
+        elif isinstance(node, list):
+            for value in node:
+                visit(value)
+
+    visit(p_children)
+    return dropdowns
+
+
+class LoadRecorder:
+    """
+    Collects (callback, latency, ok) of the calls of all simulated users.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.records: list = []
+
+    def timed(self, p_name: str, func, *args):
+        started: float = time.perf_counter()
+        try:
+            result = func(*args)
+            ok: bool = True
+        except (requests.RequestException, ValueError, KeyError, StopIteration):
+            result, ok = None, False
+        with self._lock:
+            self.records.append((p_name, time.perf_counter() - started, ok))
+        return result
+
+    def add(self, p_name: str, p_latency: float, p_ok: bool):
+        with self._lock:
+            self.records.append((p_name, p_latency, p_ok))
+
+
+def run_session(client: DashClient, recorder: LoadRecorder, rng: random.Random, p_ledger_ids: list,
+                args: argparse.Namespace):
+    """
+    One reviewer session: ledger, periods, a random selection pulled into the table or Pygwalker,
+    and the job polled every second like the page does until it finished.
+    """
+    ledger_id = rng.choice(p_ledger_ids)
+    ledger: Optional[dict] = recorder.timed('update_output', client.call, 'update_output',
+                                            {'ledger-dropdown.value': ledger_id}, 'ledger-dropdown.value')
+    if not ledger:
+        return
+    periods_response: Optional[dict] = recorder.timed('get_periods', client.call, 'get_periods',
+                                                      {'ledger-store.data': ledger_id}, 'ledger-store.data')
+    if not periods_response:
+        return
+    periods: list = [option['value'] for option in periods_response['periods-store']['data']]
+    dropdowns: list = _flex_dropdowns(ledger['flex_from_dropdown']['children'])
+    if not periods or not dropdowns:
+        return
+
+    # Recent periods (latest first in the options), one or two segments restricted to a few values
+    start: int = rng.randrange(min(12, len(periods)))
+    chosen: list = periods[start:start + rng.randint(1, args.max_periods)]
+    restricted: set = set(rng.sample(range(len(dropdowns)), k=min(len(dropdowns), rng.randint(1, 2))))
+    selection: list = [(component_id, sorted(rng.sample(options, k=min(len(options), rng.randint(1, 2))))
+                        if position in restricted and options else '%')
+                       for position, (component_id, options) in enumerate(dropdowns)]
+    flex_mode: str = 'Summary' if rng.random() < args.summary_share else 'Detail'
+    subtotal_options: list = ledger.get('subtotal-dropdown', {}).get('options') or []
+    subtotals: Optional[list] = (subtotal_options[:rng.randint(1, 2)]
+                                 if flex_mode == 'Summary' and subtotal_options and rng.random() < 0.3 else None)
+    target: str = 'display_pygwalker' if rng.random() < args.pygwalker_share else 'display_table'
+    values: dict = {
+        (flex_dropdown_type, 'value'): selection,
+        (flex_dropdown_type, 'id'): [(component_id, component_id) for component_id, _ in selection],
+        'ledger-dropdown.value': ledger_id,
+        'period-from-dropdown.value': chosen[-1],
+        'period-to-dropdown.value': chosen[0],
+        'flex_mode.value': flex_mode,
+        'currency-dropdown.value': ledger['currency-dropdown']['value'],
+        'balance-type.value': 'Total',
+        'from-currency-dropdown.value': None,
+        'subtotal-dropdown.value': subtotals,
+        'trend-measure.value': 'EndingBalance',
+        'list_flex_btn.n_clicks': 1,
+        'pyg_flex_btn.n_clicks': 1,
+    }
+    button: str = 'pyg_flex_btn.n_clicks' if target == 'display_pygwalker' else 'list_flex_btn.n_clicks'
+    submitted: float = time.perf_counter()
+    pull: Optional[dict] = recorder.timed(target, client.call, target, values, button)
+    job: Optional[dict] = (pull or {}).get('job-store', {}).get('data')
+    if not job:
+        return
+
+    cursor: int = 0
+    status: str = 'timeout'
+    for interval in range(1, int(args.job_timeout) + 1):
+        time.sleep(1.0)
+        progress: Optional[dict] = recorder.timed('poll_job', client.call, 'poll_job',
+                                                  {'job-interval.n_intervals': interval, 'job-store.data': job,
+                                                   'stream-cursor.data': cursor}, 'job-interval.n_intervals')
+        if progress is None:
+            continue
+        if not progress:
+            status = 'missing'
+            break
+        cursor = progress.get('stream-cursor', {}).get('data', cursor)
+        if progress.get('job-interval', {}).get('disabled') is True:
+            status = str(progress['job-progress']['label']).split(':', 1)[0]
+            break
+    recorder.add('job', time.perf_counter() - submitted, status == 'done')
+
+
+def _user_loop(client: DashClient, recorder: LoadRecorder, p_seed: int, p_ledger_ids: list,
+               args: argparse.Namespace, p_stop_at: float):
+    rng: random.Random = random.Random(p_seed)
+    while time.monotonic() < p_stop_at:
+        run_session(client, recorder, rng, p_ledger_ids, args)
+        time.sleep(rng.uniform(0.5, 1.5) * args.think)
+
+
+class RssSampler:
+    """
+    Samples the resident memory of the server processes and their children twice a second.
+    """
+
+    def __init__(self, p_pids: list):
+        self.processes: list = [psutil.Process(pid) for pid in p_pids]
+        self.samples: list = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def rss(self) -> int:
+        processes: list = [child for process in self.processes
+                           for child in [process] + process.children(recursive=True)]
+        return sum(process.memory_info().rss for process in processes)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.samples.append(self.rss())
+            self._stop.wait(0.5)
+
+    def __enter__(self) -> 'RssSampler':
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+
+
+def summarize(p_records: list, p_users: int, p_elapsed: float, p_rss_samples: list) -> dict:
+    """
+    Latency percentiles (of the successful calls), error rate and throughput per callback for one level.
+    """
+    callbacks: dict = {}
+    for name in sorted({record[0] for record in p_records}):
+        latencies: np.ndarray = np.array([latency for record_name, latency, ok in p_records
+                                          if record_name == name and ok]) * 1000
+        calls: int = sum(1 for record in p_records if record[0] == name)
+        errors: int = calls - len(latencies)
+        percentiles: list = (np.percentile(latencies, [50, 95, 99]).round(1).tolist() if len(latencies)
+                             else [None, None, None])
+        callbacks[name] = {'calls': calls, 'errors': errors, 'error_rate': round(errors / calls, 4),
+                           'p50_ms': percentiles[0], 'p95_ms': percentiles[1], 'p99_ms': percentiles[2],
+                           'throughput': round(calls / p_elapsed, 3)}
+    http_records: list = [record for record in p_records if record[0] != 'job']
+    errors: int = sum(1 for record in http_records if not record[2])
+    mb: float = 1024 * 1024
+    return {
+        'users': p_users,
+        'elapsed_s': round(p_elapsed, 1),
+        'calls': len(http_records),
+        'errors': errors,
+        'error_rate': round(errors / len(http_records), 4) if http_records else None,
+        'throughput': round(len(http_records) / p_elapsed, 3),
+        'rss_start_mb': round(p_rss_samples[0] / mb, 1) if p_rss_samples else None,
+        'rss_peak_mb': round(max(p_rss_samples) / mb, 1) if p_rss_samples else None,
+        'rss_end_mb': round(p_rss_samples[-1] / mb, 1) if p_rss_samples else None,
+        'callbacks': callbacks,
+    }
+
+
+def run_level(clients: list, p_server_pids: list, p_users: int, p_ledger_ids: list,
+              args: argparse.Namespace) -> dict:
+    recorder: LoadRecorder = LoadRecorder()
+    started: float = time.monotonic()
+    stop_at: float = started + args.duration
+    # Users are spread over the web workers like a load balancer would
+    users: list = [threading.Thread(target=_user_loop, daemon=True,
+                                    args=(clients[user % len(clients)], recorder, args.seed * 1000 + user,
+                                          p_ledger_ids, args, stop_at))
+                   for user in range(p_users)]
+    with RssSampler(p_server_pids) as sampler:
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+    return summarize(recorder.records, p_users, time.monotonic() - started, sampler.samples)
+
+
+def _wait_until_up(p_url: str, p_process: subprocess.Popen, p_log: Path, p_timeout: float):
+    deadline: float = time.monotonic() + p_timeout
+    while time.monotonic() < deadline:
+        if p_process.poll() is not None:
+            raise RuntimeError(f"Process exited with {p_process.returncode}:\n{p_log.read_text()[-3000:]}")
+        try:
+            if requests.get(p_url, timeout=5).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"{p_url} not up after {p_timeout}s:\n{p_log.read_text()[-3000:]}")
+
+
+def start_servers(p_work_dir: Path, args: argparse.Namespace) -> tuple:
+    """
+    Starts the mock Fusion server and the application in the scratch directory, with --workers the writer
+    process and the web workers of a multi-worker deployment.
+
+    Returns:
+    - tuple: (mock process, application processes, URLs of the web workers)
+    """
+    mock_port: int = _free_port()
+    env: dict = {**os.environ, 'PYTHONPATH': str(app_dir)}
+    mock_log: Path = p_work_dir / 'mock_fusion.log'
+    mock = subprocess.Popen([sys.executable, '-m', 'benchmarks.mock_fusion', '--port', str(mock_port),
+                             '--lg-list', str(p_work_dir / 'lg_list.json'), '--api-delay', str(args.api_delay),
+                             '--detail-rows', str(args.detail_rows)],
+                            cwd=app_dir, env=env, stdout=open(mock_log, 'w'), stderr=subprocess.STDOUT)
+    _wait_until_up(f'http://127.0.0.1:{mock_port}{ledgers_endpoint}', mock, mock_log, 60)
+    # Environment variables win over the .env file, the server only touches the scratch directory
+    env.update(BASE_API_URL=f'http://127.0.0.1:{mock_port}', ORACLE_FUSION_USERNAME='load',
+               ORACLE_FUSION_PASSWORD='test', DUCKDB_DB_PATH='ledgers.duckdb', JOBS_CACHE_DIR='.jobs_cache',
+               HTTP_CACHE_DIR='.http_cache', OFFLINE_SNAPSHOT='', WARM_ENABLED='false')
+    processes: list = []
+    if args.workers:
+        env.update(MULTI_WORKER='true', REPLICA_DIR='.replicas')
+        writer_log: Path = p_work_dir / 'writer.log'
+        processes.append(subprocess.Popen([sys.executable, '-m', 'packages.writer'], cwd=p_work_dir, env=env,
+                                          stdout=open(writer_log, 'w'), stderr=subprocess.STDOUT))
+    app_urls: list = []
+    for worker in range(max(args.workers, 1)):
+        app_port: int = _free_port()
+        app_log: Path = p_work_dir / f'app_{worker}.log'
+        app = subprocess.Popen([sys.executable, '-c', f"import main; main.app.run_server(host='127.0.0.1', "
+                                                      f"port={app_port}, debug=False)"],
+                               cwd=p_work_dir, env=env, stdout=open(app_log, 'w'), stderr=subprocess.STDOUT)
+        processes.append(app)
+        app_urls.append(f'http://127.0.0.1:{app_port}')
+        _wait_until_up(f'{app_urls[-1]}/_dash-dependencies', app, app_log, 300)
+    return mock, processes, app_urls
+
+
+def git_revision() -> str:
+    try:
+        revision: str = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=app_dir, capture_output=True,
+                                       text=True, check=True).stdout.strip()
+        dirty: str = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=app_dir,
+                                    capture_output=True, text=True, check=True).stdout.strip()
+        return f'{revision}-dirty' if dirty else revision
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def level_table(p_level: dict) -> pd.DataFrame:
+    return pd.DataFrame.from_dict(p_level['callbacks'], orient='index')
+
+
+def compare(p_result: dict, p_baseline: dict) -> pd.DataFrame:
+    """
+    p95 latency and throughput of every callback and level in both results, with their ratio.
+    """
+    rows: list = []
+    baseline_levels: dict = {level['users']: level for level in p_baseline['levels']}
+    for level in p_result['levels']:
+        baseline: Optional[dict] = baseline_levels.get(level['users'])
+        if not baseline:
+            continue
+        for name, stats in level['callbacks'].items():
+            before: Optional[dict] = baseline['callbacks'].get(name)
+            if not before:
+                continue
+            rows.append({'users': level['users'], 'callback': name,
+                         'p95_ms_before': before['p95_ms'], 'p95_ms': stats['p95_ms'],
+                         'p95_ratio': round(stats['p95_ms'] / before['p95_ms'], 2)
+                         if stats['p95_ms'] and before['p95_ms'] else None,
+                         'throughput_before': before['throughput'], 'throughput': stats['throughput'],
+                         'error_rate_before': before['error_rate'], 'error_rate': stats['error_rate']})
+    return pd.DataFrame(rows)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Load test of the Dash callbacks against a mock Fusion server")
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 5, 10, 25], help="concurrency levels")
+    parser.add_argument('--duration', type=float, default=60, help="seconds every level starts sessions")
+    parser.add_argument('--think', type=float, default=2.0, help="mean seconds between the sessions of a user")
+    parser.add_argument('--max-periods', type=int, default=3, help="periods of a selection at most")
+    parser.add_argument('--summary-share', type=float, default=0.4, help="share of Summary pulls")
+    parser.add_argument('--pygwalker-share', type=float, default=0.2, help="share of pulls shown in Pygwalker")
+    parser.add_argument('--api-delay', type=float, default=0.2, help="seconds per mock ledgerBalances call")
+    parser.add_argument('--detail-rows', type=int, default=200, help="Detail rows per mock ledgerBalances call")
+    parser.add_argument('--job-timeout', type=float, default=300, help="seconds a pull is polled at most")
+    parser.add_argument('--timeout', type=float, default=60, help="seconds per callback request")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="web workers of a multi-worker deployment, 0 runs main.py as one process")
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--lg-list', default='lg_list.json')
+    parser.add_argument('--output', help="result file, benchmarks/results/load_<revision>_<time>.json by default")
+    parser.add_argument('--compare', help="earlier result file to compare with")
+    parser.add_argument('--keep', action='store_true', help="keep the scratch directory with the server logs")
+    args = parser.parse_args()
+
+    ledger_ids: list = [int(ledger_id) for ledger_id in load_lg_list_to_dataframe(args.lg_list)['ledger_id'].unique()]
+    work_dir: Path = Path(tempfile.mkdtemp(prefix='glwalker-load-'))
+    shutil.copy(args.lg_list, work_dir / 'lg_list.json')
+    mock, processes, app_urls = start_servers(work_dir, args)
+    try:
+        clients: list = [DashClient(app_url, requests.get(f'{app_url}/_dash-dependencies').json(), args.timeout)
+                         for app_url in app_urls]
+        levels: list = []
+        for users in args.users:
+            print(f"\n{users} users, {args.duration:.0f}s ...", flush=True)
+            level: dict = run_level(clients, [process.pid for process in processes], users, ledger_ids, args)
+            levels.append(level)
+            print(f"{level['throughput']} calls/s, error rate {level['error_rate']}, "
+                  f"RSS peak {level['rss_peak_mb']} MB (end {level['rss_end_mb']} MB)")
+            print(level_table(level).to_string())
+    finally:
+        for process in processes + [mock]:
+            process.terminate()
+        for process in processes + [mock]:
+            process.wait(30)
+        if args.keep:
+            print(f"Server logs in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    revision: str = git_revision()
+    result: dict = {'revision': revision, 'created_at': datetime.now().isoformat(timespec='seconds'),
+                    'settings': {key: value for key, value in vars(args).items()
+                                 if key not in ('output', 'compare', 'keep')},
+                    'levels': levels}
+    output: Path = Path(args.output) if args.output else \
+        results_dir / f"load_{revision}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2), encoding='utf-8')
+    print(f"\nResults saved to {output}")
+    if args.compare:
+        baseline: dict = json.loads(Path(args.compare).read_text(encoding='utf-8'))
+        print(f"\nCompared with {baseline['revision']} ({baseline['created_at']}):")
+        print(compare(result, baseline).to_string(index=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""
+Mock of the Oracle Fusion REST endpoints used by the application, for the load test (benchmarks.load_test).
+
+Ledgers and value sets are generated from lg_list.json: every ledger of the file exists, every value set
+has values_per_segment codes of the segment's DISPLAY_SIZE. Accounting periods are monthly, for the last
+years of the calendar. A ledgerBalances call answers after api_delay seconds with up to detail_rows Detail
+rows per (combination, period), deterministic for the same finder, or one Summary row. Responses are paged
+with offset/limit like Fusion, LOV pages carry an ETag and answer conditional requests with 304.
+
+Run standalone from the application directory:
+    python -m benchmarks.mock_fusion [--port 8099] [--api-delay 0.2]
+"""
+import argparse
+import random
+import time
+from datetime import date
+
+import pandas as pd
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+from packages.endpoints import (ledgers_endpoint, periods_endpoint, currencies_endpoint, segments_endpoint,
+                                balances_endpoint)
+from packages.persist_metadata import load_lg_list_to_dataframe
+
+months: list = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+
+def _page(items: list):
+    offset: int = int(request.args.get('offset', 0))
+    limit: int = int(request.args.get('limit', 500))
+    response = jsonify({'items': items[offset:offset + limit], 'count': len(items[offset:offset + limit]),
+                        'hasMore': offset + limit < len(items)})
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def create_app(p_lg_list: pd.DataFrame, p_values_per_segment: int = 20, p_detail_rows: int = 200,
+               p_api_delay: float = 0.2, p_years: int = 2) -> Flask:
+    """
+    Builds the mock Fusion server.
+
+    Parameters:
+    - p_lg_list (pd.DataFrame): Parsed lg_list.json, the ledgers and segments to serve.
+    - p_values_per_segment (int): Codes per value set.
+    - p_detail_rows (int): Maximum Detail rows of one (combination, period) call.
+    - p_api_delay (float): Seconds every ledgerBalances call takes.
+    - p_years (int): Years of monthly periods up to the current one.
+
+    Returns:
+    - Flask: The mock server application.
+    """
+    app = Flask(__name__)
+    value_sets: dict = {}
+    for value_set_name, display_size in (p_lg_list.groupby('VALUE_SET_NAME')['DISPLAY_SIZE'].max().items()):
+        value_sets[value_set_name] = [str(code).zfill(int(display_size))
+                                      for code in range(1, p_values_per_segment + 1)]
+    segments: dict = {ledger_id: ledger_segments.sort_values('SEGMENT_NUMBER')
+                      for ledger_id, ledger_segments in p_lg_list.groupby('ledger_id')}
+    first_year: int = date.today().year - p_years + 1
+    periods: list = [{'PeriodNameId': f'{month}-{str(year)[2:]}', 'PeriodSetNameId': 'Accounting',
+                      'PeriodType': 'Month', 'PeriodYear': year, 'PeriodNumber': number,
+                      'StartDate': f'{year}-{number:02d}-01', 'EndDate': f'{year}-{number:02d}-28'}
+                     for year in range(first_year, first_year + p_years)
+                     for number, month in enumerate(months, start=1)]
+    ledger_by_name: dict = {f'Ledger {ledger_id}': ledger_id for ledger_id in segments}
+
+    @app.route(ledgers_endpoint)
+    def ledgers():
+        return _page([{'AccountedPeriodType': 'Month', 'ChartOfAccountsId': 1, 'Description': '',
+                       'EnableBudgetaryControlFlag': 'N', 'LedgerCategoryCode': 'PRIMARY', 'LedgerId': int(ledger_id),
+                       'Name': name, 'PeriodSetName': 'Accounting', 'CurrencyCode': 'USD'}
+                      for name, ledger_id in ledger_by_name.items()])
+
+    @app.route(periods_endpoint)
+    def accounting_periods():
+        return _page(periods)
+
+    @app.route(currencies_endpoint)
+    def currencies():
+        return _page([{'CurrencyCode': 'USD', 'Name': 'US Dollar'}, {'CurrencyCode': 'EUR', 'Name': 'Euro'}])
+
+    @app.route(f'{segments_endpoint}<value_set_name>/child/values')
+    def values(value_set_name: str):
+        return _page([{'Value': code, 'Description': f'{value_set_name} {code}', 'EnabledFlag': 'Y',
+                       'StartDateActive': None, 'EndDateActive': None}
+                      for code in value_sets.get(value_set_name, [])])
+
+    @app.route(balances_endpoint)
+    def balances():
+        finder: dict = dict(item.split('=', 1) for item in request.args['finder'].split(';', 1)[1].split(','))
+        ledger_segments: pd.DataFrame = segments[ledger_by_name[finder['ledgerName']]]
+        separator: str = ledger_segments['SEGMENT_SEPARATOR'].iloc[0]
+        parts: list = finder['accountCombination'].split(separator)
+        codes: list = [value_sets[value_set_name] if part == '%' else [part]
+                       for part, value_set_name in zip(parts, ledger_segments['VALUE_SET_NAME'])]
+        period: str = finder['accountingPeriod']
+        month: int = months.index(period[:3]) + 1
+        # The same finder always returns the same rows, pages of one pull stay consistent
+        rng: random.Random = random.Random(request.args['finder'])
+        combinations: dict = {}
+        for _ in range(p_detail_rows):
+            combination: str = separator.join(rng.choice(segment_codes) for segment_codes in codes)
+            combinations.setdefault(combination, rng.randint(-100000, 100000))
+        time.sleep(p_api_delay)
+        base: dict = {'LedgerName': finder['ledgerName'], 'Currency': finder['currency'], 'PeriodName': period,
+                      'AmountType': 'PTD', 'CurrencyType': finder['currencyType']}
+        if finder['mode'] == 'Detail':
+            rows: list = [{**base, 'AccountName': f'Account {combination.split(separator)[-1]}',
+                           'AccountCombination': combination, 'DetailAccountCombination': combination,
+                           'BeginningBalance': str(amount), 'PeriodActivity': str(month * 10),
+                           'EndingBalance': str(amount + month * 10)}
+                          for combination, amount in sorted(combinations.items())]
+        else:
+            total: int = sum(combinations.values())
+            activity: int = month * 10 * len(combinations)
+            rows: list = [{**base, 'AccountName': None, 'AccountCombination': finder['accountCombination'],
+                           'DetailAccountCombination': None, 'BeginningBalance': str(total),
+                           'PeriodActivity': str(activity), 'EndingBalance': str(total + activity)}]
+        return _page(rows)
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock Oracle Fusion REST server generated from lg_list.json")
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--lg-list', default='lg_list.json')
+    parser.add_argument('--values-per-segment', type=int, default=20)
+    parser.add_argument('--detail-rows', type=int, default=200)
+    parser.add_argument('--api-delay', type=float, default=0.2, help="seconds per ledgerBalances call")
+    args = parser.parse_args()
+
+    mock_app: Flask = create_app(load_lg_list_to_dataframe(args.lg_list), args.values_per_segment,
+                                 args.detail_rows, args.api_delay)
+    print(f"Mock Fusion server on http://127.0.0.1:{args.port}")
+    make_server('127.0.0.1', args.port, mock_app, threaded=True).serve_forever()
@@ -1,45 +1,75 @@
-from packages.load_metadata import load_metadata
-from packages.prepare_df import prepare_df
+from packages.load_metadata import load_metadata, reload_metadata
+from packages.prepare_df import prepare_df, derive_balances, get_periods_list, load_detail_result, refresh_open_periods
+from packages.balance_cache import request_signature, has_detail_balances, log_request, detail_row_keys, cached_as_of
+from packages.cache_warmer import start_cache_warmer, open_periods
+from packages.jobs import submit_job, submit_write, get_job, get_job_result, get_job_chunks, cancel_job, wait_for_job
+from packages.snapshot import read_manifest, export_snapshot
 import pandas as pd
-from packages.config import duckdb_db_path, base_api_url, username, password, ldf
+from packages.config import (duckdb_db_path, base_api_url, username, password, ldf, offline_mode, offline_snapshot,
+                             replica_wait, response_compression, balance_cache_ttl, job_wait_timeout)
 from packages.duck_select import execute_sql_query
-from packages.persist_metadata import load_lg_list_to_dataframe
+from packages.metadata_registry import registry
+from packages.replica import is_reader, wait_for_replica
+from packages.rollups import balance_columns
+from packages.transport import decode_grid_payload_js, grid_payload, transaction_payload
+from packages.spill import (SpilledResult, spilled_result, read_spilled, export_spilled, is_spill_table,
+                            head_of_spilled)
 import dash
-from dash import dcc, html, Patch
-from dash.dependencies import Input, Output, State, ALL
+from dash import dcc, html, Patch, no_update, ctx
+from dash.dependencies import Input, Output, State, ALL, MATCH
 from dash.exceptions import PreventUpdate
 import dash_dangerously_set_inner_html
 import logging
 import dash_ag_grid as dag
 import dash_bootstrap_components as dbc
 import pygwalker as pyg
+import flask
+import tempfile
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
 
 # Configure logging to output to console with level INFO
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
+# A web worker of a multi-worker deployment reads the replicas of the writer process, which loads the metadata
+if is_reader():
+    wait_for_replica(replica_wait)
+
 # load ledgers and currencies from db
-df_ledgers: pd.DataFrame = pd.DataFrame()
 df_currencies = execute_sql_query("SELECT CurrencyCode, Name FROM currencies")
 
-if df_currencies is None or df_currencies.empty:  # naively assume the database is broken or empty kinda migration
+# naively assume the database is broken or empty kinda migration, offline the snapshot bundle is all there is
+if not offline_mode and not is_reader() and (df_currencies is None or df_currencies.empty):
     load_metadata(ldf, base_api_url, username, password, duckdb_db_path)
-    df_currencies = execute_sql_query("SELECT CurrencyCode, Name FROM currencies")
 
-df_ledgers = execute_sql_query(
-    "SELECT lg.LedgerId, lg.Name, lg.CurrencyCode, lg.accountedperiodtype FROM ledgers lg where lg.LedgerId "
-    "in (select distinct ledger_id from ldf)")
+# Ledgers, periods, currencies and lg_list.json are served from the registry, callbacks only pass ledger ids
+df_ledgers: pd.DataFrame = registry.get_ledgers()
+df_currencies: pd.DataFrame = registry.get_currencies()
+
+# Re-pulls the frequently requested balances of the open periods off-peak, if WARM_ENABLED is set
+start_cache_warmer()
 
 # Initialize the Dash app
 dbc_css = "https://cdn.jsdelivr.net/gh/AnnMarieW/dash-bootstrap-templates/dbc.min.css"
-app = dash.Dash(external_stylesheets=[dbc.themes.BOOTSTRAP, dbc_css])
+# Responses are compressed with Flask-Compress, the grid rows are sent column oriented, see packages/transport.py
+app = dash.Dash(external_stylesheets=[dbc.themes.BOOTSTRAP, dbc_css], compress=response_compression)
 
 app.title = "Ledger Selector"
+# WSGI application for running several web workers, e.g. gunicorn -w 4 main:server, see packages/replica.py
+server = app.server
+
+offline_rows: list = [dbc.Row([dbc.Col(dbc.Alert(
+    f"Offline: cached balances of the snapshot of {read_manifest(offline_snapshot)['created_at']}, "
+    f"the Fusion API is not called.", color="secondary", className="py-1"), width=12)])] if offline_mode else []
 
 # Define the layout
 app.layout = dbc.Container([
 
     dbc.Row([dbc.Col(html.H3("GL Walker"), width=12)]),
+    *offline_rows,
 
     dbc.Row([
         dbc.Col([
@@ -112,8 +142,26 @@ app.layout = dbc.Container([
 
         dbc.Col([
             dbc.Label("Balance type:"),
-            dcc.RadioItems(id='flex_mode', options=['Detail', 'Summary'], value='Detail', persistence=True,
-                           persistence_type='memory')], width=2, align="start"),
+            dcc.RadioItems(id='flex_mode', options=['Detail', 'Summary', 'Trend'], value='Detail', persistence=True,
+                           persistence_type='memory', inline=True),
+            dcc.Dropdown(
+                id='subtotal-dropdown',
+                options=[],
+                placeholder="Summary subtotals by",
+                multi=True,
+                persistence=True,
+                persistence_type='memory',
+                value=None
+            ),
+            # Balance column the Trend view pivots by period
+            dcc.Dropdown(
+                id='trend-measure',
+                options=balance_columns,
+                clearable=False,
+                persistence=True,
+                persistence_type='memory',
+                value='EndingBalance'
+            )], width=2, align="start"),
     ]),
     # html.Hr(style={'borderTop': '1px solid #ccc', 'margin': '20px 0'}),
 
@@ -139,21 +187,56 @@ app.layout = dbc.Container([
             # ], width=2),
             # dbc.Col([
             dbc.Button("Pygwalker", id="pyg_flex_btn", n_clicks=0, style={"marginLeft": "4px"}, disabled=True),
+            dbc.Button("Refresh open periods", id="refresh_open_btn", n_clicks=0, style={"marginLeft": "4px"},
+                       disabled=True),
             # ], width=2)
             html.Div([
                 dbc.Button("Load/Refresh Valuesets", id="load_vsets_btn", n_clicks=0, style={"marginLeft": "4px"},
-                           color="info"),
+                           color="info", disabled=offline_mode),
                 dbc.Spinner(html.Div(id="loading-valuesets_spin")),
             ])
         ], style={"marginTop": "2px"})
     ]),
 
+    dbc.Row([
+        dbc.Col([
+            dbc.Progress(id="job-progress", value=0, label="", striped=True, animated=True,
+                         style={"height": "20px"})
+        ], width=10, align="center"),
+        dbc.Col([
+            dbc.Button("Cancel", id="cancel_job_btn", n_clicks=0, color="danger", size="sm", disabled=True)
+        ], width=2),
+    ], style={"marginTop": "2px"}),
+
     dbc.Row([
         dbc.Col([
             dcc.Loading(
                 id="loading-main-table",
                 type="default",
-                children=html.Div(id="data_table_div", style={"marginTop": "2px"}),
+                delay_show=500,  # job polling updates the div every second
+                children=html.Div([
+                    html.Div(id="table-message"),
+                    # The grid stays in the layout, so that partial results can be added as row transactions
+                    html.Div([
+                        dag.AgGrid(
+                            id="main-table",
+                            rowData=[],
+                            columnDefs=[],
+                            className="ag-theme-alpine",
+                            columnSize="sizeToFit",
+                            defaultColDef={"editable": False, "resizable": True, "sortable": True, "filter": True,
+                                           "minWidth": 100},
+                            dashGridOptions={"pagination": True, "paginationPageSize": 50, "rowHeight": 30,
+                                             "autoSizePadding": 10, "groupIncludeFooter": True,
+                                             "groupIncludeTotalFooter": True},
+                            style={"height": "400px", "width": "100%"},
+                            enableEnterpriseModules=True,  # demo only! remove for switch to free version
+                            licenseKey='you must buy a license for the AG Grid Enterprise version!',  # demo only! remove for switch to free version
+                        )
+                    ], id="grid-container", style={"display": "none"}),
+                    # Results above the memory budget are paged from their DuckDB spill table, see spilled_grid
+                    html.Div(id="spilled-container")
+                ], id="data_table_div", style={"marginTop": "2px"}),
                 style={
                     "position": "fixed",
                     "top": "50%",
@@ -169,6 +252,7 @@ app.layout = dbc.Container([
             dcc.Loading(
                 id="loading-pygwalker",
                 type="default",
+                delay_show=500,  # job polling updates the div every second
                 children=html.Div(id="pygwalker_div", style={"marginTop": "2px"}),
                 style={
                     "position": "fixed",
@@ -185,11 +269,15 @@ app.layout = dbc.Container([
     dcc.Store(id='ledger-store', storage_type='memory', data=[]),
     # Store component to hold the selected periods in session storage
     dcc.Store(id='periods-store', storage_type='memory', data=[]),
-    # Store to hold ldf DataFrame
-    dcc.Store(id='ldf-store', data=[]),  # ldf.to_dict('records')
-    # Store to hold df_ledgers DataFrame
-    dcc.Store(id='df_ledgers-store', data=df_ledgers.to_dict('records')),
-    html.Div(id='dummy-div'),  # A div that triggered callback at page load
+    # Store to hold the running balances pull, kept in session storage to reconnect after a page reload
+    dcc.Store(id='job-store', storage_type='session'),
+    # Store to hold the number of partial results of the job already added to the grid
+    dcc.Store(id='stream-cursor', storage_type='memory', data=0),
+    # Store to hold the encoded rows or row transaction of the main grid, decoded in the browser
+    dcc.Store(id='grid-payload', storage_type='memory'),
+    # Store to hold the pull parameters of the result shown, refreshed by the refresh open periods button
+    dcc.Store(id='loaded-request', storage_type='memory'),
+    dcc.Interval(id='job-interval', interval=1000, disabled=True),
 ])
 
 
@@ -200,7 +288,13 @@ app.layout = dbc.Container([
 )
 def load_valuesets(n_clicks: int):
     if n_clicks:
-        load_metadata(ldf, base_api_url, username, password, duckdb_db_path)
+        if not is_reader():
+            load_metadata(registry.get_lg_list(), base_api_url, username, password, duckdb_db_path)
+            return None
+        # Only the writer process writes DuckDB, the spinner runs until it loaded the metadata
+        job: dict = wait_for_job(submit_job('metadata', reload_metadata, {}), job_wait_timeout)
+        if job['status'] != 'done':
+            logger.error(f"Metadata load {job['status']}: {job.get('error')}")
         return None
 
 
@@ -217,26 +311,10 @@ def toggle_offcanvas(n1: int, is_open: bool):
     return is_open
 
 
-# Callback to load metadata on page load
-@app.callback(
-    Output('ldf-store', 'data'),
-    Input('dummy-div', 'children')  # This triggers the callback upon page load
-)
-def load_data_on_page_load(_):
-    # Load json with ledgers definitions
-    v_l_file_path: str = 'lg_list.json'  # Replace with your file path if different
-    v_ldf: pd.DataFrame = load_lg_list_to_dataframe(v_l_file_path)
-    v_ldf: pd.DataFrame = v_ldf.sort_values(by=['ledger_id', 'SEGMENT_NUMBER'], inplace=False)
-    # Convert DataFrame to dictionary to store in dcc.Store
-    v_ldf_dict = v_ldf.to_dict('records')
-    logger.info(f"Config file: {v_l_file_path}' loaded.")
-    logger.info(v_ldf.iloc[0].to_dict())
-    return v_ldf_dict
-
-
 @app.callback(
     # Output('flex_params_div', 'children'),
-    Output('data_table_div', 'children'),
+    Output('table-message', 'children'),
+    Output('job-store', 'data'),
     Input("list_flex_btn", "n_clicks"),
     State({"type": "flex-dynamic-dropdown", "index": ALL}, "value"),
     State({"type": "flex-dynamic-dropdown", "index": ALL}, "id"),
@@ -247,16 +325,15 @@ def load_data_on_page_load(_):
     State('currency-dropdown', 'value'),
     State('balance-type', 'value'),
     State('from-currency-dropdown', 'value'),
-    State('ldf-store', 'data'),
-    State('df_ledgers-store', 'data'),
+    State('subtotal-dropdown', 'value'),
+    State('trend-measure', 'value'),
     prevent_initial_call=True
 )
 def display_table(n_clicks: int, p_values, p_ids, p_ledger_id, p_period_from, p_period_to, p_flex_mode, p_currency,
-                  p_balance_type, p_from_currency, p_ldf, p_df_ledgers):
+                  p_balance_type, p_from_currency, p_subtotals, p_trend_measure):
     """
-    Shows datatable on button click
-    :param p_ldf:
-    :param p_df_ledgers:
+    Starts the balances pull for the datatable on button click, see poll_job for the result
+    :param p_subtotals:
     :param p_from_currency:
     :param p_balance_type:
     :param p_currency:
@@ -267,49 +344,258 @@ def display_table(n_clicks: int, p_values, p_ids, p_ledger_id, p_period_from, p_
     :param n_clicks:
     :param p_values:
     :param p_ids:
+    :param p_trend_measure:
     :return:
     """
     if n_clicks is None or n_clicks == 0:
-        return "Click the button to list chosen values."
+        return "Click the button to list chosen values.", no_update
 
     if not p_values or not p_ids:
-        return "No values selected."
+        return "No values selected.", no_update
 
-    patched_children = Patch()
-    patched_children.clear()  # remove previous selections
+    params: dict = pull_params(p_ledger_id, p_values, p_ids, p_period_from, p_period_to, p_balance_type,
+                               p_from_currency, p_currency, p_flex_mode, p_subtotals, p_trend_measure)
+    submit_write(log_request, request_signature(p_ledger_id, p_values, p_ids, p_balance_type, p_from_currency,
+                                                p_currency), params)
+    job_id: str = submit_job('table', prepare_df, params, p_stream=True)
+    return "", {'job_id': job_id, 'target': 'table'}
 
-    df: pd.DataFrame = prepare_df(p_df_ledgers, p_ledger_id, p_values, p_ids, p_ldf, p_period_from, p_period_to,
-                                  p_balance_type,
-                                  p_from_currency, p_currency, p_flex_mode)
-    if df is not None and not df.empty:
-        new_element: html.Div = html.Div([
-
-            dag.AgGrid(
-                id="main-table",
-                rowData=df.to_dict("records"),
-                columnDefs=[{"field": i, 'filter': True} for i in df.columns],
-                className="ag-theme-alpine",
-                columnSize="sizeToFit",
-                defaultColDef={"editable": False, "resizable": True, "sortable": True, "filter": True, "minWidth": 100},
-                dashGridOptions={"pagination": True, "paginationPageSize": 50, "rowHeight": 30, "autoSizePadding": 10,
-                                 "groupIncludeFooter": True, "groupIncludeTotalFooter": True},
-                style={"height": "400px", "width": "100%"},
-                enableEnterpriseModules=True,  # demo only! remove for switch to free version
-                licenseKey='you must buy a license for the AG Grid Enterprise version!',  # demo only! remove for switch to free version
-            )
 
-        ])
+@app.callback(
+    Output('table-message', 'children', allow_duplicate=True),
+    Output('job-store', 'data', allow_duplicate=True),
+    Input("refresh_open_btn", "n_clicks"),
+    State('loaded-request', 'data'),
+    prevent_initial_call=True
+)
+def display_refresh(n_clicks: int, p_loaded):
+    """
+    Pulls the open (prior and current) periods of the shown result again, whatever the dropdowns were changed to
+    since. A Detail table shown in the grid gets only the added, changed and removed rows as a row transaction,
+    see poll_job, other views are shown again from the refreshed balances.
+    :param p_loaded: Pull parameters of the shown result from 'loaded-request', see loaded_request
+    """
+    if not n_clicks:
+        raise PreventUpdate
+    if not p_loaded:
+        return html.P("Pull the balances before refreshing them."), no_update
+    params: dict = {key: value for key, value in p_loaded.items() if key != 'in_grid'}
+    periods: list = get_periods_list(params['p_ledger_id'], params['p_period_from'], params['p_period_to'])
+    refreshed: list = [period for period in periods
+                       if period in open_periods(params['p_ledger_id'], datetime.now())]
+    if not refreshed:
+        return html.P("No open period in the pulled range."), no_update
+
+    # Changes can only be applied to Detail rows shown in the main grid, not to a spilled or empty result
+    params.update(p_open_periods=refreshed, p_changes=params['p_flex_mode'] == 'Detail' and p_loaded['in_grid'])
+    job_id: str = submit_job('refresh', refresh_open_periods, params)
+    return "", {'job_id': job_id, 'target': 'refresh'}
+
+
+@app.callback(
+    Output('table-message', 'children', allow_duplicate=True),
+    Output('grid-payload', 'data', allow_duplicate=True),
+    Output('main-table', 'columnDefs', allow_duplicate=True),
+    Output('grid-container', 'style', allow_duplicate=True),
+    Output('spilled-container', 'children', allow_duplicate=True),
+    Output('loaded-request', 'data', allow_duplicate=True),
+    Input('flex_mode', 'value'),
+    Input('subtotal-dropdown', 'value'),
+    Input('trend-measure', 'value'),
+    State({"type": "flex-dynamic-dropdown", "index": ALL}, "value"),
+    State({"type": "flex-dynamic-dropdown", "index": ALL}, "id"),
+    State('ledger-dropdown', 'value'),
+    State('period-from-dropdown', 'value'),
+    State('period-to-dropdown', 'value'),
+    State('currency-dropdown', 'value'),
+    State('balance-type', 'value'),
+    State('from-currency-dropdown', 'value'),
+    State('main-table', 'columnDefs'),
+    prevent_initial_call=True
+)
+def display_rollup(p_flex_mode, p_subtotals, p_trend_measure, p_values, p_ids, p_ledger_id, p_period_from,
+                   p_period_to, p_currency, p_balance_type, p_from_currency, p_column_defs):
+    """
+    Switches the shown table between Detail, Summary/subtotals and Trend views using the Detail balances
+    already stored in DuckDB, no API calls are made. Does nothing if the request was not pulled yet.
+    """
+    if not p_column_defs or not p_values or not p_ids:
+        raise PreventUpdate
+    if ctx.triggered_id == 'trend-measure' and p_flex_mode != 'Trend':
+        raise PreventUpdate
+    signature: str = request_signature(p_ledger_id, p_values, p_ids, p_balance_type, p_from_currency, p_currency)
+    periods: list = get_periods_list(p_ledger_id, p_period_from, p_period_to)
+    if not has_detail_balances(signature, periods):
+        raise PreventUpdate
+
+    if p_flex_mode != 'Detail':
+        df: pd.DataFrame = derive_balances(signature, p_flex_mode, p_values, p_ids, p_ledger_id, periods, p_subtotals,
+                                           p_trend_measure)
     else:
-        new_element: html.Div = html.Div([
-            html.P("No data to display.")
-        ])
-    patched_children.append(new_element)
-    return patched_children
+        df = load_detail_result(signature, periods)
+    params: dict = pull_params(p_ledger_id, p_values, p_ids, p_period_from, p_period_to, p_balance_type,
+                               p_from_currency, p_currency, p_flex_mode, p_subtotals, p_trend_measure)
+    return with_cache_age(grid_outputs(df), params) + (loaded_request(df, params),)
+
+
+def grid_outputs(df) -> tuple:
+    """
+    Message, grid payload, columnDefs and container style showing the DataFrame in the main AG Grid table,
+    and the spilled container children showing a SpilledResult instead.
+    """
+    if isinstance(df, SpilledResult) and not df.empty:
+        return (html.P(f"{df.row_count} rows exceed the memory budget, they are paged from DuckDB."),
+                {'rowData': []}, [], {"display": "none"}, spilled_grid(df))
+    if df is None or df.empty:
+        return html.P("No data to display."), {'rowData': []}, [], {"display": "none"}, []
+    return "", grid_payload(df), [{"field": i, 'filter': True} for i in df.columns], {"display": "block"}, []
+
+
+def loaded_request(df, p_params: dict) -> Optional[dict]:
+    """
+    Pull parameters of a shown result for 'loaded-request', with in_grid telling whether its rows are in the
+    main AG Grid table rather than spilled. None when there is no result to refresh.
+    """
+    if df is None or df.empty:
+        return None
+    params: dict = {key: value for key, value in p_params.items() if key not in ('p_open_periods', 'p_changes')}
+    return {**params, 'in_grid': not isinstance(df, SpilledResult)}
+
+
+def with_cache_age(p_outputs: tuple, p_params: dict, p_since: Optional[str] = None) -> tuple:
+    """
+    Shows how old the cached Detail balances behind the grid outputs are in the table message, unless it
+    shows something else already. Cached balances are served for up to BALANCE_CACHE_TTL seconds.
+    :param p_outputs: grid_outputs of the result
+    :param p_params: pull_params of the result
+    :param p_since: Start of the pull, balances it pulled itself get no message
+    """
+    if p_outputs[0] not in ("", no_update):
+        return p_outputs
+    signature: str = request_signature(p_params['p_ledger_id'], p_params['p_values'], p_params['p_ids'],
+                                       p_params['p_balance_type'], p_params['p_from_currency'],
+                                       p_params['p_currency'])
+    periods: list = get_periods_list(p_params['p_ledger_id'], p_params['p_period_from'], p_params['p_period_to'])
+    # A Summary without subtotals comes from the API unless all its periods are cached, see prepare_df
+    if (p_params['p_flex_mode'] == 'Summary' and not p_params['p_subtotals'] and not offline_mode
+            and not has_detail_balances(signature, periods, balance_cache_ttl)):
+        return p_outputs
+    as_of: Optional[datetime] = cached_as_of(signature, periods)
+    if as_of is None or (p_since and as_of >= datetime.fromisoformat(p_since)):
+        return p_outputs
+    minutes: int = int((datetime.now() - as_of).total_seconds() // 60)
+    newer: str = "" if offline_mode else f", they are pulled again after {balance_cache_ttl / 60:.0f} min"
+    return (html.P(f"Balances as of {as_of:%Y-%m-%d %H:%M} ({minutes} min ago) from the cache{newer}."),
+            ) + p_outputs[1:]
+
+
+# Rows of the main grid arrive through the 'grid-payload' store, see packages/transport.py
+app.clientside_callback(
+    decode_grid_payload_js,
+    Output('main-table', 'rowData'),
+    Output('main-table', 'rowTransaction'),
+    Input('grid-payload', 'data'),
+    State('main-table', 'id'),
+    prevent_initial_call=True
+)
+
+
+def spilled_grid(result: SpilledResult) -> html.Div:
+    """
+    AG Grid with the infinite row model reading the spill table page by page, see get_spilled_rows.
+    The table name is part of the grid id, so every spilled result gets a fresh grid.
+    """
+    return html.Div([
+        html.A("Download CSV", href=f"/spilled/{result.table_name}.csv"),
+        html.Div(id={"type": "spilled-message", "index": result.table_name}),
+        dag.AgGrid(
+            id={"type": "spilled-table", "index": result.table_name},
+            rowModelType="infinite",
+            columnDefs=[{"field": i} for i in result.columns],
+            className="ag-theme-alpine",
+            columnSize="sizeToFit",
+            defaultColDef={"editable": False, "resizable": True, "sortable": True, "minWidth": 100},
+            dashGridOptions={"pagination": True, "paginationPageSize": 50, "rowHeight": 30,
+                             "cacheBlockSize": 500, "maxBlocksInCache": 10},
+            style={"height": "400px", "width": "100%"},
+        )
+    ])
+
+
+@app.callback(
+    Output({"type": "spilled-table", "index": MATCH}, 'getRowsResponse'),
+    Output({"type": "spilled-message", "index": MATCH}, 'children'),
+    Input({"type": "spilled-table", "index": MATCH}, 'getRowsRequest'),
+    prevent_initial_call=True
+)
+def get_spilled_rows(p_request: dict):
+    """
+    Reads the block of rows the spilled grid asks for from DuckDB.
+    """
+    table_name: str = ctx.triggered_id['index']
+    if not p_request or not is_spill_table(table_name):
+        raise PreventUpdate
+    result: Optional[SpilledResult] = spilled_result(table_name)
+    if result is None:
+        return {'rowData': [], 'rowCount': 0}, html.P("This result has expired, pull the balances again.")
+    rows_df: pd.DataFrame = read_spilled(result, p_request['startRow'], p_request['endRow'],
+                                         p_request.get('sortModel'))
+    return {'rowData': rows_df.to_dict("records"), 'rowCount': result.row_count}, no_update
+
+
+@app.server.route('/spilled/<table_name>.csv')
+def download_spilled(table_name: str):
+    """
+    Exports a spilled result as CSV, written by DuckDB to a temporary file of the request and streamed from disk.
+    The file is removed once it was sent or the download was aborted.
+    """
+    if not is_spill_table(table_name) or execute_sql_query(
+            "SELECT table_name FROM duckdb_tables() WHERE table_name = ?", [table_name]).empty:
+        flask.abort(404)
+    with tempfile.NamedTemporaryFile(prefix=f"{table_name}_", suffix='.csv', delete=False) as export_file:
+        export_path: Path = Path(export_file.name)
+    try:
+        export_spilled(table_name, export_path)
+    except Exception:
+        export_path.unlink(missing_ok=True)
+        raise
+    return flask.Response(stream_and_remove(export_path), mimetype='text/csv',
+                          headers={'Content-Disposition': f'attachment; filename=balances_{table_name}.csv'})
+
+
+@app.server.route('/snapshot.tar')
+def download_snapshot():
+    """
+    Exports a snapshot bundle of the app's database, see packages.snapshot. It reads through the app's own
+    connection, so it works while the app holds ledgers.duckdb, unlike python -m packages.snapshot export.
+    """
+    with tempfile.NamedTemporaryFile(prefix='glwalker-snapshot_', suffix='.tar', delete=False) as bundle_file:
+        bundle_path: Path = Path(bundle_file.name)
+    try:
+        export_snapshot(str(bundle_path), None, registry.get_lg_list())
+    except Exception:
+        bundle_path.unlink(missing_ok=True)
+        raise
+    return flask.Response(stream_and_remove(bundle_path), mimetype='application/x-tar',
+                          headers={'Content-Disposition': f'attachment; filename=glwalker-snapshot-'
+                                                          f'{datetime.now():%Y%m%d-%H%M%S}.tar'})
+
+
+def stream_and_remove(p_path: Path):
+    """
+    Streams a temporary file of a download and removes it once it was sent or the download was aborted.
+    """
+    try:
+        with open(p_path, 'rb') as file:
+            yield from iter(lambda: file.read(1024 * 1024), b'')
+    finally:
+        p_path.unlink(missing_ok=True)
 
 
 @app.callback(
     # Output('flex_params_div', 'children'),
     Output('pygwalker_div', 'children'),
+    Output('job-store', 'data', allow_duplicate=True),
     Input("pyg_flex_btn", "n_clicks"),
     State({"type": "flex-dynamic-dropdown", "index": ALL}, "value"),
     State({"type": "flex-dynamic-dropdown", "index": ALL}, "id"),
@@ -320,16 +606,15 @@ def display_table(n_clicks: int, p_values, p_ids, p_ledger_id, p_period_from, p_
     State('currency-dropdown', 'value'),
     State('balance-type', 'value'),
     State('from-currency-dropdown', 'value'),
-    State('ldf-store', 'data'),
-    State('df_ledgers-store', 'data'),
+    State('subtotal-dropdown', 'value'),
+    State('trend-measure', 'value'),
     prevent_initial_call=True
 )
 def display_pygwalker(n_clicks: int, p_values, p_ids, p_ledger_id, p_period_from, p_period_to, p_flex_mode, p_currency,
-                      p_balance_type, p_from_currency, p_ldf, p_df_ledgers):
+                      p_balance_type, p_from_currency, p_subtotals, p_trend_measure):
     """
-    Shows pygwalker on button click
-    :param p_df_ledgers:
-    :param p_ldf:
+    Starts the balances pull for pygwalker on button click, see poll_job for the result
+    :param p_subtotals:
     :param p_from_currency:
     :param p_balance_type:
     :param p_currency:
@@ -340,34 +625,165 @@ def display_pygwalker(n_clicks: int, p_values, p_ids, p_ledger_id, p_period_from
     :param n_clicks:
     :param p_values:
     :param p_ids:
+    :param p_trend_measure:
     :return:
     """
     if n_clicks is None or n_clicks == 0:
-        return "Click the button to list chosen values."
+        return "Click the button to list chosen values.", no_update
 
     if not p_values or not p_ids:
-        return "No values selected."
+        return "No values selected.", no_update
 
-    df: pd.DataFrame = prepare_df(p_df_ledgers, p_ledger_id, p_values, p_ids, p_ldf, p_period_from, p_period_to,
-                                  p_balance_type,
-                                  p_from_currency, p_currency, p_flex_mode)
+    params: dict = pull_params(p_ledger_id, p_values, p_ids, p_period_from, p_period_to, p_balance_type,
+                               p_from_currency, p_currency, p_flex_mode, p_subtotals, p_trend_measure)
+    submit_write(log_request, request_signature(p_ledger_id, p_values, p_ids, p_balance_type, p_from_currency,
+                                                p_currency), params)
+    job_id: str = submit_job('pygwalker', prepare_df, params)
+    return [], {'job_id': job_id, 'target': 'pygwalker'}
 
-    patched_children = Patch()
-    patched_children.clear()  # remove previous selections
-    if df is not None and not df.empty:
-        # html_code = pyg.walk(df,  use_kernel_calc=True, return_html=True).to_html()
-        html_code = pyg.walk(df, return_html=True).to_html()
 
-        new_element: html.Div = html.Div([
-            dash_dangerously_set_inner_html.DangerouslySetInnerHTML(html_code)
-        ])
+@app.callback(
+    Output('table-message', 'children', allow_duplicate=True),
+    Output('grid-payload', 'data', allow_duplicate=True),
+    Output('main-table', 'columnDefs', allow_duplicate=True),
+    Output('grid-container', 'style', allow_duplicate=True),
+    Output('spilled-container', 'children', allow_duplicate=True),
+    Output('pygwalker_div', 'children', allow_duplicate=True),
+    Output('stream-cursor', 'data'),
+    Output('job-progress', 'value'),
+    Output('job-progress', 'label'),
+    Output('job-interval', 'disabled'),
+    Output('cancel_job_btn', 'disabled'),
+    Output('loaded-request', 'data'),
+    Input('job-interval', 'n_intervals'),
+    Input('job-store', 'data'),
+    State('stream-cursor', 'data'),
+    prevent_initial_call='initial_duplicate'  # the initial call reconnects to a job after a page reload
+)
+def poll_job(_, p_job, p_cursor):
+    """
+    Reports the progress of the balances pull. Partial results of the table job are added to the grid
+    as row transactions while it runs, other results are shown once the job has finished.
+    :param p_job: {'job_id': ..., 'target': 'table' | 'pygwalker' | 'refresh'} from 'job-store'
+    :param p_cursor: Number of partial results already in the grid
+    :return:
+    """
+    if not p_job:
+        raise PreventUpdate
+    job: dict = get_job(p_job['job_id'])
+    if job is None:
+        return (no_update,) * 7 + (0, "", True, True, no_update)
+
+    # A new job or a reloaded page starts the grid from the first partial result
+    cursor: int = 0 if ctx.triggered_id == 'job-store' else (p_cursor or 0)
+    table_outputs: tuple = (no_update,) * 5
+    pygwalker_output = no_update
+    # A table pull replaces the shown result, nothing can be refreshed until it is done
+    loaded = None if job['target'] == 'table' else no_update
+    if job['target'] == 'table':
+        if job['chunks'] > cursor:
+            chunks_df: pd.DataFrame = pd.concat(get_job_chunks(job['id'], cursor, job['chunks']), ignore_index=True)
+            if cursor == 0:
+                table_outputs = grid_outputs(chunks_df)
+            else:
+                table_outputs = (no_update, transaction_payload(add=chunks_df)) + (no_update,) * 3
+            cursor = job['chunks']
+        elif cursor == 0:
+            table_outputs = ("", {'rowData': []}, [], {"display": "none"}, [])
+
+    percent: int = int(job['done'] * 100 / job['total']) if job['total'] else 0
+    label: str = f"{job['done']}/{job['total']} calls, {job['rows']} rows"
+    if job['status'] in ('queued', 'running'):
+        return table_outputs + (pygwalker_output, cursor, percent, label, False, False, loaded)
+
+    if job['status'] == 'done':
+        if job['target'] == 'pygwalker':
+            pygwalker_output = Patch()
+            pygwalker_output.clear()  # remove previous selections
+            pygwalker_output.append(render_pygwalker(get_job_result(job['id'])))
+        elif job['target'] == 'refresh':
+            result = get_job_result(job['id'])
+            if isinstance(result, dict):
+                # Only the changed rows of the open periods, applied to the rows shown in the grid
+                keyed: pd.DataFrame = next((df for df in result.values() if not df.empty), result['update'])
+                table_outputs = (html.P(f"{', '.join(job['params']['p_open_periods'])} refreshed: "
+                                        f"{len(result['add'])} added, {len(result['update'])} changed, "
+                                        f"{len(result['remove'])} removed."),
+                                 transaction_payload(detail_row_keys(keyed), **result)) + (no_update,) * 3
+            else:
+                table_outputs = grid_outputs(result)
+                loaded = loaded_request(result, job['params'])
+        else:
+            result = get_job_result(job['id'])
+            # local rollups are not streamed, spilled results replace the streamed rows
+            if job['chunks'] == 0 or isinstance(result, SpilledResult):
+                table_outputs = grid_outputs(result)
+            table_outputs = with_cache_age(table_outputs, job['params'], job.get('started_at'))
+            loaded = loaded_request(result, job['params'])
     else:
-        new_element: html.Div = html.Div([
+        resume_hint: str = '' if offline_mode else "Pull again to resume after the last completed page."
+        message: html.P = html.P(f"Balances pull {job['status']}. {job['error'] or ''} {resume_hint}")
+        if job['target'] == 'pygwalker':
+            pygwalker_output = message
+        else:
+            table_outputs = (message,) + table_outputs[1:]
+    return table_outputs + (pygwalker_output, cursor, percent, f"{job['status']}: {label}", True, True, loaded)
+
+
+@app.callback(
+    Output('job-progress', 'label', allow_duplicate=True),
+    Input('cancel_job_btn', 'n_clicks'),
+    State('job-store', 'data'),
+    prevent_initial_call=True
+)
+def cancel_pull(n_clicks: int, p_job):
+    """
+    Requests cancellation of the running balances pull
+    """
+    if not n_clicks or not p_job:
+        raise PreventUpdate
+    cancel_job(p_job['job_id'])
+    return "Cancelling..."
+
+
+def pull_params(p_ledger_id, p_values, p_ids, p_period_from, p_period_to, p_balance_type, p_from_currency, p_currency,
+                p_flex_mode, p_subtotals, p_trend_measure=None) -> dict:
+    """
+    Keyword arguments of prepare_df for a balances pull job.
+    """
+    return {'p_ledger_id': p_ledger_id, 'p_values': p_values, 'p_ids': p_ids,
+            'p_period_from': p_period_from, 'p_period_to': p_period_to,
+            'p_balance_type': p_balance_type, 'p_from_currency': p_from_currency, 'p_currency': p_currency,
+            'p_flex_mode': p_flex_mode, 'p_subtotals': p_subtotals, 'p_trend_measure': p_trend_measure}
+
+
+# pygwalker registers every DataFrame as the same view of the default DuckDB connection, concurrent walks would
+# read each other's data or deadlock between the DuckDB context lock and the GIL
+pygwalker_lock: threading.Lock = threading.Lock()
+
+
+def render_pygwalker(df) -> html.Div:
+    """
+    Shows a pulled DataFrame in pygwalker. Of a SpilledResult only the first rows fitting
+    the memory budget are shown.
+    """
+    note = None
+    if isinstance(df, SpilledResult) and not df.empty:
+        row_count: int = df.row_count
+        df = head_of_spilled(df)
+        if len(df) < row_count:
+            note = html.P(f"Showing the first {len(df)} of {row_count} rows, the result exceeds the memory budget.")
+    if df is None or df.empty:
+        return html.Div([
             html.P("No data to display.")
         ])
-
-    patched_children.append(new_element)
-    return patched_children
+    # html_code = pyg.walk(df,  use_kernel_calc=True, return_html=True).to_html()
+    with pygwalker_lock:
+        html_code = pyg.walk(df, return_html=True).to_html()
+    return html.Div([
+        note,
+        dash_dangerously_set_inner_html.DangerouslySetInnerHTML(html_code)
+    ])
 
 
 # Define callback to update output based on ledger selection, enable buttons
@@ -377,15 +793,17 @@ def display_pygwalker(n_clicks: int, p_values, p_ids, p_ledger_id, p_period_from
     Output('acc_flex_btn', 'disabled'),
     Output('list_flex_btn', 'disabled'),
     Output('pyg_flex_btn', 'disabled'),
+    Output('refresh_open_btn', 'disabled'),
+    Output('subtotal-dropdown', 'options'),
     Input('ledger-dropdown', 'value'),
     State('flex_from_dropdown', 'children'),
-    State('ldf-store', 'data'),
     prevent_initial_call=True
 )
-def update_output(p_selected_ledger_id, flex_from_dropdown, p_ldf):
+def update_output(p_selected_ledger_id, flex_from_dropdown):
     v_currency_code: str = ''
     if p_selected_ledger_id is None:
-        return None, None  # "No ledger selected."
+        # No ledger selected: no segments to select and nothing to pull
+        return [], None, True, True, True, True, []
 
     # Fetch ledger details based on selected ID
     # ledger = df_ledgers[df_ledgers['LedgerId'] == selected_ledger_id].iloc[0]
@@ -393,8 +811,7 @@ def update_output(p_selected_ledger_id, flex_from_dropdown, p_ldf):
     patched_children = Patch()
     patched_children.clear()  # remove previous selections
 
-    v_ldf = pd.DataFrame(p_ldf)
-    ledger_df = v_ldf[v_ldf['ledger_id'] == p_selected_ledger_id]
+    ledger_df: pd.DataFrame = registry.ledger_segments(p_selected_ledger_id)
 
     for index, row in ledger_df.iterrows():
         vs_vals = get_flex_values(row['VALUE_SET_NAME'])
@@ -415,8 +832,11 @@ def update_output(p_selected_ledger_id, flex_from_dropdown, p_ldf):
         ])
         patched_children.append(new_element)
 
-        v_currency_code: str = df_ledgers[df_ledgers['LedgerId'] == p_selected_ledger_id].iloc[0]['CurrencyCode']
-    return patched_children, v_currency_code, False, False, False
+        v_currency_code: str = registry.ledger(p_selected_ledger_id)['CurrencyCode']
+    # Segment columns of Detail results available for Summary subtotals
+    subtotal_options: list = ledger_df['VALUE_SET_DESCRIPTION'].tolist()
+    # The snapshot of an offline start has nothing to refresh from
+    return patched_children, v_currency_code, False, False, False, offline_mode, subtotal_options
 
 
 # Define callback to update ledger_id storage and enable currency dropdown
@@ -448,22 +868,14 @@ def get_periods(ledger_store_data):
     if not ledger_store_data:
         raise PreventUpdate  # No update if ledger_store_data is empty or None
 
-    query = '''
-                SELECT ap.periodnameid AS period 
-                FROM accounting_periods ap
-                JOIN ledgers lg 
-                    ON (ap.periodsetnameid = lg.periodsetname AND ap.periodtype = lg.accountedperiodtype)
-                WHERE lg.ledgerid = ?
-                ORDER BY ap.periodyear DESC, ap.periodnumber DESC
-            '''
-    df_periods = execute_sql_query(query, [ledger_store_data])
+    df_periods: pd.DataFrame = registry.ledger_calendar(ledger_store_data)
 
     if df_periods.empty:
         return []  # Return empty list if no periods found
 
-    # Convert the DataFrame to a list of options
-    # Assuming 'period' is the column name after aliasing in the query
-    options = [{'label': row['period'], 'value': row['period']} for _, row in df_periods.iterrows()]
+    # Convert the DataFrame to a list of options, latest period first
+    df_periods = df_periods.sort_values(by=['PeriodYear', 'PeriodNumber'], ascending=False)
+    options = [{'label': period, 'value': period} for period in df_periods['PeriodNameId']]
     return options
 
 
@@ -506,7 +918,7 @@ def set_period_to_value(period_from):
 
 def get_flex_values(flex_table: str) -> list:
     """
-    Retrieves flex values from the specified table in DuckDB.
+    Retrieves flex values of the specified value set from the metadata registry.
 
     Parameters:
     - flex_table: The name of the flex table to query.
@@ -514,7 +926,7 @@ def get_flex_values(flex_table: str) -> list:
     Returns:
     - A list of dictionaries formatted for Dropdown options, e.g., [{'label': 'FlexValue1', 'value': 'FlexValue1'}, ...]
     """
-    val_df = execute_sql_query(f'SELECT VALUE, DESCRIPTION FROM {flex_table}')
+    val_df: pd.DataFrame = registry.value_set(flex_table)
 
     if val_df.empty:
         return []  # Return empty list if no flex values found
@@ -50,6 +50,7 @@ def construct_params(p_combination: str, p_accounting_period: str, p_currency: s
     finder_params_str_updated = ','.join(f"{key}={value}" for key, value in finder_params.items())
     finder_str_updated = f"{finder_name};{finder_params_str_updated}"
 
-    # Step 5: Update the original dictionary
-    balances_query_params['finder'] = finder_str_updated
-    return balances_query_params
+    # Step 5: Return a copy of the original dictionary, concurrent pulls must not share it
+    query_params: dict = dict(balances_query_params)
+    query_params['finder'] = finder_str_updated
+    return query_params
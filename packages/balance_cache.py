@@ -0,0 +1,470 @@
+import hashlib
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional, Union
+
+import duckdb
+import pandas as pd
+
+from packages.config import duckdb_db_path, offline_mode
+from packages.db_connection import DuckDBConnection
+from packages.duck_select import execute_sql_query, quote_identifier
+from packages.enrichment import description_column
+from packages.metadata_registry import registry
+from packages.spill import SpilledResult, align_columns
+
+logger = logging.getLogger(__name__)
+
+cache_catalog_table = 'balance_cache'
+request_log_table = 'balance_requests'
+balance_key_table = 'dim_balance_key'
+key_columns: list = ['LedgerName', 'Currency', 'CurrencyType', 'AmountType', 'PeriodName']
+# Dimension ids come from sequences, stores of a process still run one at a time to keep the dimensions free of
+# duplicate keys (a multi-worker deployment has one writer)
+_store_lock: threading.Lock = threading.Lock()
+_selection_locks: dict = {}
+_selection_locks_guard: threading.Lock = threading.Lock()
+
+
+def normalize_selection(p_values: list, p_ids: list) -> dict:
+    """
+    Maps the flex dropdown selections to a stable {segment: [values]} dictionary.
+
+    Parameters:
+    - p_values (list): Values of the flex dynamic dropdowns.
+    - p_ids (list): Ids of the flex dynamic dropdowns.
+
+    Returns:
+    - dict: Sorted values per segment, ['%'] for segments without a selection.
+    """
+    selection: dict = {}
+    for dropdown_id, value in zip(p_ids or [], p_values or []):
+        if value is None or not value or '%' in value:
+            selection[dropdown_id['index']] = ['%']
+        elif isinstance(value, str):
+            selection[dropdown_id['index']] = [value]
+        else:
+            selection[dropdown_id['index']] = sorted(value)
+    return selection
+
+
+def request_signature(p_ledger_id, p_values, p_ids, p_balance_type, p_from_currency, p_currency) -> str:
+    """
+    Builds the key of the Detail balances of a selection. Periods are not part of the key, every period
+    of the selection is cached separately. The flex mode is not part of the key either,
+    Summary views are derived from the Detail rows stored under the same signature.
+
+    Returns:
+    - str: Hex digest identifying the selection.
+    """
+    payload: dict = {
+        'ledger_id': p_ledger_id,
+        'selection': normalize_selection(p_values, p_ids),
+        'balance_type': p_balance_type,
+        'from_currency': p_from_currency if p_balance_type == 'From' else None,
+        'currency': p_currency,
+    }
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+def selection_lock(signature: str) -> threading.RLock:
+    """
+    Lock of a selection signature. Pulls of the same selection hold it, so a second pull waits for the first
+    one and is served from what it cached, instead of sharing its staging and fact tables. Reentrant, so a
+    refresh can hold it around the pull it diffs.
+    """
+    with _selection_locks_guard:
+        return _selection_locks.setdefault(signature, threading.RLock())
+
+
+def cache_table_name(signature: str) -> str:
+    """
+    View presenting the cached Detail balances of the signature with their strings rebuilt from the dimensions.
+    """
+    return f'bal_{signature}'
+
+
+def fact_table_name(signature: str) -> str:
+    return f'fact_{signature}'
+
+
+def combination_table_name(p_ledger_id) -> str:
+    return f'dim_combination_{int(p_ledger_id)}'
+
+
+def combination_columns(p_ledger_id) -> list:
+    """
+    String attributes of an account combination, kept once per combination in the combination dimension
+    of the ledger: the combinations, the account name, the split segments and their descriptions.
+    """
+    segments: list = registry.ledger_segments(p_ledger_id)['VALUE_SET_DESCRIPTION'].tolist()
+    return (['AccountCombination', 'DetailAccountCombination', 'AccountName']
+            + segments + [description_column(segment) for segment in segments])
+
+
+def _ensure_catalog(conn: duckdb.DuckDBPyConnection):
+    # Catalogs written before the balances were split into facts and dimensions are dropped with their tables
+    catalog_columns: set = {column_name for (column_name,) in conn.execute(
+        "SELECT column_name FROM duckdb_columns() WHERE table_name = ?", [cache_catalog_table]).fetchall()}
+    if catalog_columns and 'fact_table' not in catalog_columns:
+        for (table_name,) in conn.execute(
+                "SELECT table_name FROM duckdb_tables() WHERE starts_with(table_name, 'bal_')").fetchall():
+            conn.execute(f"DROP TABLE {table_name}")
+        conn.execute(f"DROP TABLE {cache_catalog_table}")
+        catalog_columns = set()
+    definition: str = """(
+            signature VARCHAR,
+            table_name VARCHAR,
+            fact_table VARCHAR,
+            ledger_id BIGINT,
+            period_name VARCHAR,
+            row_count BIGINT,
+            cached_at TIMESTAMP,
+            PRIMARY KEY (signature, period_name)
+        )"""
+    if not catalog_columns:
+        conn.execute(f"CREATE TABLE {cache_catalog_table} {definition}")
+    elif conn.execute("SELECT count(*) FROM duckdb_constraints() WHERE table_name = ? "
+                      "AND constraint_type = 'PRIMARY KEY'", [cache_catalog_table]).fetchone()[0] == 0:
+        # Imported from a snapshot bundle, which keeps the rows only, store_detail_balances upserts by the key
+        conn.execute(f"CREATE TABLE {cache_catalog_table}_constrained {definition}")
+        conn.execute(f"INSERT INTO {cache_catalog_table}_constrained BY NAME SELECT * FROM {cache_catalog_table}")
+        conn.execute(f"DROP TABLE {cache_catalog_table}")
+        conn.execute(f"ALTER TABLE {cache_catalog_table}_constrained RENAME TO {cache_catalog_table}")
+        logger.info(f"Rebuilt {cache_catalog_table} with its primary key")
+    _ensure_dimension(conn, balance_key_table, 'key_id', {column: 'VARCHAR' for column in key_columns})
+
+
+def _ensure_dimension(conn: duckdb.DuckDBPyConnection, table_name: str, id_column: str, columns: dict,
+                      unique_column: Optional[str] = None):
+    """
+    Creates a dimension table whose id is its primary key, drawn from the sequence seq_<table name without dim_>,
+    and unique_column, if any, unique. A dimension created before it had these constraints is rebuilt with
+    its rows and ids, the sequence continues after its largest id.
+
+    Parameters:
+    - table_name (str): Dimension table.
+    - id_column (str): INTEGER id column.
+    - columns (dict): {column: type} of the other columns of a new table.
+    - unique_column (str): Natural key column, e.g. DetailAccountCombination.
+    """
+    sequence: str = f"seq_{table_name.removeprefix('dim_')}"
+    existing: dict = dict(conn.execute("SELECT column_name, data_type FROM duckdb_columns() WHERE table_name = ? "
+                                       "ORDER BY column_index", [table_name]).fetchall())
+    if conn.execute("SELECT count(*) FROM duckdb_sequences() WHERE sequence_name = ?", [sequence]).fetchone()[0] == 0:
+        next_id: int = (conn.execute(f"SELECT coalesce(max({id_column}), 0) + 1 FROM {table_name}").fetchone()[0]
+                        if existing else 1)
+        conn.execute(f"CREATE SEQUENCE {sequence} START WITH {next_id}")
+    if existing and conn.execute("SELECT count(*) FROM duckdb_constraints() WHERE table_name = ? "
+                                 "AND constraint_type = 'PRIMARY KEY'", [table_name]).fetchone()[0] > 0:
+        return
+    definitions: list = [f"{id_column} INTEGER PRIMARY KEY DEFAULT nextval('{sequence}')"] + [
+        f"{quote_identifier(column)} {data_type}{' UNIQUE' if column == unique_column else ''}"
+        for column, data_type in (existing or columns).items() if column != id_column]
+    if not existing:
+        conn.execute(f"CREATE TABLE {table_name} ({', '.join(definitions)})")
+        return
+    conn.execute(f"CREATE TABLE {table_name}_constrained ({', '.join(definitions)})")
+    conn.execute(f"INSERT INTO {table_name}_constrained BY NAME SELECT * FROM {table_name}")
+    conn.execute(f"DROP TABLE {table_name}")
+    conn.execute(f"ALTER TABLE {table_name}_constrained RENAME TO {table_name}")
+    logger.info(f"Rebuilt dimension {table_name} with a primary key drawn from {sequence}")
+
+
+def _store_dimensions(conn: duckdb.DuckDBPyConnection, source: str, source_columns: list, p_ledger_id) -> list:
+    """
+    Adds the balance keys and account combinations of the source rows that are not in the dimensions yet
+    and refreshes the attributes of the known combinations, account names and descriptions can change.
+
+    Returns:
+    - list: Combination attribute columns of the source.
+    """
+    key_select: str = ', '.join(f"CAST({column} AS VARCHAR) AS {column}" if column in source_columns
+                                else f"NULL::VARCHAR AS {column}" for column in key_columns)
+    key_match: str = ' AND '.join(f"k.{column} IS NOT DISTINCT FROM s.{column}" for column in key_columns)
+    conn.execute(f"""
+        INSERT INTO {balance_key_table} ({', '.join(key_columns)})
+        SELECT s.*
+        FROM (SELECT DISTINCT {key_select} FROM {source}) s
+        WHERE NOT EXISTS (SELECT 1 FROM {balance_key_table} k WHERE {key_match})
+    """)
+
+    combination_table: str = combination_table_name(p_ledger_id)
+    attributes: list = [column for column in combination_columns(p_ledger_id) if column in source_columns]
+    attribute_source: str = (f"(SELECT DISTINCT ON (DetailAccountCombination) "
+                             f"{', '.join(quote_identifier(column) for column in attributes)} FROM {source})")
+    _ensure_dimension(conn, combination_table, 'combination_id', {'DetailAccountCombination': 'VARCHAR'},
+                      'DetailAccountCombination')
+    align_columns(conn, combination_table, attribute_source)
+    conn.execute(f"""
+        INSERT INTO {combination_table} BY NAME
+        SELECT s.*
+        FROM {attribute_source} s
+        WHERE s.DetailAccountCombination NOT IN (SELECT DetailAccountCombination FROM {combination_table})
+    """)
+    refreshed: list = [f"{quote_identifier(column)} = s.{quote_identifier(column)}"
+                       for column in attributes if column != 'DetailAccountCombination']
+    if refreshed:
+        conn.execute(f"UPDATE {combination_table} d SET {', '.join(refreshed)} FROM {attribute_source} s "
+                     f"WHERE d.DetailAccountCombination = s.DetailAccountCombination")
+    return attributes
+
+
+def _store_facts(conn: duckdb.DuckDBPyConnection, source: str, source_columns: list, attributes: list,
+                 fact_table: str, p_ledger_id):
+    """
+    Appends the source rows to the fact table as (key_id, combination_id) plus the columns that are
+    not dimension attributes, in source order.
+    """
+    measures: list = [column for column in source_columns if column not in attributes and column not in key_columns]
+    key_match: str = ' AND '.join(f"k.{column} IS NOT DISTINCT FROM CAST(s.{column} AS VARCHAR)"
+                                  if column in source_columns else f"k.{column} IS NULL" for column in key_columns)
+    fact_source: str = f"""(
+        SELECT k.key_id, d.combination_id{''.join(f', s.{quote_identifier(column)}' for column in measures)}
+        FROM (SELECT row_number() OVER () AS source_pos, * FROM {source}) s
+        JOIN {balance_key_table} k ON {key_match}
+        JOIN {combination_table_name(p_ledger_id)} d ON d.DetailAccountCombination = s.DetailAccountCombination
+        ORDER BY s.source_pos
+    )"""
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {fact_table} AS SELECT * FROM {fact_source} LIMIT 0")
+    align_columns(conn, fact_table, fact_source)
+    conn.execute(f"INSERT INTO {fact_table} BY NAME SELECT * FROM {fact_source}")
+
+
+def _create_view(conn: duckdb.DuckDBPyConnection, signature: str, source_columns: list, p_ledger_id):
+    """
+    (Re)creates the presentation view of the signature, the only place where the fact rows are joined
+    back to their strings. Columns keep the order of the last stored rows, columns of earlier rows follow.
+    """
+    fact_table: str = fact_table_name(signature)
+    combination_table: str = combination_table_name(p_ledger_id)
+    table_columns: dict = {}
+    for table_name, column_name in conn.execute(
+            "SELECT table_name, column_name FROM duckdb_columns() WHERE list_contains(?, table_name) "
+            "ORDER BY column_index", [[fact_table, combination_table]]).fetchall():
+        if column_name not in ('key_id', 'combination_id'):
+            table_columns.setdefault(column_name, 'f' if table_name == fact_table else 'd')
+    for column in key_columns:
+        table_columns[column] = 'k'
+    columns: list = ([column for column in source_columns if column in table_columns]
+                     + [column for column in table_columns if column not in source_columns])
+    conn.execute(f"""
+        CREATE OR REPLACE VIEW {cache_table_name(signature)} AS
+        SELECT {', '.join(f'{table_columns[column]}.{quote_identifier(column)}' for column in columns)},
+               f.rowid AS row_pos
+        FROM {fact_table} f
+        JOIN {balance_key_table} k ON k.key_id = f.key_id
+        JOIN {combination_table} d ON d.combination_id = f.combination_id
+    """)
+
+
+def store_detail_balances(df: Union[pd.DataFrame, SpilledResult], signature: str, p_ledger_id, p_periods: list):
+    """
+    Persists Detail balances in DuckDB, replacing the rows of p_periods, and registers
+    every period in the cache catalog. Periods without rows are registered as well.
+
+    The rows are stored dictionary encoded: the ledger, currency, type and period strings go to the
+    balance key dimension, the combination strings, account name and segments to the combination
+    dimension of the ledger, and the fact table of the signature holds their integer ids and the amounts.
+
+    Parameters:
+    - df (pd.DataFrame | SpilledResult): Detail balances as returned by prepare_df.
+    - signature (str): Selection signature, see request_signature.
+    - p_ledger_id: Ledger of the pull.
+    - p_periods (list): Periods the pull covered.
+
+    Raises:
+    - duckdb.Error: The rows could not be stored, e.g. a dimension constraint was violated. Nothing is stored.
+    """
+    fact_table: str = fact_table_name(signature)
+    with _store_lock, DuckDBConnection(Path.cwd() / duckdb_db_path) as conn:
+        conn.execute("BEGIN TRANSACTION")
+        try:
+            _ensure_catalog(conn)
+            if conn.execute("SELECT count(*) FROM duckdb_tables() WHERE table_name = ?",
+                            [fact_table]).fetchone()[0] > 0:
+                conn.execute(f"DELETE FROM {fact_table} WHERE key_id IN "
+                             f"(SELECT key_id FROM {balance_key_table} WHERE list_contains(?, PeriodName))",
+                             [p_periods])
+            if isinstance(df, SpilledResult):
+                source: str = df.table_name
+            else:
+                source: str = 'temp_df'
+                conn.register('temp_df', df)
+            row_counts: dict = {}
+            if not df.empty:
+                source_columns: list = [column_name for column_name, *_ in
+                                        conn.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()]
+                attributes: list = _store_dimensions(conn, source, source_columns, p_ledger_id)
+                _store_facts(conn, source, source_columns, attributes, fact_table, p_ledger_id)
+                _create_view(conn, signature, source_columns, p_ledger_id)
+                row_counts = dict(conn.execute(f"SELECT PeriodName, count(*) FROM {source} GROUP BY PeriodName")
+                                  .fetchall())
+            if source == 'temp_df':
+                conn.unregister('temp_df')
+            cached_at: datetime = datetime.now()
+            # Replaced rather than deleted and inserted again, DuckDB rejects a key deleted in the same transaction
+            conn.executemany(f"INSERT OR REPLACE INTO {cache_catalog_table} VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             [[signature, cache_table_name(signature), fact_table, p_ledger_id, period,
+                               int(row_counts.get(period, 0)), cached_at] for period in p_periods])
+            conn.execute("COMMIT")
+        except duckdb.Error as e:
+            conn.execute("ROLLBACK")
+            logger.error(f"Failed to cache balances in '{fact_table}': {e}")
+            raise
+    logger.info(f"Cached {sum(row_counts.values())} balances of {len(p_periods)} periods in '{fact_table}'")
+
+
+def cached_periods(signature: str, p_max_age: Optional[float] = None) -> set:
+    """
+    Returns the periods cached for the signature.
+
+    Parameters:
+    - signature (str): Selection signature.
+    - p_max_age (float): Only periods cached less than p_max_age seconds ago, all periods if None.
+    """
+    if execute_sql_query("SELECT table_name FROM duckdb_columns() WHERE table_name = ? AND column_name = 'fact_table'",
+                         [cache_catalog_table]).empty:
+        return set()
+    query: str = f"SELECT period_name FROM {cache_catalog_table} WHERE signature = ?"
+    parameters: list = [signature]
+    if p_max_age is not None:
+        query += " AND cached_at >= ?"
+        parameters.append(datetime.now() - timedelta(seconds=p_max_age))
+    return set(execute_sql_query(query, parameters)['period_name'].tolist())
+
+
+def has_detail_balances(signature: str, p_periods: list, p_max_age: Optional[float] = None) -> bool:
+    """
+    Checks whether the Detail balances of all p_periods are cached for the signature.
+    """
+    return bool(p_periods) and set(p_periods) <= cached_periods(signature, p_max_age)
+
+
+def cached_as_of(signature: str, p_periods: list) -> Optional[datetime]:
+    """
+    Returns when the oldest of the cached Detail balances of p_periods was pulled, None if none is cached.
+    """
+    if not cached_periods(signature):
+        return None
+    as_of_df: pd.DataFrame = execute_sql_query(
+        f"SELECT min(cached_at) AS cached_at FROM {cache_catalog_table} "
+        f"WHERE signature = ? AND list_contains(?, period_name)", [signature, p_periods])
+    if as_of_df.empty or pd.isna(as_of_df['cached_at'].iloc[0]):
+        return None
+    return as_of_df['cached_at'].iloc[0].to_pydatetime()
+
+
+def cached_row_count(signature: str, p_periods: list) -> int:
+    """
+    Returns the number of Detail rows cached for the signature in p_periods.
+    """
+    counts_df: pd.DataFrame = execute_sql_query(
+        f"SELECT coalesce(sum(row_count), 0) AS row_count FROM {cache_catalog_table} "
+        f"WHERE signature = ? AND list_contains(?, period_name)", [signature, p_periods])
+    return int(counts_df['row_count'].iloc[0]) if not counts_df.empty else 0
+
+
+def period_source(signature: str) -> str:
+    """
+    SQL source of the cached Detail balances restricted to the periods passed as the first two parameters
+    (the period list, twice), with period_pos and row_pos columns keeping the pulled order.
+    """
+    return (f"(SELECT *, list_position(?, PeriodName) AS period_pos "
+            f"FROM {cache_table_name(signature)} WHERE list_contains(?, PeriodName))")
+
+
+def load_detail_balances(signature: str, p_periods: list) -> pd.DataFrame:
+    """
+    Reads the cached Detail balances of p_periods back into a DataFrame, in period order.
+    """
+    if execute_sql_query("SELECT table_name FROM duckdb_tables() WHERE table_name = ?",
+                         [fact_table_name(signature)]).empty:
+        return pd.DataFrame()
+    return execute_sql_query(
+        f"SELECT * EXCLUDE (period_pos, row_pos) FROM {period_source(signature)} ORDER BY period_pos, row_pos",
+        [p_periods, p_periods])
+
+
+def detail_row_keys(df: pd.DataFrame) -> list:
+    """
+    Columns identifying a Detail balance row: the balance keys (ledger, currency, type, period)
+    and DetailAccountCombination.
+    """
+    return [column for column in key_columns + ['DetailAccountCombination'] if column in df.columns]
+
+
+def detail_changes(p_old: pd.DataFrame, p_new: pd.DataFrame) -> dict:
+    """
+    Compares two pulls of the Detail balances of the same periods by period and DetailAccountCombination.
+
+    Parameters:
+    - p_old (pd.DataFrame): Rows stored before the pull.
+    - p_new (pd.DataFrame): Rows of the pull.
+
+    Returns:
+    - dict: {'add': rows only in p_new, 'update': rows of p_new with other values than in p_old,
+      'remove': rows only in p_old}, DataFrames with the columns of p_new.
+    """
+    if p_old.empty or p_new.empty:
+        return {'add': p_new, 'update': p_new.iloc[0:0], 'remove': p_old}
+    keys: list = detail_row_keys(p_new)
+    old: pd.DataFrame = p_old.set_index(keys)
+    new: pd.DataFrame = p_new.set_index(keys)
+    old = old[~old.index.duplicated(keep='last')].reindex(columns=new.columns)
+    kept: pd.Index = new.index.intersection(old.index)
+    old_kept: pd.DataFrame = old.loc[kept]
+    new_kept: pd.DataFrame = new.loc[kept]
+    changed: pd.Series = ~((old_kept == new_kept) | (old_kept.isna() & new_kept.isna())).all(axis=1)
+    return {'add': new[~new.index.isin(old.index)].reset_index()[p_new.columns],
+            'update': new_kept[changed].reset_index()[p_new.columns],
+            'remove': old[~old.index.isin(new.index)].reset_index()[p_new.columns]}
+
+
+def log_request(signature: str, p_params: dict):
+    """
+    Records an interactive balances request, the cache warmer learns the frequently used selections from it.
+
+    Parameters:
+    - signature (str): Selection signature of the request.
+    - p_params (dict): prepare_df keyword arguments of the request.
+    """
+    if offline_mode:
+        # Nothing is warmed from a snapshot bundle, the request history is only kept online
+        return
+    try:
+        with DuckDBConnection(Path.cwd() / duckdb_db_path) as conn:
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {request_log_table} (
+                    signature VARCHAR,
+                    ledger_id BIGINT,
+                    params VARCHAR,
+                    requested_at TIMESTAMP
+                )
+            """)
+            conn.execute(f"INSERT INTO {request_log_table} VALUES (?, ?, ?, ?)",
+                         [signature, p_params['p_ledger_id'], json.dumps(p_params, default=str), datetime.now()])
+    except duckdb.Error as e:
+        logger.error(f"Failed to log balances request: {e}")
+
+
+def frequent_requests(p_ledger_id, p_limit: int, p_days: int) -> list:
+    """
+    Returns the prepare_df keyword arguments of the most frequently requested selections of the ledger
+    during the last p_days days, most frequent first.
+    """
+    if execute_sql_query("SELECT table_name FROM duckdb_tables() WHERE table_name = ?",
+                         [request_log_table]).empty:
+        return []
+    df: pd.DataFrame = execute_sql_query(f"""
+        SELECT signature, count(*) AS requests, arg_max(params, requested_at) AS params
+        FROM {request_log_table}
+        WHERE ledger_id = ? AND requested_at >= ?
+        GROUP BY signature
+        ORDER BY requests DESC
+        LIMIT ?
+    """, [p_ledger_id, datetime.now() - timedelta(days=p_days), p_limit])
+    return [json.loads(params) for params in df['params']]
@@ -0,0 +1,106 @@
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+import pandas as pd
+
+from packages.balance_cache import frequent_requests
+from packages.config import (warm_enabled, warm_ledgers, warm_top_requests, warm_history_days, warm_interval,
+                             warm_off_peak_hours, warm_close_days, warm_close_interval)
+from packages.metadata_registry import registry
+from packages.prepare_df import prepare_df
+from packages.rate_limit import background_priority
+from packages.replica import is_reader, publish_replica
+
+logger = logging.getLogger(__name__)
+
+_warmer_thread: Optional[threading.Thread] = None
+
+
+def open_periods(p_ledger_id, p_today: datetime) -> tuple:
+    """
+    Returns the (prior, current) period names of the ledger calendar for the given day.
+    The current period is the one containing the day, or the last one started before it.
+
+    Returns:
+    - tuple: (prior period, current period), (None, None) if the calendar has no period started yet.
+    """
+    calendar: pd.DataFrame = registry.ledger_calendar(p_ledger_id)
+    start_dates = pd.to_datetime(calendar['StartDate'])
+    started: pd.DataFrame = calendar[start_dates <= pd.Timestamp(p_today.date())]
+    if started.empty:
+        return None, None
+    current_pos: int = len(started) - 1
+    prior_pos: int = max(current_pos - 1, 0)
+    return calendar['PeriodNameId'].iloc[prior_pos], calendar['PeriodNameId'].iloc[current_pos]
+
+
+def in_off_peak_hours(p_now: datetime) -> bool:
+    """
+    Checks the hour against WARM_OFF_PEAK_HOURS, e.g. '20-6' is 20:00 to 05:59.
+    """
+    start, end = (int(hour) for hour in warm_off_peak_hours.split('-'))
+    if start <= end:
+        return start <= p_now.hour < end
+    return p_now.hour >= start or p_now.hour < end
+
+
+def warm_cadence(p_now: datetime) -> Optional[float]:
+    """
+    Seconds between warm runs at the given time, None if no warming should happen now.
+    During the first WARM_CLOSE_DAYS days of the month (period close) the cache is refreshed
+    every WARM_CLOSE_INTERVAL seconds at any hour, otherwise every WARM_INTERVAL seconds off-peak only.
+    """
+    if p_now.day <= warm_close_days:
+        return warm_close_interval
+    if in_off_peak_hours(p_now):
+        return warm_interval
+    return None
+
+
+def warm_once():
+    """
+    Re-pulls the Detail balances of the current and prior period for the most frequently
+    requested selections of each warmed ledger. The requests are sent with background priority,
+    see packages.rate_limit.
+    """
+    ledger_ids: list = warm_ledgers or registry.get_ledgers()['LedgerId'].tolist()
+    for ledger_id in ledger_ids:
+        prior_period, current_period = open_periods(ledger_id, datetime.now())
+        if current_period is None:
+            continue
+        for params in frequent_requests(ledger_id, warm_top_requests, warm_history_days):
+            params.update(p_period_from=prior_period, p_period_to=current_period,
+                          p_flex_mode='Detail', p_subtotals=None, p_max_age=0)
+            try:
+                with background_priority():
+                    prepare_df(**params)
+                logger.info(f"Warmed balances of ledger {ledger_id} for {prior_period} - {current_period}")
+            except Exception as e:
+                logger.error(f"Cache warming failed for ledger {ledger_id}: {e}")
+    publish_replica()
+
+
+def _warm_loop():
+    last_run: float = 0.0
+    while True:
+        cadence: Optional[float] = warm_cadence(datetime.now())
+        if cadence is not None and time.monotonic() - last_run >= cadence:
+            last_run = time.monotonic()
+            warm_once()
+        time.sleep(60)
+
+
+def start_cache_warmer():
+    """
+    Starts the cache warmer thread if WARM_ENABLED is set, once per process. In a multi-worker deployment
+    only the writer process warms.
+    """
+    global _warmer_thread
+    if not warm_enabled or is_reader() or _warmer_thread is not None:
+        return
+    _warmer_thread = threading.Thread(target=_warm_loop, name='glwalker-cache-warmer', daemon=True)
+    _warmer_thread.start()
+    logger.info("Cache warmer started")
@@ -2,17 +2,74 @@ import pandas as pd
 
 from packages.load_env_vars import get_env_variable, load_environment_variables
 from packages.persist_metadata import load_lg_list_to_dataframe
+from packages.snapshot import restore_snapshot
 
 # Loads environment variables from a .env file
 load_environment_variables()
 
-base_api_url: str = get_env_variable('BASE_API_URL')
-username: str = get_env_variable('ORACLE_FUSION_USERNAME')
-password: str = get_env_variable('ORACLE_FUSION_PASSWORD')
+# Snapshot bundle to run from offline, see packages/snapshot.py. The Fusion API is never called then.
+offline_snapshot: str = get_env_variable('OFFLINE_SNAPSHOT', required=False)
+offline_mode: bool = bool(offline_snapshot)
+snapshot_dir: str = get_env_variable('SNAPSHOT_DIR', required=False) or '.snapshots'
+
+base_api_url: str = get_env_variable('BASE_API_URL', required=not offline_mode) or ''
+username: str = get_env_variable('ORACLE_FUSION_USERNAME', required=not offline_mode)
+password: str = get_env_variable('ORACLE_FUSION_PASSWORD', required=not offline_mode)
 verify_ssl = get_env_variable('VERIFY_SSL', required=False)
 duckdb_db_path: str = get_env_variable('DUCKDB_DB_PATH', required=False) or 'ledgers.duckdb'
+# Background jobs running the balance pulls
+jobs_cache_dir: str = get_env_variable('JOBS_CACHE_DIR', required=False) or '.jobs_cache'
+job_workers: int = int(get_env_variable('JOB_WORKERS', required=False) or 4)
+# API calls of one pull running in parallel and fetched pages waiting to be stored, see packages/pipeline.py
+pull_workers: int = int(get_env_variable('PULL_WORKERS', required=False) or 4)
+pull_queue_depth: int = int(get_env_variable('PULL_QUEUE_DEPTH', required=False) or 8)
+# Multi-worker deployment, see packages/replica.py: the web workers read replicas of the database published
+# by the single writer process (python -m packages.writer), which runs all pulls and metadata loads
+multi_worker: bool = ((get_env_variable('MULTI_WORKER', required=False) or 'false').lower() == 'true'
+                      and not offline_mode)
+replica_dir: str = get_env_variable('REPLICA_DIR', required=False) or '.replicas'
+replica_wait: float = float(get_env_variable('REPLICA_WAIT', required=False) or 60)
+# Seconds between two replica copies, the jobs finishing meanwhile are published by one copy
+replica_publish_interval: float = float(get_env_variable('REPLICA_PUBLISH_INTERVAL', required=False) or 2)
+# Seconds a web worker waits for a job of the writer process it needs the result of, e.g. a metadata load
+job_wait_timeout: float = float(get_env_variable('JOB_WAIT_TIMEOUT', required=False) or 600)
+# Encoding of the rows sent to the AG Grid table (columns or records), see packages/transport.py,
+# and compression of the responses of the Dash server
+grid_transport: str = (get_env_variable('GRID_TRANSPORT', required=False) or 'columns').lower()
+response_compression: bool = (get_env_variable('RESPONSE_COMPRESSION', required=False) or 'true').lower() == 'true'
+# Pages of the metadata endpoints kept for conditional requests
+http_cache_dir: str = get_env_variable('HTTP_CACHE_DIR', required=False) or '.http_cache'
+# Fusion API requests per second shared by all pulls of the process (0 = unlimited, the default), in a multi-worker
+# deployment only the writer process calls the API, so it is the limit of the deployment.
+# background_rate_share is the part of a configured limit the cache warmer may use
+api_rate_limit: float = float(get_env_variable('API_RATE_LIMIT', required=False) or 0)
+background_rate_share: float = float(get_env_variable('WARM_RATE_SHARE', required=False) or 0.3)
+# Seconds cached Detail balances are served without pulling them again
+balance_cache_ttl: float = float(get_env_variable('BALANCE_CACHE_TTL', required=False) or 1800)
+# Memory budgets in MB, results above them are kept in DuckDB spill tables instead of DataFrames
+request_memory_budget: int = int(get_env_variable('REQUEST_MEMORY_BUDGET_MB', required=False) or 256) * 1024 * 1024
+process_memory_budget: int = int(get_env_variable('PROCESS_MEMORY_BUDGET_MB', required=False) or 2048) * 1024 * 1024
+# Seconds the completed pages of a failed or cancelled pull are kept for resuming it
+extraction_resume_ttl: float = float(get_env_variable('EXTRACTION_RESUME_TTL', required=False) or 3600)
+# Cache warmer, see packages/cache_warmer.py
+warm_enabled: bool = ((get_env_variable('WARM_ENABLED', required=False) or 'false').lower() == 'true'
+                      and not offline_mode)
+warm_ledgers: list = [int(ledger_id) for ledger_id in
+                      (get_env_variable('WARM_LEDGERS', required=False) or '').split(',') if ledger_id.strip()]
+warm_top_requests: int = int(get_env_variable('WARM_TOP_REQUESTS', required=False) or 5)
+warm_history_days: int = int(get_env_variable('WARM_HISTORY_DAYS', required=False) or 14)
+warm_interval: float = float(get_env_variable('WARM_INTERVAL', required=False) or 3600)
+warm_off_peak_hours: str = get_env_variable('WARM_OFF_PEAK_HOURS', required=False) or '20-6'
+warm_close_days: int = int(get_env_variable('WARM_CLOSE_DAYS', required=False) or 5)
+warm_close_interval: float = float(get_env_variable('WARM_CLOSE_INTERVAL', required=False) or 900)
+# Results of metadata queries kept in memory until the metadata tables change, see packages/duck_select.py
+metadata_query_cache_size: int = int(get_env_variable('METADATA_QUERY_CACHE_SIZE', required=False) or 256)
+# Seconds between checks of lg_list.json and the DuckDB metadata tables for changes
+metadata_check_interval: float = float(get_env_variable('METADATA_CHECK_INTERVAL', required=False) or 5)
 
 # Load json with ledgers definitions
 l_file_path: str = 'lg_list.json'  # Replace with your file path if different
+if offline_mode:
+    duckdb_db_path, l_file_path = restore_snapshot(offline_snapshot, snapshot_dir)
 ldf: pd.DataFrame = load_lg_list_to_dataframe(l_file_path)
 ldf: pd.DataFrame = ldf.sort_values(by=['ledger_id', 'SEGMENT_NUMBER'], inplace=False)
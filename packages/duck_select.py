@@ -1,20 +1,31 @@
 # main.py
+import json
 import logging
 import sys
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from packages.db_connection import DuckDBConnection
+from typing import Optional
+from packages.persist_metadata import catalog_version_table, catalog_writes
+from packages.replica import read_connection, is_reader, current_replica
 sys.path.append(str(Path(__file__).parent))
 import duckdb
 import pandas as pd
-from config import duckdb_db_path, ldf
+from config import duckdb_db_path, ldf, metadata_query_cache_size
 
 logger = logging.getLogger(__name__)
 
+_query_cache: OrderedDict = OrderedDict()  # (sql, parameters) -> DataFrame, least recently used first
+_query_cache_lock: threading.Lock = threading.Lock()
+_query_cache_version: Optional[int] = None
+_catalog_state: tuple = (None, None)  # (database state, catalog version read in that state)
+
 
 def execute_sql_query(sql_query: str, parameters: list = None) -> pd.DataFrame:
     df = pd.DataFrame()
     try:
-        with DuckDBConnection(Path.cwd() / duckdb_db_path) as conn:
+        # A replica of the database in a web worker of a multi-worker deployment, see packages.replica
+        with read_connection() as conn:
             df = conn.execute(sql_query, parameters).fetchdf()
     except duckdb.Error as e:
         logger.error(f"Error executing DuckDB query: {str(e)}")
@@ -24,3 +35,80 @@ def execute_sql_query(sql_query: str, parameters: list = None) -> pd.DataFrame:
         return df
     logger.info(f"Query executed successfully: {sql_query}")
     return df
+
+
+def _file_state(p_path: Path) -> Optional[tuple]:
+    try:
+        stat = p_path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _database_state() -> tuple:
+    # Changes with every write that may change the catalog version, without querying DuckDB: the replica
+    # read by a web worker, otherwise the metadata writes of this process and the files of ledgers.duckdb,
+    # which the writes of other processes change too. Reads leave the files as they are.
+    if is_reader():
+        return (current_replica(),)
+    db_file: Path = Path.cwd() / duckdb_db_path
+    return catalog_writes(), _file_state(db_file), _file_state(db_file.with_name(f'{db_file.name}.wal'))
+
+
+def catalog_version() -> Optional[int]:
+    """
+    Version of the metadata tables, incremented by every metadata write, see
+    packages.persist_metadata.bump_catalog_version, None before the first one. It is read from DuckDB again
+    only after something was written to the database, e.g. a balances pull, otherwise only the database
+    files are checked.
+    """
+    global _catalog_state
+    state: tuple = _database_state()
+    known_state, version = _catalog_state
+    if known_state == state:
+        return version
+    version = None
+    if not execute_sql_query("SELECT table_name FROM duckdb_tables() WHERE table_name = ?",
+                             [catalog_version_table]).empty:
+        version_df: pd.DataFrame = execute_sql_query(f"SELECT max(version) AS version FROM {catalog_version_table}")
+        if not version_df.empty and not pd.isna(version_df['version'].iloc[0]):
+            version = int(version_df['version'].iloc[0])
+    _catalog_state = (state, version)
+    return version
+
+
+def cached_sql_query(sql_query: str, parameters: list = None) -> pd.DataFrame:
+    """
+    Memoized execute_sql_query for queries of the metadata tables written by save_dataframe_to_duckdb
+    (ledgers, periods, currencies and value sets). Results are kept by SQL and parameters, at most
+    METADATA_QUERY_CACHE_SIZE of them with the least recently used dropped first, and all of them are dropped
+    when the catalog version changes, see catalog_version. Empty results are not kept, execute_sql_query
+    returns them on errors too. Callers get a copy they may modify.
+    """
+    global _query_cache_version
+    key: tuple = (sql_query, json.dumps(parameters, default=str))
+    version: Optional[int] = catalog_version()
+    with _query_cache_lock:
+        if _query_cache_version != version:
+            _query_cache.clear()
+            _query_cache_version = version
+        df: Optional[pd.DataFrame] = _query_cache.get(key)
+        if df is not None:
+            _query_cache.move_to_end(key)
+            return df.copy()
+    df = execute_sql_query(sql_query, parameters)
+    # Not kept if the metadata changed while the query ran
+    current: Optional[int] = catalog_version()
+    with _query_cache_lock:
+        if not df.empty and version == _query_cache_version == current:
+            _query_cache[key] = df
+            while len(_query_cache) > metadata_query_cache_size:
+                _query_cache.popitem(last=False)
+    return df.copy()
+
+
+def quote_identifier(name: str) -> str:
+    """
+    Quotes a column or table name for use in DuckDB SQL, e.g. split segment columns like 'COST CENTER'.
+    """
+    return '"' + str(name).replace('"', '""') + '"'
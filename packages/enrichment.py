@@ -0,0 +1,124 @@
+import logging
+from typing import Union
+
+import duckdb
+import numpy as np
+import pandas as pd
+
+from packages.duck_select import quote_identifier
+from packages.metadata_registry import registry
+from packages.spill import SpilledResult, spill_query, drop_spilled
+
+logger = logging.getLogger(__name__)
+
+description_suffix = '_DESCRIPTION'
+_memory_db: duckdb.DuckDBPyConnection = duckdb.connect()
+
+
+def description_column(column_name: str) -> str:
+    return f'{column_name}{description_suffix}'
+
+
+def join_descriptions(df: pd.DataFrame, p_segments: list) -> pd.DataFrame:
+    """
+    Adds a description column right after every segment column. The segment columns are dictionary encoded,
+    one DuckDB query joins the distinct codes of all segments against their value sets and the descriptions
+    are spread back to the rows with numpy, so the cost barely grows with the number of rows.
+
+    Parameters:
+    - df (pd.DataFrame): Rows with split segment columns.
+    - p_segments (list): (segment column, value set DataFrame with Value and Description) pairs.
+
+    Returns:
+    - pd.DataFrame: df with the description columns, in the original row order.
+    """
+    segments: list = [(column_name, values_df) for column_name, values_df in p_segments
+                      if column_name in df.columns and description_column(column_name) not in df.columns]
+    if df.empty or not segments:
+        return df
+    codes: dict = {}
+    code_frames: list = []
+    value_set_frames: list = []
+    for segment, (column_name, values_df) in enumerate(segments):
+        row_codes, uniques = pd.factorize(df[column_name])
+        codes[column_name] = (segment, row_codes, len(uniques))
+        if values_df is None or values_df.empty:
+            continue
+        code_frames.append(pd.DataFrame({'segment': segment, 'code': np.arange(len(uniques)),
+                                         'Value': pd.Series(uniques, dtype=object).astype(str)}))
+        value_set_frames.append(pd.DataFrame({'segment': segment, 'Value': values_df['Value'].astype(str),
+                                              'Description': values_df['Description'],
+                                              'pos': np.arange(len(values_df))}))
+    described_df: pd.DataFrame = pd.DataFrame(columns=['segment', 'code', 'Description'])
+    if code_frames:
+        # A cursor is a separate connection to the shared in-memory database, safe to use from any thread
+        with _memory_db.cursor() as conn:
+            conn.register('codes', pd.concat(code_frames, ignore_index=True))
+            conn.register('value_sets', pd.concat(value_set_frames, ignore_index=True))
+            # The first description of a value in value set order, so duplicate values never multiply rows
+            described_df = conn.execute("""
+                SELECT c.segment, c.code, arg_min(v.Description, v.pos) AS Description
+                FROM codes c JOIN value_sets v ON c.segment = v.segment AND c.Value = v.Value
+                GROUP BY c.segment, c.code
+            """).df()
+    columns: dict = {}
+    for column_name in df.columns:
+        columns[column_name] = df[column_name]
+        if column_name in codes:
+            segment, row_codes, unique_count = codes[column_name]
+            # The extra last slot stays None, it is what the code -1 of missing segment values picks
+            descriptions: np.ndarray = np.full(unique_count + 1, None, dtype=object)
+            segment_df: pd.DataFrame = described_df[described_df['segment'] == segment]
+            descriptions[segment_df['code'].to_numpy(dtype=np.int64)] = segment_df['Description'].to_numpy()
+            columns[description_column(column_name)] = descriptions[row_codes]
+    return pd.DataFrame(columns, index=df.index)
+
+
+def join_spilled_descriptions(result: SpilledResult, p_segments: list) -> SpilledResult:
+    """
+    Adds a description column right after every segment column of a spilled result. The rows are copied
+    inside DuckDB to a new spill table, left joined to the value sets, and the original table is dropped.
+
+    Parameters:
+    - result (SpilledResult): Rows with split segment columns.
+    - p_segments (list): (segment column, value set SQL source with Value and Description) pairs,
+      see MetadataRegistry.value_set_source.
+
+    Returns:
+    - SpilledResult: The rows with the description columns, in the original row order.
+    """
+    segments: dict = {column_name: source for column_name, source in p_segments
+                      if column_name in result.columns and description_column(column_name) not in result.columns}
+    if result.empty or not segments:
+        return result
+    select: list = []
+    joins: list = []
+    for column_name in result.columns:
+        select.append(f"s.{quote_identifier(column_name)}")
+        if column_name in segments:
+            alias: str = f"v{len(joins)}"
+            select.append(f"{alias}.Description AS {quote_identifier(description_column(column_name))}")
+            joins.append(f"LEFT JOIN {segments[column_name]} {alias} "
+                         f"ON {alias}.Value = CAST(s.{quote_identifier(column_name)} AS VARCHAR)")
+    described: SpilledResult = spill_query(f"SELECT {', '.join(select)} FROM {result.table_name} s "
+                                           f"{' '.join(joins)} ORDER BY s.rowid")
+    drop_spilled(result.table_name)
+    return described
+
+
+def enrich_segment_descriptions(df: Union[pd.DataFrame, SpilledResult],
+                                p_ledger_id) -> Union[pd.DataFrame, SpilledResult]:
+    """
+    Adds the descriptions of the split segment columns of Detail balances. The value set of every
+    segment column is the VALUE_SET_NAME of the segment in lg_list.json, see join_descriptions,
+    spilled results are joined in DuckDB, see join_spilled_descriptions.
+    """
+    if df.empty:
+        return df
+    ledger_segments: pd.DataFrame = registry.ledger_segments(p_ledger_id)
+    segment_value_sets: list = list(zip(ledger_segments['VALUE_SET_DESCRIPTION'], ledger_segments['VALUE_SET_NAME']))
+    if isinstance(df, SpilledResult):
+        return join_spilled_descriptions(df, [(column_name, registry.value_set_source(value_set_name))
+                                              for column_name, value_set_name in segment_value_sets])
+    return join_descriptions(df, [(column_name, registry.value_set(value_set_name))
+                                  for column_name, value_set_name in segment_value_sets])
@@ -0,0 +1,246 @@
+import hashlib
+import json
+import logging
+import threading
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional, Union
+
+import duckdb
+import pandas as pd
+
+from packages.config import duckdb_db_path, offline_mode
+from packages.db_connection import DuckDBConnection
+from packages.duck_select import execute_sql_query
+from packages.replica import is_reader
+from packages.snapshot import OfflineModeError
+from packages.spill import SpilledResult, MemoryBudget, align_columns, estimate_bytes, spill_query
+
+logger = logging.getLogger(__name__)
+
+units_table = 'extraction_units'
+staging_catalog_table = 'extraction_staging'
+unit_columns: list = ['_period_pos', '_combination_pos', '_page_offset']
+# Held while creating the units tables and while claiming a staging table: DuckDB fails concurrent creates of the
+# same table, CREATE TABLE IF NOT EXISTS included, and concurrent claims of the same extraction with a write-write
+# conflict. Only the process writing ledgers.duckdb runs pulls, see packages.replica.
+_units_lock: threading.RLock = threading.RLock()
+
+
+class StagingTakenOver(RuntimeError):
+    """
+    Raised by a pull whose staging table was claimed by another pull of the same extraction.
+    """
+
+
+def extraction_id(signature: str, p_fetch_mode: str, p_periods: list, p_segment_values: list) -> str:
+    """
+    Identifies the units of a pull. Pulling the same selection, mode, periods and combinations again
+    gives the same id, so the pull resumes from the units already completed. The combinations are
+    given by the values of every segment they are generated from, see prepare_df.combination_axes.
+    """
+    payload: list = [signature, p_fetch_mode, p_periods, p_segment_values]
+    return hashlib.sha1(json.dumps(payload).encode('utf-8')).hexdigest()[:16]
+
+
+def _ensure_units_table(conn: duckdb.DuckDBPyConnection):
+    """
+    Creates the units and staging catalog tables, one thread of the process at a time, see _units_lock.
+    """
+    with _units_lock:
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {units_table} (
+                extraction_id VARCHAR,
+                period_name VARCHAR,
+                combination VARCHAR,
+                page_offset BIGINT,
+                has_more BOOLEAN,
+                row_count BIGINT,
+                completed_at TIMESTAMP,
+                PRIMARY KEY (extraction_id, period_name, combination, page_offset)
+            )
+        """)
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {staging_catalog_table} (
+                extraction_id VARCHAR PRIMARY KEY,
+                staging_table VARCHAR,
+                claimed_at TIMESTAMP
+            )
+        """)
+
+
+def _check_writable(extraction: str):
+    # Pages are only staged for API calls, which neither an offline start nor a web worker makes, see fetch_api_pages
+    if offline_mode:
+        raise OfflineModeError(f"Running from a snapshot bundle, extraction {extraction} is not staged")
+    if is_reader():
+        raise RuntimeError(f"Web workers of a multi-worker deployment queue pulls for the writer process: "
+                           f"extraction {extraction}")
+
+
+def _staging_owner(conn: duckdb.DuckDBPyConnection, extraction: str) -> Optional[str]:
+    owner: Optional[tuple] = conn.execute(
+        f"SELECT staging_table FROM {staging_catalog_table} WHERE extraction_id = ?", [extraction]).fetchone()
+    return owner[0] if owner else None
+
+
+def _table_exists(conn: duckdb.DuckDBPyConnection, table_name: str) -> bool:
+    return conn.execute("SELECT count(*) FROM duckdb_tables() WHERE table_name = ?", [table_name]).fetchone()[0] > 0
+
+
+def claim_extraction(extraction: str, p_max_age: float) -> str:
+    """
+    Returns a new staging table of its own for a pull of the extraction. The rows staged by an earlier attempt
+    of the same pull are taken over by renaming its staging table, unless one of its pages is older than
+    p_max_age seconds, then the pull starts over. Pulls of the same extraction never append to the same
+    table: a pull whose staging table was claimed by another one fails, see checkpoint_pages. The claims of
+    the process run one at a time, see _units_lock.
+
+    Raises:
+    - OfflineModeError: Running from a snapshot bundle, nothing is pulled.
+    """
+    _check_writable(extraction)
+    staging: str = f'ext_{extraction}_{uuid.uuid4().hex[:8]}'
+    with _units_lock, DuckDBConnection(Path.cwd() / duckdb_db_path) as conn:
+        _ensure_units_table(conn)
+        conn.execute("BEGIN TRANSACTION")
+        try:
+            previous: Optional[str] = _staging_owner(conn, extraction)
+            oldest: Optional[datetime] = conn.execute(
+                f"SELECT min(completed_at) FROM {units_table} WHERE extraction_id = ?", [extraction]).fetchone()[0]
+            resumed: bool = (oldest is not None and previous is not None and _table_exists(conn, previous)
+                             and oldest >= datetime.now() - timedelta(seconds=p_max_age))
+            if resumed:
+                conn.execute(f"ALTER TABLE {previous} RENAME TO {staging}")
+            else:
+                if oldest is not None:
+                    logger.info(f"Completed units of extraction {extraction} expired, pulling again")
+                conn.execute(f"DELETE FROM {units_table} WHERE extraction_id = ?", [extraction])
+                # Staging tables were named after the extraction only before they were claimed per pull
+                conn.execute(f"DROP TABLE IF EXISTS {previous or f'ext_{extraction}'}")
+            conn.execute(f"INSERT OR REPLACE INTO {staging_catalog_table} VALUES (?, ?, ?)",
+                         [extraction, staging, datetime.now()])
+            conn.execute("COMMIT")
+        except duckdb.Error:
+            conn.execute("ROLLBACK")
+            raise
+    return staging
+
+
+def completed_units(extraction: str) -> dict:
+    """
+    Returns the last completed page of every (period, combination) of the pull, see claim_extraction.
+
+    Returns:
+    - dict: {(period, combination): (page offset, has_more)}
+    """
+    if execute_sql_query("SELECT table_name FROM duckdb_tables() WHERE table_name = ?", [units_table]).empty:
+        return {}
+    units_df: pd.DataFrame = execute_sql_query(f"""
+        SELECT period_name, combination, max(page_offset) AS page_offset,
+               arg_max(has_more, page_offset) AS has_more
+        FROM {units_table}
+        WHERE extraction_id = ?
+        GROUP BY period_name, combination
+    """, [extraction])
+    return {(row['period_name'], row['combination']): (int(row['page_offset']), bool(row['has_more']))
+            for row in units_df.to_dict('records')}
+
+
+def checkpoint_pages(extraction: str, staging: str, p_pages: list):
+    """
+    Stores the rows of completed (period, combination, offset) pages and marks the pages completed,
+    in one transaction and one append of all their rows. Rows of a page stored before are replaced,
+    so fetching a page again never duplicates its rows.
+
+    Parameters:
+    - extraction (str): Id of the pull, see extraction_id.
+    - staging (str): Staging table of the pull, see claim_extraction.
+    - p_pages (list): (period position, period, combination position, combination, offset, has_more, rows)
+      of every page. The positions keep the pulled row order, has_more is whether the API reported
+      more pages after the page and rows is a DataFrame of the rows of the page.
+
+    Raises:
+    - StagingTakenOver: Another pull of the extraction claimed the staging table.
+    - OfflineModeError: Running from a snapshot bundle, nothing is pulled.
+    """
+    _check_writable(extraction)
+    table_name: str = staging
+    with DuckDBConnection(Path.cwd() / duckdb_db_path) as conn:
+        _ensure_units_table(conn)
+        conn.execute("BEGIN TRANSACTION")
+        try:
+            if _staging_owner(conn, extraction) != staging:
+                raise StagingTakenOver(f"Extraction {extraction} was taken over by another pull of the selection")
+            staged_frames: list = [df.assign(_period_pos=period_pos, _combination_pos=combination_pos,
+                                             _page_offset=offset)
+                                   for period_pos, _, combination_pos, _, offset, _, df in p_pages if not df.empty]
+            if staged_frames:
+                staged_df: pd.DataFrame = (staged_frames[0] if len(staged_frames) == 1
+                                           else pd.concat(staged_frames, ignore_index=True))
+                conn.register('temp_df', staged_df)
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {table_name} AS SELECT * FROM temp_df LIMIT 0")
+                align_columns(conn, table_name, 'temp_df')
+                conn.execute(f"""
+                    DELETE FROM {table_name} USING (SELECT DISTINCT {', '.join(unit_columns)} FROM temp_df) pages
+                    WHERE {' AND '.join(f'{table_name}.{column} = pages.{column}' for column in unit_columns)}
+                """)
+                conn.execute(f"INSERT INTO {table_name} BY NAME SELECT * FROM temp_df")
+                conn.unregister('temp_df')
+            conn.executemany(f"INSERT OR REPLACE INTO {units_table} VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             [[extraction, period, combination, offset, has_more, len(df), datetime.now()]
+                              for _, period, _, combination, offset, has_more, df in p_pages])
+            conn.execute("COMMIT")
+        except (duckdb.Error, StagingTakenOver):
+            conn.execute("ROLLBACK")
+            raise
+
+
+def staged_row_count(extraction: str) -> int:
+    if execute_sql_query("SELECT table_name FROM duckdb_tables() WHERE table_name = ?", [units_table]).empty:
+        return 0
+    counts_df: pd.DataFrame = execute_sql_query(
+        f"SELECT coalesce(sum(row_count), 0) AS row_count FROM {units_table} WHERE extraction_id = ?", [extraction])
+    return int(counts_df['row_count'].iloc[0])
+
+
+def staged_source(staging: str) -> str:
+    """
+    SQL of the staged rows of the pull in pulled order, without the unit columns.
+    """
+    return f"SELECT * EXCLUDE ({', '.join(unit_columns)}) FROM {staging} ORDER BY {', '.join(unit_columns)}, rowid"
+
+
+def staged_fits_budget(extraction: str, staging: str) -> bool:
+    """
+    Checks whether the staged rows of the pull can be loaded within the memory budget.
+    """
+    return MemoryBudget().fits(estimate_bytes(staged_source(staging), None, staged_row_count(extraction)))
+
+
+def load_staged(extraction: str, staging: str) -> Union[pd.DataFrame, SpilledResult]:
+    """
+    Returns the staged rows of the pull as a DataFrame, or as a SpilledResult when they
+    do not fit the memory budget.
+    """
+    if execute_sql_query("SELECT table_name FROM duckdb_tables() WHERE table_name = ?", [staging]).empty:
+        return pd.DataFrame()
+    if staged_fits_budget(extraction, staging):
+        return execute_sql_query(staged_source(staging))
+    return spill_query(staged_source(staging))
+
+
+def finish_extraction(extraction: str, staging: str):
+    """
+    Drops the staged rows and, unless another pull of the extraction claimed them, the completed units of a pull.
+    """
+    try:
+        with DuckDBConnection(Path.cwd() / duckdb_db_path) as conn:
+            _ensure_units_table(conn)
+            conn.execute(f"DROP TABLE IF EXISTS {staging}")
+            if _staging_owner(conn, extraction) == staging:
+                conn.execute(f"DELETE FROM {units_table} WHERE extraction_id = ?", [extraction])
+                conn.execute(f"DELETE FROM {staging_catalog_table} WHERE extraction_id = ?", [extraction])
+    except duckdb.Error as e:
+        logger.error(f"Failed to drop the staged rows of extraction {extraction}: {e}")
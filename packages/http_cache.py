@@ -0,0 +1,101 @@
+import hashlib
+import json
+import logging
+from typing import Optional
+from urllib.parse import urlparse
+
+import diskcache
+import pandas as pd
+import requests
+
+from packages.config import http_cache_dir
+
+logger = logging.getLogger(__name__)
+
+
+class HttpCache:
+    """
+    On-disk cache of API pages for conditional requests. Pages are stored with their ETag and Last-Modified
+    per URL, query parameters (including offset and limit) and user. A request for a stored page sends
+    If-None-Match/If-Modified-Since and a 304 response reuses the stored page, so unchanged catalogs
+    only cost the response headers. Hits and misses are counted per endpoint in the cache as well.
+    """
+
+    def __init__(self, directory: str):
+        self.cache = diskcache.Cache(directory)
+
+    @staticmethod
+    def page_key(url: str, username: str, params: Optional[dict]) -> str:
+        payload: str = json.dumps([url, username, params or {}], sort_keys=True, default=str)
+        return 'page:' + hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def endpoint(url: str) -> str:
+        """
+        Endpoint of the URL for the statistics, the path after the REST API version.
+        """
+        path: str = urlparse(url).path
+        return path.split('/resources/', 1)[-1].split('/', 1)[-1] if '/resources/' in path else path
+
+    def conditional_headers(self, key: str) -> dict:
+        """
+        Returns the If-None-Match/If-Modified-Since headers of a stored page, empty if the page is not stored.
+        """
+        page: Optional[dict] = self.cache.get(key)
+        if not page:
+            return {}
+        headers: dict = {}
+        if page['etag']:
+            headers['If-None-Match'] = page['etag']
+        if page['last_modified']:
+            headers['If-Modified-Since'] = page['last_modified']
+        return headers
+
+    def reuse(self, key: str, url: str) -> Optional[dict]:
+        """
+        Returns the stored page after a 304 response. A page evicted meanwhile is requested again
+        and counted as a miss by store.
+        """
+        page: Optional[dict] = self.cache.get(key)
+        if page:
+            self._count(url, 'hits')
+        return page['data'] if page else None
+
+    def store(self, key: str, url: str, response: requests.Response, data: dict):
+        """
+        Stores a page with its validators and counts the request as a miss, pages without ETag or
+        Last-Modified are not stored.
+        """
+        self._count(url, 'misses')
+        etag: Optional[str] = response.headers.get('ETag')
+        last_modified: Optional[str] = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            self.cache.set(key, {'etag': etag, 'last_modified': last_modified, 'data': data})
+
+    def _count(self, url: str, counter: str):
+        self.cache.incr(f'stats:{self.endpoint(url)}:{counter}')
+
+    def stats(self) -> pd.DataFrame:
+        """
+        Returns requests, hits (304 responses served from the cache), misses and hit ratio per endpoint.
+        """
+        counts: dict = {}
+        for key in self.cache.iterkeys():
+            if isinstance(key, str) and key.startswith('stats:'):
+                endpoint, counter = key[len('stats:'):].rsplit(':', 1)
+                counts.setdefault(endpoint, {'hits': 0, 'misses': 0})[counter] = self.cache.get(key, 0)
+        stats_df: pd.DataFrame = pd.DataFrame(
+            [{'endpoint': endpoint, **endpoint_counts} for endpoint, endpoint_counts in sorted(counts.items())],
+            columns=['endpoint', 'hits', 'misses'])
+        stats_df['requests'] = stats_df['hits'] + stats_df['misses']
+        stats_df['hit_ratio'] = (stats_df['hits'] / stats_df['requests']).round(3)
+        return stats_df
+
+    def log_stats(self):
+        for row in self.stats().to_dict('records'):
+            logger.info(f"HTTP cache {row['endpoint']}: {row['hits']} hits, {row['misses']} misses "
+                        f"({row['hit_ratio']:.0%} of {row['requests']} requests)")
+
+
+# Metadata catalogs (LOVs and value sets), the balances are never served from this cache
+metadata_http_cache: HttpCache = HttpCache(http_cache_dir)
@@ -0,0 +1,220 @@
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Optional
+
+import diskcache
+import psutil
+
+from packages.config import jobs_cache_dir, job_workers
+from packages.replica import is_reader, publish_replica
+
+logger = logging.getLogger(__name__)
+
+# Job records live on disk, so a reloaded page (or another worker process) can find a running job by its id
+jobs_cache: diskcache.Cache = diskcache.Cache(jobs_cache_dir)
+executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=job_workers, thread_name_prefix='glwalker-job')
+# Jobs and small writes of the web workers of a multi-worker deployment, run by the writer process
+job_queue: diskcache.Deque = diskcache.Deque(directory=str(Path(jobs_cache_dir) / 'queue'))
+write_queue: diskcache.Deque = diskcache.Deque(directory=str(Path(jobs_cache_dir) / 'writes'))
+queue_poll_interval: float = 0.2  # seconds the writer process waits when both queues are empty
+# The writer process refreshes its heartbeat while it serves the queues, queued jobs of the web workers
+# are reported interrupted when it is older than writer_timeout seconds
+heartbeat_key: str = 'writer:heartbeat'
+heartbeat_interval: float = 1.0
+writer_timeout: float = 10.0
+
+job_ttl: int = 24 * 60 * 60  # seconds a finished job and its result are kept
+active_statuses: tuple = ('queued', 'running')
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when its cancellation was requested."""
+
+
+def _save_job(job: dict):
+    jobs_cache.set(f"job:{job['id']}", job, expire=job_ttl)
+
+
+def _update_job(job_id: str, **fields) -> dict:
+    with jobs_cache.transact():
+        job: dict = jobs_cache.get(f"job:{job_id}") or {'id': job_id}
+        job.update(fields)
+        _save_job(job)
+    return job
+
+
+def submit_job(p_target: str, p_func: Callable, p_kwargs: dict, p_stream: bool = False) -> str:
+    """
+    Queues p_func(**p_kwargs, p_progress=...) on the job pool. A web worker of a multi-worker deployment
+    queues it for the writer process instead, p_func and p_kwargs must be picklable then, see serve_queues.
+
+    Parameters:
+    - p_target (str): What the result is shown in, e.g. 'table' or 'pygwalker'.
+    - p_func (Callable): Function doing the work, it must accept a p_progress(done, total, rows) callback.
+    - p_kwargs (dict): Keyword arguments of p_func, kept in the job record.
+    - p_stream (bool): Also pass a p_on_chunk(df) callback and keep the partial results, see get_job_chunks.
+
+    Returns:
+    - str: Id of the job.
+    """
+    job_id: str = uuid.uuid4().hex
+    # A queued job of the writer process has no process until it runs
+    _save_job({'id': job_id, 'target': p_target, 'status': 'queued', 'done': 0, 'total': 0, 'rows': 0, 'chunks': 0,
+               'error': None, 'pid': None if is_reader() else os.getpid(), 'params': p_kwargs,
+               'submitted_at': datetime.now().isoformat()})
+    if is_reader():
+        job_queue.append((job_id, p_func, p_kwargs, p_stream))
+    else:
+        executor.submit(_run_job, job_id, p_func, p_kwargs, p_stream)
+    logger.info(f"Job {job_id} ({p_target}) submitted")
+    return job_id
+
+
+def _run_job(job_id: str, p_func: Callable, p_kwargs: dict, p_stream: bool):
+    def progress(p_done: int, p_total: int, p_rows: int):
+        _update_job(job_id, done=p_done, total=p_total, rows=p_rows)
+        if jobs_cache.get(f"cancel:{job_id}"):
+            raise JobCancelled(job_id)
+
+    def on_chunk(p_chunk):
+        with jobs_cache.transact():
+            chunk_no: int = jobs_cache.get(f"job:{job_id}")['chunks']
+            jobs_cache.set(f"chunk:{job_id}:{chunk_no}", p_chunk, expire=job_ttl)
+            _update_job(job_id, chunks=chunk_no + 1)
+
+    if (jobs_cache.get(f"job:{job_id}") or {}).get('status') not in active_statuses:
+        logger.info(f"Job {job_id} was given up before it started")
+        return
+    if jobs_cache.get(f"cancel:{job_id}"):
+        _update_job(job_id, status='cancelled')
+        return
+    _update_job(job_id, status='running', pid=os.getpid(), started_at=datetime.now().isoformat())
+    try:
+        if p_stream:
+            result = p_func(**p_kwargs, p_progress=progress, p_on_chunk=on_chunk)
+        else:
+            result = p_func(**p_kwargs, p_progress=progress)
+        jobs_cache.set(f"result:{job_id}", result, expire=job_ttl)
+        # The web workers read what the job stored, e.g. its spill table, only from the next replica
+        try:
+            publish_replica()
+        except Exception as e:
+            logger.error(f"Replica after job {job_id} not published, the web workers see its result "
+                         f"from the next one: {e}")
+        _update_job(job_id, status='done', finished_at=datetime.now().isoformat())
+        logger.info(f"Job {job_id} finished")
+    except JobCancelled:
+        _update_job(job_id, status='cancelled', finished_at=datetime.now().isoformat())
+        logger.info(f"Job {job_id} cancelled")
+    except Exception as e:
+        _update_job(job_id, status='failed', error=str(e), finished_at=datetime.now().isoformat())
+        logger.error(f"Job {job_id} failed: {e}")
+
+
+def writer_running() -> bool:
+    """
+    Whether the writer process of a multi-worker deployment is serving the queues, see serve_queues.
+    """
+    heartbeat: Optional[float] = jobs_cache.get(heartbeat_key)
+    return heartbeat is not None and time.time() - heartbeat < writer_timeout
+
+
+def get_job(job_id: str) -> Optional[dict]:
+    """
+    Returns the job record or None if the job is unknown or expired.
+    A queued or running job whose process is gone is reported as 'interrupted', as is a job queued for
+    the writer process while it is not running.
+    """
+    job: Optional[dict] = jobs_cache.get(f"job:{job_id}")
+    if job and job['status'] in active_statuses:
+        if job['pid'] is not None and not psutil.pid_exists(job['pid']):
+            job = _update_job(job_id, status='interrupted')
+        elif job['pid'] is None and not writer_running():
+            job = _update_job(job_id, status='interrupted', error="The writer process is not running")
+    return job
+
+
+def wait_for_job(job_id: str, p_timeout: float) -> dict:
+    """
+    Waits until the job is no longer queued or running. After p_timeout seconds the job is marked failed
+    and cancelled, a job still queued never starts then.
+
+    Returns:
+    - dict: The job record.
+    """
+    deadline: float = time.monotonic() + p_timeout
+    while True:
+        job: dict = get_job(job_id) or {'id': job_id, 'status': 'failed', 'error': "The job expired"}
+        if job['status'] not in active_statuses:
+            return job
+        if time.monotonic() > deadline:
+            cancel_job(job_id)
+            logger.error(f"Job {job_id} did not finish within {p_timeout:.0f}s")
+            return _update_job(job_id, status='failed', error=f"Not finished within {p_timeout:.0f}s",
+                               finished_at=datetime.now().isoformat())
+        time.sleep(0.5)
+
+
+def get_job_result(job_id: str):
+    """
+    Returns the result of a finished job.
+    """
+    return jobs_cache.get(f"result:{job_id}")
+
+
+def get_job_chunks(job_id: str, p_start: int, p_end: int) -> list:
+    """
+    Returns the partial results number p_start to p_end - 1 of a streaming job.
+    """
+    return [jobs_cache.get(f"chunk:{job_id}:{chunk_no}") for chunk_no in range(p_start, p_end)]
+
+
+def cancel_job(job_id: str):
+    """
+    Requests cancellation, the job stops at its next progress report.
+    """
+    jobs_cache.set(f"cancel:{job_id}", True, expire=job_ttl)
+    logger.info(f"Job {job_id} cancellation requested")
+
+
+def submit_write(p_func: Callable, *args):
+    """
+    Runs a small DuckDB write without a job record, e.g. the request log. A web worker of a multi-worker
+    deployment queues it for the writer process, whose replicas show it after its next publish.
+    """
+    if is_reader():
+        write_queue.append((p_func, args))
+    else:
+        p_func(*args)
+
+
+def serve_queues():
+    """
+    Runs the jobs and writes queued by the web workers, in the writer process. Never returns.
+    """
+    logger.info(f"Serving the job queue of {jobs_cache_dir} with {job_workers} workers")
+    heartbeat: float = 0.0
+    while True:
+        if time.monotonic() - heartbeat >= heartbeat_interval:
+            jobs_cache.set(heartbeat_key, time.time())
+            heartbeat = time.monotonic()
+        try:
+            p_func, args = write_queue.popleft()
+            try:
+                p_func(*args)
+            except Exception as e:
+                logger.error(f"Queued write {getattr(p_func, '__name__', p_func)} failed: {e}")
+            continue
+        except IndexError:
+            pass
+        try:
+            job_id, p_func, p_kwargs, p_stream = job_queue.popleft()
+        except IndexError:
+            time.sleep(queue_poll_interval)
+            continue
+        executor.submit(_run_job, job_id, p_func, p_kwargs, p_stream)
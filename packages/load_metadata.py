@@ -1,11 +1,15 @@
 import logging
+from typing import Callable
 
 import numpy as np
 import pandas as pd
 
 from packages.endpoints import segments_endpoint, segments_query_params, ledgers_endpoint, ledgers_query_params, \
     ledgers_table, periods_endpoint, periods_query_params, currencies_endpoint, currencies_query_params
+from packages.http_cache import metadata_http_cache
+from packages.metadata_registry import registry
 from packages.persist_metadata import construct_api_url, fetch_api_data, save_dataframe_to_duckdb
+from packages.replica import publish_replica
 
 logger = logging.getLogger(__name__)
 
@@ -21,7 +25,8 @@ def load_metadata(df: pd.DataFrame, base_api_url: str, username: str, password:
         segment_api_url: str = construct_api_url(base_api_url, segments_endpoint) + segment + '/child/values'
         # Fetch the ledger data
         segment_list: list[str] = fetch_api_data(segment_api_url, username, password,
-                                                 segments_query_params)  # , verify_ssl=verify_ssl)
+                                                 segments_query_params,  # verify_ssl=verify_ssl,
+                                                 http_cache=metadata_http_cache)
         if segment_list:
             # Load the items into a pandas DataFrame
             segment_df: pd.DataFrame = pd.DataFrame(segment_list)
@@ -33,7 +38,8 @@ def load_metadata(df: pd.DataFrame, base_api_url: str, username: str, password:
 
     # Fetch the ledger data
     ledgers_list: list[str] = fetch_api_data(ledgers_api_url, username, password,
-                                             ledgers_query_params)  # , verify_ssl=verify_ssl)
+                                             ledgers_query_params,  # verify_ssl=verify_ssl,
+                                             http_cache=metadata_http_cache)
 
     if ledgers_list:
         # Load the items into a pandas DataFrame
@@ -42,15 +48,31 @@ def load_metadata(df: pd.DataFrame, base_api_url: str, username: str, password:
         save_dataframe_to_duckdb(df, duckdb_db_path, table_name=ledgers_table, if_exists='replace')
         logger.info('Ledgers loaded into DuckDB')
     periods_api_url: str = construct_api_url(base_api_url, periods_endpoint)
-    periods_list: list[str] = fetch_api_data(periods_api_url, username, password, periods_query_params)
+    periods_list: list[str] = fetch_api_data(periods_api_url, username, password, periods_query_params,
+                                             http_cache=metadata_http_cache)
     if periods_list:
         df = pd.DataFrame(periods_list)
         save_dataframe_to_duckdb(df, duckdb_db_path, table_name='accounting_periods', if_exists='replace')
         logger.info('Accounting periods loaded into DuckDB')
     currencies_api_url: str = construct_api_url(base_api_url, currencies_endpoint)
-    currencies_list: list[str] = fetch_api_data(currencies_api_url, username, password, currencies_query_params)
+    currencies_list: list[str] = fetch_api_data(currencies_api_url, username, password, currencies_query_params,
+                                                http_cache=metadata_http_cache)
     if currencies_list:
         df: pd.DataFrame = pd.DataFrame(currencies_list)
         save_dataframe_to_duckdb(df, duckdb_db_path, table_name='currencies', if_exists='replace')
         logger.info('Currencies loaded into DuckDB')
+    registry.invalidate()
+    publish_replica()
+    metadata_http_cache.log_stats()
     logger.info('Metadata loaded into DuckDB')
+
+
+def reload_metadata(p_progress: Callable[[int, int, int], None] = None):
+    """
+    Loads the metadata of the registry's lg_list.json with the configured connection, the job the
+    Load/Refresh Valuesets button of a multi-worker deployment queues for the writer process.
+    """
+    # Imported here, packages.config is not needed by load_metadata itself
+    from packages.config import base_api_url, username, password, duckdb_db_path
+
+    load_metadata(registry.get_lg_list(), base_api_url, username, password, duckdb_db_path)
@@ -0,0 +1,186 @@
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+import pandas as pd
+
+from packages.config import l_file_path, metadata_check_interval
+from packages.duck_select import cached_sql_query, catalog_version
+from packages.persist_metadata import load_lg_list_to_dataframe
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataRegistry:
+    """
+    Server side copy of lg_list.json and the ledgers, periods, currencies and value sets loaded into DuckDB.
+    Callbacks pass a ledger_id and look everything else up here. The registry reloads itself when
+    lg_list.json or the catalog version in DuckDB change, checked at most every metadata_check_interval seconds.
+    Every metadata write increments the version, see packages.persist_metadata.bump_catalog_version, so
+    every process sees the writes of the others, in a multi-worker deployment from the next replica.
+    The metadata queries are memoized until the version changes, see packages.duck_select.cached_sql_query,
+    and the checks only query DuckDB after a write, so lookups of the callbacks do not touch the database.
+    """
+
+    def __init__(self, lg_list_path: str, check_interval: float):
+        self.lg_list_path = lg_list_path
+        self.check_interval = check_interval
+        self._lock = threading.RLock()
+        self._fingerprint: Optional[tuple] = None
+        self._checked_at: float = 0.0
+        self.lg_list: pd.DataFrame = pd.DataFrame()
+        self.ledgers: pd.DataFrame = pd.DataFrame()
+        self.currencies: pd.DataFrame = pd.DataFrame()
+        self._segments: dict = {}
+        self._ledgers_by_id: dict = {}
+        self._calendars: dict = {}
+        self._periods: pd.DataFrame = pd.DataFrame()
+        self._value_sets: dict = {}
+
+    def _catalog_fingerprint(self) -> tuple:
+        lg_list_mtime: float = os.path.getmtime(self.lg_list_path) if os.path.exists(self.lg_list_path) else 0.0
+        return lg_list_mtime, catalog_version()
+
+    def refresh(self, force: bool = False):
+        """
+        Reloads the metadata if it changed since the last load or if force is set.
+        """
+        with self._lock:
+            now: float = time.monotonic()
+            if not force and self._fingerprint is not None and now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+            fingerprint: tuple = self._catalog_fingerprint()
+            if not force and fingerprint == self._fingerprint:
+                return
+            self._load()
+            # Taken before the load, a write during the load is seen by the next check
+            self._fingerprint = fingerprint
+
+    def invalidate(self):
+        """
+        Forces a reload on the next lookup, e.g. after load_metadata.
+        """
+        with self._lock:
+            self._fingerprint = None
+
+    def _load(self):
+        lg_list: pd.DataFrame = load_lg_list_to_dataframe(self.lg_list_path)
+        lg_list = lg_list.sort_values(by=['ledger_id', 'SEGMENT_NUMBER'], inplace=False)
+        ledgers: pd.DataFrame = cached_sql_query(
+            "SELECT LedgerId, Name, CurrencyCode, AccountedPeriodType, PeriodSetName FROM ledgers")
+        if not ledgers.empty:
+            ledgers = ledgers[ledgers['LedgerId'].isin(lg_list['ledger_id'].unique())].reset_index(drop=True)
+        periods: pd.DataFrame = cached_sql_query(
+            "SELECT PeriodNameId, PeriodSetNameId, PeriodType, PeriodYear, PeriodNumber, StartDate, EndDate "
+            "FROM accounting_periods")
+        self.currencies = cached_sql_query("SELECT CurrencyCode, Name FROM currencies")
+        self.lg_list = lg_list
+        self.ledgers = ledgers
+        self._periods = periods
+        self._segments = {ledger_id: segments.reset_index(drop=True)
+                          for ledger_id, segments in lg_list.groupby('ledger_id')}
+        self._ledgers_by_id = {row['LedgerId']: row for row in ledgers.to_dict('records')}
+        self._calendars = {}
+        self._value_sets = {}
+        logger.info(f"Metadata registry loaded: {len(ledgers)} ledgers, {len(periods)} periods, "
+                    f"{len(self.currencies)} currencies")
+
+    def get_ledgers(self) -> pd.DataFrame:
+        self.refresh()
+        return self.ledgers
+
+    def get_currencies(self) -> pd.DataFrame:
+        self.refresh()
+        return self.currencies
+
+    def get_lg_list(self) -> pd.DataFrame:
+        self.refresh()
+        return self.lg_list
+
+    def ledger(self, ledger_id) -> dict:
+        """
+        Returns LedgerId, Name, CurrencyCode, AccountedPeriodType and PeriodSetName of the ledger.
+        """
+        self.refresh()
+        return self._ledgers_by_id[ledger_id]
+
+    def ledger_segments(self, ledger_id) -> pd.DataFrame:
+        """
+        Returns the lg_list.json rows of the ledger ordered by SEGMENT_NUMBER.
+        """
+        self.refresh()
+        return self._segments[ledger_id]
+
+    def segment_separator(self, ledger_id) -> str:
+        return self.ledger_segments(ledger_id)['SEGMENT_SEPARATOR'].iloc[0]
+
+    def ledger_calendar(self, ledger_id) -> pd.DataFrame:
+        """
+        Returns the accounting periods of the ledger's period set and period type ordered by StartDate.
+        """
+        self.refresh()
+        with self._lock:
+            calendar: Optional[pd.DataFrame] = self._calendars.get(ledger_id)
+            if calendar is None:
+                ledger: dict = self._ledgers_by_id[ledger_id]
+                periods: pd.DataFrame = self._periods
+                calendar = periods[(periods['PeriodSetNameId'] == ledger['PeriodSetName']) &
+                                   (periods['PeriodType'] == ledger['AccountedPeriodType'])]
+                calendar = calendar.sort_values(by=['StartDate', 'PeriodYear', 'PeriodNumber']).reset_index(drop=True)
+                self._calendars[ledger_id] = calendar
+            return calendar
+
+    def periods_between(self, ledger_id, period_from: str, period_to: str) -> list:
+        """
+        Returns the period names of the ledger from period_from to period_to in calendar order.
+        """
+        calendar: pd.DataFrame = self.ledger_calendar(ledger_id)
+        start_dates = calendar.loc[calendar['PeriodNameId'] == period_from, 'StartDate']
+        end_dates = calendar.loc[calendar['PeriodNameId'] == period_to, 'EndDate']
+        if start_dates.empty or end_dates.empty:
+            return []
+        in_range = calendar[(calendar['StartDate'] >= start_dates.iloc[0]) & (calendar['EndDate'] <= end_dates.iloc[0])]
+        return in_range['PeriodNameId'].tolist()
+
+    @staticmethod
+    def value_set_source(value_set_name: str) -> str:
+        """
+        SQL source of one Value and Description per value of the value set table loaded by load_metadata,
+        with the value_pos of the row in the table. A value with several date-effective rows gets the row
+        active today, then the enabled one, then the one starting last, then the first description.
+        """
+        columns: set = set(cached_sql_query("SELECT column_name FROM duckdb_columns() WHERE table_name = ?",
+                                            [value_set_name])['column_name'].tolist())
+        start_date: str = "TRY_CAST(CAST(StartDateActive AS VARCHAR) AS DATE)"
+        end_date: str = "TRY_CAST(CAST(EndDateActive AS VARCHAR) AS DATE)"
+        preference: list = []
+        if {'StartDateActive', 'EndDateActive'} <= columns:
+            preference.append(f"coalesce({start_date} <= current_date, true) "
+                              f"AND coalesce({end_date} >= current_date, true) DESC")
+        if 'EnabledFlag' in columns:
+            preference.append("coalesce(EnabledFlag = 'Y', false) DESC")
+        if 'StartDateActive' in columns:
+            preference.append(f"{start_date} DESC NULLS LAST")
+        preference += ["Description NULLS LAST", "rowid"]
+        return (f"(SELECT rowid AS value_pos, CAST(Value AS VARCHAR) AS Value, Description FROM {value_set_name} "
+                f"QUALIFY row_number() OVER (PARTITION BY Value ORDER BY {', '.join(preference)}) = 1)")
+
+    def value_set(self, value_set_name: str) -> pd.DataFrame:
+        """
+        Returns Value and Description of the value set table loaded by load_metadata in table order,
+        one row per value, see value_set_source.
+        """
+        self.refresh()
+        with self._lock:
+            values: Optional[pd.DataFrame] = self._value_sets.get(value_set_name)
+            if values is None:
+                values = cached_sql_query(f'SELECT Value, Description FROM {self.value_set_source(value_set_name)} '
+                                         f'ORDER BY value_pos')
+                self._value_sets[value_set_name] = values
+            return values
+
+
+registry: MetadataRegistry = MetadataRegistry(l_file_path, metadata_check_interval)
@@ -1,7 +1,7 @@
 import json
 import logging
 from pathlib import Path
-from typing import List
+from typing import Iterator, List, Optional, Tuple
 
 import pandas as pd
 import requests
@@ -9,8 +9,46 @@ from requests.auth import HTTPBasicAuth
 import duckdb
 import re
 
+from packages.snapshot import OfflineModeError
+
 logger = logging.getLogger(__name__)
 
+api_page_size: int = 500  # items per request of the paged Fusion REST endpoints
+# One row table incremented by every metadata write, the metadata registry of every process reloads when it
+# changes, see packages.metadata_registry. The replicas of a multi-worker deployment carry it along.
+catalog_version_table = 'catalog_version'
+# Metadata writes of this process, see packages.duck_select.catalog_version
+_catalog_writes: int = 0
+
+
+def bump_catalog_version(con: duckdb.DuckDBPyConnection, p_after: int = 0):
+    """
+    Marks the metadata tables as changed, on the connection that wrote them.
+
+    Parameters:
+    - con (duckdb.DuckDBPyConnection): Connection that wrote the metadata tables.
+    - p_after (int): Version the new one must be greater than as well, e.g. the one of the database before
+      a snapshot bundle replaced its catalog_version table, see read_catalog_version.
+    """
+    global _catalog_writes
+    con.execute(f"CREATE TABLE IF NOT EXISTS {catalog_version_table} AS SELECT 0::BIGINT AS version")
+    con.execute(f"UPDATE {catalog_version_table} SET version = greatest(version, ?) + 1", [p_after])
+    _catalog_writes += 1
+
+
+def read_catalog_version(con: duckdb.DuckDBPyConnection) -> int:
+    """
+    Returns the catalog version of the database of the connection, 0 before the first metadata write.
+    """
+    if con.execute("SELECT count(*) FROM duckdb_tables() WHERE table_name = ?",
+                   [catalog_version_table]).fetchone()[0] == 0:
+        return 0
+    return con.execute(f"SELECT coalesce(max(version), 0) FROM {catalog_version_table}").fetchone()[0]
+
+
+def catalog_writes() -> int:
+    return _catalog_writes
+
 
 def load_lg_list_to_dataframe(file_path: str) -> pd.DataFrame:
     """
@@ -23,6 +61,11 @@ def load_lg_list_to_dataframe(file_path: str) -> pd.DataFrame:
     - pd.DataFrame: DataFrame containing the ledger segments.
     """
     try:
+        if str(file_path).endswith('.parquet'):
+            # Already parsed into a snapshot bundle, see packages.snapshot
+            with duckdb.connect() as conn:
+                return conn.execute(f"SELECT * FROM read_parquet('{Path(file_path).as_posix()}')").df()
+
         # Step 1: Read the file content
         with open(file_path, 'r', encoding='utf-8') as file:
             content: str = file.read()
@@ -70,7 +113,7 @@ def construct_api_url(base_url: str, endpoint: str) -> str:
     return url
 
 
-def fetch_api_data(url: str, username: str, password: str, params=None, verify_ssl=True) -> list:
+def fetch_api_data(url: str, username: str, password: str, params=None, verify_ssl=True, http_cache=None) -> list:
     """
     Fetches data from the specified API URL using Basic Authentication.
 
@@ -80,6 +123,7 @@ def fetch_api_data(url: str, username: str, password: str, params=None, verify_s
     - password (str): Password for Basic Authentication.
     - params (dict): Query parameters as key-value pairs.
     - verify_ssl (bool): Whether to verify SSL certificates.
+    - http_cache (HttpCache): Cache for conditional requests, see packages.http_cache.
 
     Returns:
     - dict: Parsed JSON response from the API.
@@ -90,7 +134,34 @@ def fetch_api_data(url: str, username: str, password: str, params=None, verify_s
     - KeyError: If expected keys are missing in the response.
     """
     all_items: List[dict] = []
-    offset: int = 0
+    for _, items, _ in fetch_api_pages(url, username, password, params, verify_ssl=verify_ssl,
+                                       http_cache=http_cache):
+        all_items.extend(items)
+    logger.info(f"Total items fetched: {len(all_items)}")
+    return all_items
+
+
+def fetch_api_pages(url: str, username: str, password: str, params=None, start_offset: int = 0,
+                    verify_ssl=True, http_cache=None) -> Iterator[Tuple[int, list, bool]]:
+    """
+    Fetches the pages of the specified API URL one by one, starting at start_offset.
+    With http_cache, pages stored before are requested conditionally and reused on 304 Not Modified.
+    Raises like fetch_api_data.
+
+    Yields:
+    - tuple: (offset, items, has_more) of every page.
+    """
+    # Imported here, packages.config imports this module
+    from packages.config import offline_mode
+    from packages.rate_limit import api_rate_limiter
+    from packages.replica import is_reader
+
+    if offline_mode:
+        raise OfflineModeError(f"Running from a snapshot bundle, the Fusion API is not called: {url}")
+    if is_reader():
+        # The rate limiter is per process, the single writer process keeps the limit of the whole deployment
+        raise RuntimeError(f"Web workers of a multi-worker deployment queue API calls for the writer process: {url}")
+    offset: int = start_offset
 
     # Initialize params dictionary if None
     if params is None:
@@ -99,29 +170,30 @@ def fetch_api_data(url: str, username: str, password: str, params=None, verify_s
     while True:
         # Update offset in parameters
         params['offset'] = offset
-        params['limit'] = 500
+        params['limit'] = api_page_size
 
+        page_key: Optional[str] = http_cache.page_key(url, username, params) if http_cache else None
         try:
+            api_rate_limiter.acquire()
             response: requests.Response = requests.get(
                 url,
                 auth=HTTPBasicAuth(username, password),
                 params=params,
+                headers=http_cache.conditional_headers(page_key) if http_cache else None,
                 # verify=verify_ssl
             )
-            response.raise_for_status()
-
-            data: dict = response.json()
-
-            # Extract items from current response
-            if 'items' in data:
-                all_items.extend(data['items'])
-
-            # Check if there are more items to fetch
-            if not data.get('hasMore', False):
-                break
-
-            # Increment offset for next request
-            offset += 500
+            data: Optional[dict] = None
+            if response.status_code == 304:
+                data = http_cache.reuse(page_key, url)
+            if data is None:
+                if response.status_code == 304:  # stored page evicted meanwhile
+                    api_rate_limiter.acquire()
+                    response = requests.get(url, auth=HTTPBasicAuth(username, password), params=params)
+                response.raise_for_status()
+
+                data = response.json()
+                if http_cache:
+                    http_cache.store(page_key, url, response, data)
 
         except requests.exceptions.RequestException as e:
             logger.error(f"Error making request: {e}")
@@ -129,11 +201,15 @@ def fetch_api_data(url: str, username: str, password: str, params=None, verify_s
         except ValueError as e:
             logger.error(f"Error parsing JSON response: {e}")
             raise
-        except KeyError as e:
-            logger.error(f"Missing expected key in response: {e}")
-            raise
-    logger.info(f"Total items fetched: {len(all_items)}")
-    return all_items
+
+        # Check if there are more items to fetch
+        has_more: bool = data.get('hasMore', False)
+        yield offset, data.get('items', []), has_more
+        if not has_more:
+            break
+
+        # Increment offset for next request
+        offset += api_page_size
 
 
 def save_dataframe_to_duckdb(df: pd.DataFrame, db_path: str, table_name: str = 'ledgers', if_exists: str = 'replace'):
@@ -181,6 +257,7 @@ def save_dataframe_to_duckdb(df: pd.DataFrame, db_path: str, table_name: str = '
             raise ValueError("if_exists parameter must be one of 'fail', 'replace', or 'append'.")
 
         logger.info(f"Data successfully written to DuckDB table '{table_name}' in database '{db_path}'.")
+        bump_catalog_version(con)
 
         # Unregister the temporary DataFrame to clean up
         con.unregister('temp_df')
@@ -0,0 +1,101 @@
+import logging
+import queue
+import threading
+from contextlib import nullcontext
+from typing import Callable, Iterable, Iterator
+
+from packages.rate_limit import background_priority, is_background
+
+logger = logging.getLogger(__name__)
+
+_worker_done = object()
+_put_timeout: float = 0.1  # seconds between checks of the stop flag while the queue is full
+
+
+class _WorkerFailure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def fetch_pipeline(p_units: Iterable, p_fetch: Callable[[object], Iterator], p_workers: int,
+                   p_queue_depth: int) -> Iterator[list]:
+    """
+    Runs p_fetch(unit) for every unit on p_workers threads and hands the items it yields to the calling
+    thread through a queue of p_queue_depth items. The units are taken from p_units lazily, one whenever
+    a worker is free, and a worker waits while the queue is full, so at most p_queue_depth fetched items
+    are held whatever the size of the result: when the consumer falls behind, fetching pauses.
+    Items of one unit keep their order. The API requests of the workers have the priority of the
+    calling thread, see packages.rate_limit.
+
+    The first error of a worker is raised in the calling thread. Closing the generator, e.g. when the
+    consumer raises, stops the workers after their current request.
+
+    Parameters:
+    - p_units (Iterable): Units of work, e.g. (period, combination) calls, may be a generator.
+    - p_fetch (Callable): Returns an iterator of the items of a unit, called on the worker threads.
+    - p_workers (int): Number of worker threads.
+    - p_queue_depth (int): Fetched items waiting for the consumer at most.
+
+    Yields:
+    - list: The items available at that moment, at least one and at most p_queue_depth, so the
+      consumer can store them together.
+    """
+    units: Iterator = iter(p_units)
+    units_lock: threading.Lock = threading.Lock()
+    items: queue.Queue = queue.Queue(maxsize=max(p_queue_depth, 1))
+    stopped: threading.Event = threading.Event()
+    background: bool = is_background()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=_put_timeout)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def work():
+        try:
+            with background_priority() if background else nullcontext():
+                while not stopped.is_set():
+                    with units_lock:
+                        unit = next(units, _worker_done)
+                    if unit is _worker_done:
+                        break
+                    for item in p_fetch(unit):
+                        if not put(item):
+                            return
+        except BaseException as e:
+            put(_WorkerFailure(e))
+        finally:
+            put(_worker_done)
+
+    workers: list = [threading.Thread(target=work, name=f'{threading.current_thread().name}-fetch-{number}',
+                                      daemon=True) for number in range(max(p_workers, 1))]
+    for worker in workers:
+        worker.start()
+    running: int = len(workers)
+    try:
+        while running:
+            batch: list = []
+            item = items.get()
+            while True:
+                if item is _worker_done:
+                    running -= 1
+                elif isinstance(item, _WorkerFailure):
+                    raise item.error
+                else:
+                    batch.append(item)
+                if len(batch) >= p_queue_depth:
+                    break
+                try:
+                    item = items.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                yield batch
+    finally:
+        stopped.set()
+        for worker in workers:
+            worker.join()
@@ -1,19 +1,35 @@
 import itertools
 import logging
-from itertools import chain
+import math
+from contextlib import closing
+from typing import Callable, Iterator, Union
 import pandas as pd
 from packages.account_balances import construct_params
-from packages.config import base_api_url, username, password
-from packages.duck_select import execute_sql_query
+from packages.balance_cache import (request_signature, cached_periods, store_detail_balances, load_detail_balances,
+                                    cached_row_count, period_source, selection_lock, detail_changes)
+from packages.config import (base_api_url, username, password, balance_cache_ttl, extraction_resume_ttl, offline_mode,
+                             pull_workers, pull_queue_depth)
 from packages.endpoints import balances_endpoint
-from packages.persist_metadata import construct_api_url, fetch_api_data
+from packages.enrichment import enrich_segment_descriptions
+from packages.extraction import (extraction_id, claim_extraction, completed_units, checkpoint_pages, staged_row_count,
+                                 load_staged, staged_fits_budget, finish_extraction)
+from packages.metadata_registry import registry
+from packages.persist_metadata import construct_api_url, fetch_api_pages, api_page_size
+from packages.pipeline import fetch_pipeline
+from packages.rollups import summarize_detail_balances, subtotal_detail_balances, trend_detail_balances
+from packages.snapshot import OfflineModeError
+from packages.spill import MemoryBudget, SpilledResult, spill_query, estimate_bytes
 
 logger = logging.getLogger(__name__)
 
 
-def generate_combinations(values: list, ids: list, ledger_id: int, xldf: pd.DataFrame) -> list:
-    predefined_order: list = xldf[xldf['ledger_id'] == ledger_id]["VALUE_SET_NAME"].tolist()
-    # Define the predefined order of indices
+def combination_axes(values: list, ids: list, ledger_id: int) -> list:
+    """
+    Returns the selected values of every segment of the ledger in segment order, ['%'] for the segments
+    without a selection. The account combinations are their cartesian product, see generate_combinations.
+    """
+    ledger_segments: pd.DataFrame = registry.ledger_segments(ledger_id)
+    predefined_order: list = ledger_segments["VALUE_SET_NAME"].tolist()
     # Create a mapping from index to values
     index_to_values: dict = {}
     for dropdown_id, value in zip(ids, values):
@@ -22,87 +38,277 @@ def generate_combinations(values: list, ids: list, ledger_id: int, xldf: pd.Data
             index_to_values[index] = ['%']
         else:
             index_to_values[index] = value  # value is already a list
-    # Arrange values in the predefined order
-    positions_values = []
-    for index in predefined_order:
-        values_list = index_to_values.get(index, ['%'])  # Default to '%' if index not found
-        positions_values.append(values_list)
-    # Generate all combinations
-    combinations = list(itertools.product(*positions_values))
-    # Format combinations into strings
-    combinations_strings = ['.'.join(comb) for comb in combinations]
-    return combinations_strings
-
-
-def get_periods_list(p_ledger_id: str, p_period_from: str, p_period_to: str, p_df_ledgers: pd.DataFrame) -> list:
-    # Fetch ledger accountedperiodtype based on selected ID
-    # v_accountedperiodtype: str = df_ledgers[df_ledgers['LedgerId'] == p_ledger_id].iloc[0]['AccountedPeriodType']
-    v_accountedperiodtype: str = p_df_ledgers[p_df_ledgers['LedgerId'] == p_ledger_id].iloc[0]['AccountedPeriodType']
-
-    # load ledgers and currencies from db
-    query = """
-                    SELECT PeriodNameId 
-                    FROM accounting_periods
-                    WHERE StartDate >= (SELECT StartDate FROM accounting_periods WHERE PeriodNameId=?)
-                    AND EndDate <= (SELECT EndDate FROM accounting_periods WHERE PeriodNameId=?)
-                    AND PeriodType = ?
-                    ORDER BY StartDate
-                """
-    v_periods: list = execute_sql_query(query, [p_period_from, p_period_to, v_accountedperiodtype])['PeriodNameId'].tolist()
-
-    return v_periods
-
-
-
-def prepare_df(p_df_ledgers, p_ledger_id, p_values, p_ids, p_ldf, p_period_from, p_period_to, p_balance_type,
-               p_from_currency, p_currency, p_flex_mode) -> pd.DataFrame:
-    df: pd.DataFrame = pd.DataFrame()
-    all_balances = []
-    # Fetch ledger name based on selected ID
-    xdf_ledgers = pd.DataFrame(p_df_ledgers)
-    ledger_name: str = xdf_ledgers[xdf_ledgers['LedgerId'] == p_ledger_id].iloc[0]['Name']
-    # Generate ac flex combinations
-    combinations_strings = generate_combinations(p_values, p_ids, p_ledger_id, pd.DataFrame(p_ldf))
-    logger.info(combinations_strings)
-    # Fetch periods list
-    periods_list: list = get_periods_list(p_ledger_id, p_period_from, p_period_to, xdf_ledgers)
-    if p_balance_type == 'From':
-        balance_type = f'From {p_from_currency}'
-    else:
-        balance_type = p_balance_type
-    logger.info(balance_type)
-    for period in periods_list:
-        for combination in combinations_strings:
-            balances_api_url: str = construct_api_url(base_api_url, balances_endpoint)
-            balances_list: list = fetch_api_data(balances_api_url, username, password,
-                                                 construct_params(combination, period, p_currency,
-                                                                  ledger_name, p_flex_mode, balance_type))
-            all_balances.append(balances_list)
-    flattened_balances: list = list(chain.from_iterable(all_balances))
-    if all_balances and all_balances != [[]]:
-        df = pd.DataFrame(flattened_balances)
-        if p_flex_mode == 'Detail':
-            # Extract value_set_description ordered by segment_number for the specific ledger_id
-            xldf = pd.DataFrame(p_ldf)
-            column_names = xldf[xldf['ledger_id'] == p_ledger_id].sort_values(by='SEGMENT_NUMBER')[
-                'VALUE_SET_DESCRIPTION'].tolist()
-            split_columns = df['DetailAccountCombination'].str.split('.', expand=True)
-            # Assign the extracted column names
-            split_columns.columns = column_names
-            df = pd.concat([df, split_columns], axis=1)
-            # Now reorder the columns to put split columns right after DetailAccountCombination
-            # Get all column names
-            all_columns = df.columns.tolist()
-            # Remove the new columns from the list
-            for col in column_names:
-                all_columns.remove(col)
-            # Find the index of DetailAccountCombination
-            detail_acc_idx = all_columns.index('DetailAccountCombination')
-            # Create new column order
-            new_column_order = all_columns[:(detail_acc_idx + 1)] + column_names + all_columns[
-                                                                                   (detail_acc_idx + 1):]
-            # Reindex the dataframe with the new column order
-            df = df[new_column_order]
-            df[['PeriodActivity', 'BeginningBalance', 'EndingBalance']] = df[
-                ['PeriodActivity', 'BeginningBalance', 'EndingBalance']].apply(pd.to_numeric, errors='coerce')
+    # Arrange values in the predefined order, '%' if index not found
+    return [index_to_values.get(index, ['%']) for index in predefined_order]
+
+
+def combination_count(p_axes: list) -> int:
+    return math.prod(len(values_list) for values_list in p_axes)
+
+
+def generate_combinations(p_axes: list, ledger_id: int) -> Iterator[str]:
+    """
+    Yields the account combination strings of the segment values, one at a time, so a large selection
+    is never held as a list.
+    """
+    separator: str = registry.segment_separator(ledger_id)
+    for comb in itertools.product(*p_axes):
+        yield separator.join(comb)
+
+
+def get_periods_list(p_ledger_id, p_period_from: str, p_period_to: str) -> list:
+    """
+    Returns the periods of the ledger's calendar from p_period_from to p_period_to.
+    """
+    return registry.periods_between(p_ledger_id, p_period_from, p_period_to)
+
+
+def summarize_balances(p_signature: str, p_values, p_ids, p_ledger_id, p_periods: list,
+                       p_subtotals: list = None) -> pd.DataFrame:
+    """
+    Builds the Summary view of p_periods from the Detail balances stored under the signature,
+    without calling the API. With p_subtotals the balances are rolled up over those segment columns,
+    otherwise over the selected account combination patterns like the API Summary mode does.
+    """
+    if p_subtotals:
+        return subtotal_detail_balances(p_signature, p_ledger_id, p_subtotals, p_periods)
+    return summarize_detail_balances(p_signature, p_values, p_ids, p_ledger_id, p_periods)
+
+
+def derive_balances(p_signature: str, p_flex_mode: str, p_values, p_ids, p_ledger_id, p_periods: list,
+                    p_subtotals: list = None, p_trend_measure: str = None) -> pd.DataFrame:
+    """
+    Builds the Summary or Trend view of p_periods from the Detail balances stored under the signature,
+    without calling the API. The Trend view pivots p_trend_measure (EndingBalance by default) by period
+    with the MoM and YoY variances, see trend_detail_balances.
+    """
+    if p_flex_mode == 'Trend':
+        return trend_detail_balances(p_signature, p_ledger_id, p_periods, p_trend_measure or 'EndingBalance')
+    return summarize_balances(p_signature, p_values, p_ids, p_ledger_id, p_periods, p_subtotals)
+
+
+def shape_detail_balances(df: pd.DataFrame, p_ledger_id) -> pd.DataFrame:
+    """
+    Splits DetailAccountCombination into one column per segment, placed right after it,
+    and converts the balance columns to numbers. The segment value descriptions are added to the
+    assembled result, see enrich_segment_descriptions.
+    """
+    # Extract value_set_description ordered by segment_number for the specific ledger_id
+    column_names = registry.ledger_segments(p_ledger_id)['VALUE_SET_DESCRIPTION'].tolist()
+    split_columns = df['DetailAccountCombination'].str.split(registry.segment_separator(p_ledger_id), expand=True)
+    # Assign the extracted column names
+    split_columns.columns = column_names
+    df = pd.concat([df, split_columns], axis=1)
+    # Now reorder the columns to put split columns right after DetailAccountCombination
+    # Get all column names
+    all_columns = df.columns.tolist()
+    # Remove the new columns from the list
+    for col in column_names:
+        all_columns.remove(col)
+    # Find the index of DetailAccountCombination
+    detail_acc_idx = all_columns.index('DetailAccountCombination')
+    # Create new column order
+    new_column_order = all_columns[:(detail_acc_idx + 1)] + column_names + all_columns[
+                                                                           (detail_acc_idx + 1):]
+    # Reindex the dataframe with the new column order
+    df = df[new_column_order].copy()
+    df[['PeriodActivity', 'BeginningBalance', 'EndingBalance']] = df[
+        ['PeriodActivity', 'BeginningBalance', 'EndingBalance']].apply(pd.to_numeric, errors='coerce')
+    return df
+
+
+def prepare_df(p_ledger_id, p_values, p_ids, p_period_from, p_period_to, p_balance_type, p_from_currency, p_currency,
+               p_flex_mode, p_subtotals: list = None,
+               p_progress: Callable[[int, int, int], None] = None,
+               p_on_chunk: Callable[[pd.DataFrame], None] = None,
+               p_max_age: float = None, p_trend_measure: str = None) -> Union[pd.DataFrame, SpilledResult]:
+    """
+    Pulls the balances of the selected ledger, periods and account combinations.
+    Detail balances are cached per period in DuckDB, periods cached less than p_max_age seconds ago
+    (BALANCE_CACHE_TTL by default) are served from the cache and only the other periods are pulled.
+    The API calls run on PULL_WORKERS fetch workers, the fetched pages reach the pulling thread through a
+    queue of PULL_QUEUE_DEPTH pages and are stored in DuckDB in batches, see packages.pipeline.
+    p_progress(done, total, rows) is called before the first API call and after every stored batch,
+    it may raise to stop the pull, see packages.jobs.
+    p_on_chunk(df) receives the cached rows and the rows of every stored batch as soon as they are stored,
+    it is not called when the result is a local rollup of the Detail rows, nor after the streamed rows
+    exceeded the memory budget. Larger results are returned as a SpilledResult, see packages.spill.
+    Every fetched (period, combination, offset) page is checkpointed in DuckDB, pulling the same request
+    again after a failure or cancellation resumes after the last completed page, see packages.extraction.
+    The Trend mode pulls Detail balances and returns them pivoted by period, see derive_balances.
+    Running from a snapshot bundle, the cached periods are served whatever their age and a request
+    needing other periods raises OfflineModeError, see packages.snapshot.
+    """
+    budget: MemoryBudget = MemoryBudget()
+    signature: str = request_signature(p_ledger_id, p_values, p_ids, p_balance_type, p_from_currency, p_currency)
+    # A pull of the same selection running on another thread finishes first, this one then finds
+    # its periods cached and shares neither its staging table nor its cache tables
+    with selection_lock(signature):
+        # Fetch periods list
+        periods_list: list = get_periods_list(p_ledger_id, p_period_from, p_period_to)
+        fresh_periods: set = cached_periods(signature, None if offline_mode
+                                            else balance_cache_ttl if p_max_age is None else p_max_age)
+        # Summary and Trend views are computed locally when the Detail rows of all periods are cached
+        if p_flex_mode in ('Summary', 'Trend') and periods_list and set(periods_list) <= fresh_periods:
+            logger.info(f"{p_flex_mode} computed from cached Detail balances {signature}")
+            return derive_balances(signature, p_flex_mode, p_values, p_ids, p_ledger_id, periods_list, p_subtotals,
+                                   p_trend_measure)
+        # Subtotals and trends need the Detail rows
+        fetch_mode: str = 'Detail' if p_flex_mode == 'Trend' or (p_flex_mode == 'Summary' and p_subtotals) \
+            else p_flex_mode
+        streaming: bool = p_on_chunk is not None and fetch_mode == p_flex_mode
+        if fetch_mode == 'Detail':
+            periods_to_fetch: list = [period for period in periods_list if period not in fresh_periods]
+            cached_in_range: list = [period for period in periods_list if period in fresh_periods]
+            if cached_in_range and streaming and detail_fits_budget(signature, cached_in_range):
+                p_on_chunk(load_detail_balances(signature, cached_in_range))
+        else:
+            periods_to_fetch: list = periods_list
+            cached_in_range: list = []
+        logger.info(f"Periods to pull: {periods_to_fetch}, cached: {cached_in_range}")
+        if offline_mode and periods_to_fetch:
+            raise OfflineModeError(f"{fetch_mode} balances of {', '.join(periods_to_fetch)} for this selection "
+                                   f"are not in the snapshot bundle.")
+        if not periods_to_fetch:
+            # Nothing to pull, so no staging table is claimed either, an offline start never writes one
+            if fetch_mode != 'Detail':
+                return pd.DataFrame()
+            if fetch_mode != p_flex_mode:
+                return derive_balances(signature, p_flex_mode, p_values, p_ids, p_ledger_id, periods_list,
+                                       p_subtotals, p_trend_measure)
+            return load_detail_result(signature, periods_list) if cached_in_range else pd.DataFrame()
+        # Fetch ledger name based on selected ID
+        ledger_name: str = registry.ledger(p_ledger_id)['Name']
+        # Account combinations are generated lazily from the selected values of every segment
+        axes: list = combination_axes(p_values, p_ids, p_ledger_id)
+        logger.info(f"Segment values: {axes}")
+        if p_balance_type == 'From':
+            balance_type = f'From {p_from_currency}'
+        else:
+            balance_type = p_balance_type
+        logger.info(balance_type)
+        # Pages completed by an earlier attempt of the same pull
+        extraction: str = extraction_id(signature, fetch_mode, periods_to_fetch, axes)
+        # The staging table of this pull only, taking over the rows of an earlier attempt
+        staging: str = claim_extraction(extraction, extraction_resume_ttl if p_max_age is None
+                                        else min(extraction_resume_ttl, p_max_age))
+        completed: dict = completed_units(extraction)
+        total_calls: int = len(periods_to_fetch) * combination_count(axes)
+        calls_done: int = sum(1 for _, has_more in completed.values() if not has_more)
+        rows_fetched: int = staged_row_count(extraction) if completed else 0
+        if completed:
+            logger.info(f"Resuming extraction {extraction} after {calls_done} completed calls, {rows_fetched} rows")
+            if streaming and rows_fetched and staged_fits_budget(extraction, staging):
+                staged_df: pd.DataFrame = load_staged(extraction, staging)
+                p_on_chunk(enrich_segment_descriptions(staged_df, p_ledger_id) if fetch_mode == 'Detail' else staged_df)
+        if p_progress:
+            p_progress(calls_done, total_calls, rows_fetched)
+        balances_api_url: str = construct_api_url(base_api_url, balances_endpoint)
+
+        def pending_calls() -> Iterator[tuple]:
+            for period_pos, period in enumerate(periods_to_fetch):
+                for combination_pos, combination in enumerate(generate_combinations(axes, p_ledger_id)):
+                    last_offset, has_more = completed.get((period, combination), (None, True))
+                    if has_more:
+                        yield period_pos, period, combination_pos, combination, \
+                            0 if last_offset is None else last_offset + api_page_size
+
+        def fetch_call(p_call: tuple) -> Iterator[tuple]:
+            # Runs on the fetch workers, the pages are shaped there and only stored by the pulling thread
+            period_pos, period, combination_pos, combination, start_offset = p_call
+            for offset, balances_list, has_more in fetch_api_pages(
+                    balances_api_url, username, password,
+                    construct_params(combination, period, p_currency, ledger_name, fetch_mode, balance_type),
+                    start_offset):
+                chunk: pd.DataFrame = pd.DataFrame(balances_list)
+                if fetch_mode == 'Detail' and not chunk.empty:
+                    chunk = shape_detail_balances(chunk, p_ledger_id)
+                yield period_pos, period, combination_pos, combination, offset, has_more, chunk
+
+        # The pulling thread is the only writer, the pages waiting for it are bounded by the queue depth
+        with closing(fetch_pipeline(pending_calls(), fetch_call, pull_workers, pull_queue_depth)) as batches:
+            for pages in batches:
+                checkpoint_pages(extraction, staging, pages)
+                chunks: list = [df for *_, df in pages if not df.empty]
+                rows_fetched += sum(len(chunk) for chunk in chunks)
+                calls_done += sum(1 for *_, has_more, _ in pages if not has_more)
+                if streaming and chunks:
+                    chunk: pd.DataFrame = chunks[0] if len(chunks) == 1 else pd.concat(chunks, ignore_index=True)
+                    if fetch_mode == 'Detail':
+                        chunk = enrich_segment_descriptions(chunk, p_ledger_id)
+                    p_on_chunk(chunk)
+                    budget.add(chunk)
+                    # The rest is shown from the final result, the browser would not hold it anyway
+                    streaming = not budget.exceeded()
+                if p_progress:
+                    p_progress(calls_done, total_calls, rows_fetched)
+        df = load_staged(extraction, staging)
+        if fetch_mode == 'Detail':
+            # Once on the assembled rows, the pages are only split on the fetch workers
+            df = enrich_segment_descriptions(df, p_ledger_id)
+        if fetch_mode == 'Detail' and periods_to_fetch:
+            store_detail_balances(df, signature, p_ledger_id, periods_to_fetch)
+        finish_extraction(extraction, staging)
+        if fetch_mode == 'Detail':
+            if fetch_mode != p_flex_mode:
+                return derive_balances(signature, p_flex_mode, p_values, p_ids, p_ledger_id, periods_list,
+                                       p_subtotals, p_trend_measure)
+            if cached_in_range:
+                return load_detail_result(signature, periods_list)
         return df
+
+
+def refresh_open_periods(p_ledger_id, p_values, p_ids, p_period_from, p_period_to, p_balance_type, p_from_currency,
+                         p_currency, p_flex_mode, p_open_periods: list, p_subtotals: list = None,
+                         p_trend_measure: str = None, p_changes: bool = True,
+                         p_progress: Callable[[int, int, int], None] = None
+                         ) -> Union[dict, pd.DataFrame, SpilledResult]:
+    """
+    Pulls the Detail balances of p_open_periods again whatever their age, e.g. the periods still taking
+    postings during close, the other periods of the range stay as cached.
+    With p_changes, a Detail view gets only what changed in the open periods against the stored rows,
+    see detail_changes, so the grid can apply it as a row transaction. Otherwise the whole result of the
+    range is returned like prepare_df does.
+
+    Parameters:
+    - p_open_periods (list): Consecutive periods of the range to pull again.
+    - p_changes (bool): Return the changes of a Detail view instead of the result.
+    The other parameters are the ones of prepare_df.
+
+    Returns:
+    - dict | pd.DataFrame | SpilledResult: {'add': ..., 'update': ..., 'remove': ...} DataFrames of the
+      changes, or the result of the range.
+    """
+    signature: str = request_signature(p_ledger_id, p_values, p_ids, p_balance_type, p_from_currency, p_currency)
+    changes: bool = p_changes and p_flex_mode == 'Detail'
+    logger.info(f"Refreshing the open periods {p_open_periods} of {signature}")
+    # Held across the stored rows, the pull and the diff, so a concurrent pull of the selection cannot change
+    # the rows between them
+    with selection_lock(signature):
+        stored: pd.DataFrame = load_detail_balances(signature, p_open_periods) if changes else pd.DataFrame()
+        prepare_df(p_ledger_id, p_values, p_ids, p_open_periods[0], p_open_periods[-1], p_balance_type,
+                   p_from_currency, p_currency, 'Detail', p_progress=p_progress, p_max_age=0)
+        if changes:
+            return detail_changes(stored, load_detail_balances(signature, p_open_periods))
+    return prepare_df(p_ledger_id, p_values, p_ids, p_period_from, p_period_to, p_balance_type, p_from_currency,
+                      p_currency, p_flex_mode, p_subtotals, p_progress=p_progress, p_trend_measure=p_trend_measure)
+
+
+def detail_fits_budget(p_signature: str, p_periods: list) -> bool:
+    """
+    Checks whether the cached Detail balances of p_periods can be loaded within the memory budget.
+    """
+    estimated: int = estimate_bytes(period_source(p_signature), [p_periods, p_periods],
+                                    cached_row_count(p_signature, p_periods))
+    return MemoryBudget().fits(estimated)
+
+
+def load_detail_result(p_signature: str, p_periods: list) -> Union[pd.DataFrame, SpilledResult]:
+    """
+    Returns the cached Detail balances of p_periods as a DataFrame, or as a SpilledResult copied
+    inside DuckDB when they do not fit the memory budget.
+    """
+    if detail_fits_budget(p_signature, p_periods):
+        return load_detail_balances(p_signature, p_periods)
+    return spill_query(f"SELECT * EXCLUDE (period_pos, row_pos) FROM {period_source(p_signature)} "
+                       f"ORDER BY period_pos, row_pos", [p_periods, p_periods])
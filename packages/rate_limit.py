@@ -0,0 +1,77 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from packages.config import api_rate_limit, background_rate_share
+
+logger = logging.getLogger(__name__)
+
+_priority = threading.local()
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all Fusion API requests of the process. Background requests (cache warming)
+    are limited to background_share of the rate and only take a token while the bucket holds more than
+    the reserve kept for interactive requests, so they never starve interactive users. A rate of 0 limits
+    no request, background requests neither.
+    """
+
+    def __init__(self, rate_per_second: float, background_share: float):
+        self.rate = rate_per_second
+        self.capacity = max(rate_per_second, 1.0)
+        self.reserve = min(self.capacity * (1.0 - background_share), self.capacity - 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.background_interval = 1.0 / (rate_per_second * background_share) if rate_per_second else 0.0
+        self.background_next_at = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now: float = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        """
+        Blocks until the calling thread may send one request.
+        """
+        if not self.rate:
+            return
+        background: bool = is_background()
+        threshold: float = 1.0 + (self.reserve if background else 0.0)
+        while True:
+            with self._lock:
+                self._refill()
+                now: float = time.monotonic()
+                if background and now < self.background_next_at:
+                    wait: float = self.background_next_at - now
+                elif self.tokens >= threshold:
+                    self.tokens -= 1.0
+                    if background:
+                        self.background_next_at = now + self.background_interval
+                    return
+                else:
+                    wait: float = (threshold - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+@contextmanager
+def background_priority():
+    """
+    Marks the API requests of the current thread as background requests.
+    """
+    previous: bool = is_background()
+    _priority.background = True
+    try:
+        yield
+    finally:
+        _priority.background = previous
+
+
+def is_background() -> bool:
+    return getattr(_priority, 'background', False)
+
+
+api_rate_limiter: RateLimiter = RateLimiter(api_rate_limit, background_rate_share)
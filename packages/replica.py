@@ -0,0 +1,221 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+
+import duckdb
+
+from packages.config import duckdb_db_path, multi_worker, replica_dir, replica_publish_interval
+from packages.db_connection import DuckDBConnection
+
+logger = logging.getLogger(__name__)
+
+# DuckDB allows one process to open a database file read-write, or any number of processes to open it
+# read-only, but not both at once. In a multi-worker deployment the writer process (python -m packages.writer)
+# is the only one opening ledgers.duckdb, it runs the balance pulls and metadata loads queued by the web
+# workers and publishes a copy of the database after them. The web workers read the latest copy read-only.
+pointer_file = 'CURRENT'
+replica_prefix = 'replica_'
+kept_replicas: int = 3  # published copies kept on disk, a worker may still read from the previous ones
+
+_role: str = 'reader' if multi_worker else 'single'
+_publish_lock: threading.Lock = threading.Lock()
+_last_publish_started: float = 0.0
+_readers_lock: threading.Lock = threading.Lock()
+_readers: dict = {}  # replica file name -> [read-only connection, open cursors], the current one last
+_pointer: tuple = (None, None)  # (pointer file mtime, replica file name)
+
+
+def become_writer():
+    """
+    Makes this process the writer of a multi-worker deployment, it reads and writes ledgers.duckdb
+    and publishes the replicas.
+    """
+    global _role
+    _role = 'writer'
+
+
+def is_reader() -> bool:
+    """
+    Whether this process is a web worker of a multi-worker deployment, reading the replicas only.
+    """
+    return _role == 'reader'
+
+
+def _replica_path() -> Path:
+    return Path.cwd() / replica_dir
+
+
+def _copy_database(p_partial: Path):
+    """
+    Copies the tables and views of ledgers.duckdb to p_partial. The tables are listed and copied in one
+    transaction, a snapshot that pulls writing meanwhile or dropping their staging tables do not change.
+    The staging tables (ext_) of running pulls are not copied, the readers never read them.
+    """
+    with DuckDBConnection(Path.cwd() / duckdb_db_path) as conn:
+        database: str = conn.execute("SELECT current_database()").fetchone()[0]
+        conn.execute(f"ATTACH '{p_partial.as_posix()}' AS replica")
+        try:
+            conn.execute("BEGIN TRANSACTION")
+            try:
+                for (table_name,) in conn.execute(
+                        "SELECT table_name FROM duckdb_tables() WHERE database_name = ? AND schema_name = 'main' "
+                        "AND NOT internal AND NOT starts_with(table_name, 'ext_')", [database]).fetchall():
+                    conn.execute(f'CREATE TABLE replica."{table_name}" AS SELECT * FROM {database}."{table_name}"')
+                views: list = [sql for (sql,) in conn.execute(
+                    "SELECT sql FROM duckdb_views() WHERE database_name = ? AND schema_name = 'main' AND NOT internal",
+                    [database]).fetchall()]
+                conn.execute("COMMIT")
+            except duckdb.Error:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.execute("DETACH replica")
+    # The view definitions name the tables without a database, they are created in the replica itself
+    with duckdb.connect(database=str(p_partial), read_only=False) as replica_conn:
+        for sql in views:
+            replica_conn.execute(sql)
+
+
+def publish_replica():
+    """
+    Copies ledgers.duckdb to a new replica and points the readers to it, in the writer process only, see
+    _copy_database. Copies start at most every REPLICA_PUBLISH_INTERVAL seconds, requests arriving until
+    a copy starts are served by it, so the jobs finishing together share one copy and the writes of everything
+    that finished before the call are visible to the readers when it returns. A failed copy leaves no file.
+    """
+    global _last_publish_started
+    if _role != 'writer':
+        return
+    requested_at: float = time.monotonic()
+    with _publish_lock:
+        if _last_publish_started >= requested_at:
+            return
+        # The requests arriving while this one waits queue on the lock and are served by its copy
+        time.sleep(max(_last_publish_started + replica_publish_interval - time.monotonic(), 0))
+        _last_publish_started = time.monotonic()
+        directory: Path = _replica_path()
+        directory.mkdir(parents=True, exist_ok=True)
+        name: str = f'{replica_prefix}{time.time_ns()}.duckdb'
+        partial: Path = directory / f'{name}.partial'
+        try:
+            _copy_database(partial)
+            os.replace(partial, directory / name)
+        except Exception:
+            partial.unlink(missing_ok=True)
+            partial.with_name(f'{partial.name}.wal').unlink(missing_ok=True)
+            raise
+        (directory / f'{pointer_file}.partial').write_text(name, encoding='utf-8')
+        os.replace(directory / f'{pointer_file}.partial', directory / pointer_file)
+        logger.info(f"Replica {name} published in {time.monotonic() - _last_publish_started:.2f}s")
+        _prune_replicas(directory, name)
+
+
+def _prune_replicas(directory: Path, p_current: str):
+    replicas: list = sorted(path.name for path in directory.glob(f'{replica_prefix}*.duckdb'))
+    for name in replicas[:-kept_replicas]:
+        if name == p_current:
+            continue
+        try:
+            (directory / name).unlink()
+        except OSError as e:
+            # Still open by a worker on Windows, removed by a later publish
+            logger.debug(f"Replica {name} not removed yet: {e}")
+
+
+def current_replica() -> Optional[str]:
+    """
+    Returns the file name of the latest published replica, None if none was published yet.
+    """
+    global _pointer
+    pointer: Path = _replica_path() / pointer_file
+    try:
+        mtime: int = pointer.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if _pointer[0] != mtime:
+        _pointer = (mtime, pointer.read_text(encoding='utf-8').strip())
+    return _pointer[1]
+
+
+def wait_for_replica(p_timeout: float):
+    """
+    Waits until the writer process published the first replica and it can be opened, raises RuntimeError
+    after p_timeout seconds.
+    """
+    deadline: float = time.monotonic() + p_timeout
+    while True:
+        try:
+            if current_replica() is not None:
+                _release_reader(_acquire_reader()[0])
+                return
+        except duckdb.IOException as e:
+            logger.info(f"Waiting for the replica: {e}")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"No database replica in '{_replica_path()}' after {p_timeout:.0f}s, "
+                               f"start the writer process first: python -m packages.writer")
+        time.sleep(0.5)
+
+
+def _acquire_reader() -> tuple:
+    """
+    Returns the name and the connection of the latest replica, counted as used until _release_reader.
+    """
+    name: Optional[str] = current_replica()
+    if name is None:
+        raise RuntimeError(f"No database replica in '{_replica_path()}', start the writer process first: "
+                           f"python -m packages.writer")
+    with _readers_lock:
+        if name not in _readers:
+            try:
+                conn: duckdb.DuckDBPyConnection = duckdb.connect(database=str(_replica_path() / name), read_only=True)
+            except duckdb.IOException:
+                # The writer may hold the lock of a replica it just published for a moment
+                if not _readers:
+                    raise
+                name = next(reversed(_readers))
+            else:
+                _readers[name] = [conn, 0]
+                logger.info(f"Reading from replica {name}")
+                _close_idle_readers()
+        _readers[name][1] += 1
+        return name, _readers[name][0]
+
+
+def _release_reader(name: str):
+    with _readers_lock:
+        _readers[name][1] -= 1
+        _close_idle_readers()
+
+
+def _close_idle_readers():
+    # Called holding _readers_lock. The connections of the previous replicas stay open while queries
+    # still run on them and are closed by the last one to finish.
+    current: str = next(reversed(_readers))
+    for name, (conn, cursors) in list(_readers.items()):
+        if name != current and cursors == 0:
+            del _readers[name]
+            conn.close()
+
+
+@contextmanager
+def read_connection() -> Iterator[duckdb.DuckDBPyConnection]:
+    """
+    Connection for read-only queries: a cursor on the latest replica in a web worker of a multi-worker
+    deployment, otherwise a connection to ledgers.duckdb. The replica connection is kept open and
+    shared by the threads of the worker, every query gets a cursor of its own. After a newer replica
+    was published, the connection of the previous one is closed when the last query on it finishes.
+    """
+    if _role != 'reader':
+        with DuckDBConnection(Path.cwd() / duckdb_db_path) as conn:
+            yield conn
+        return
+    name, conn = _acquire_reader()
+    try:
+        with conn.cursor() as cursor:
+            yield cursor
+    finally:
+        _release_reader(name)
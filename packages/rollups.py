@@ -0,0 +1,212 @@
+import logging
+
+import pandas as pd
+
+from packages.balance_cache import balance_key_table, combination_table_name, fact_table_name, key_columns
+from packages.duck_select import execute_sql_query, quote_identifier
+from packages.metadata_registry import registry
+
+logger = logging.getLogger(__name__)
+
+balance_columns: list = ['BeginningBalance', 'PeriodActivity', 'EndingBalance']
+
+
+def get_segment_columns(p_ledger_id) -> list:
+    """
+    Returns (VALUE_SET_NAME, VALUE_SET_DESCRIPTION) pairs of the ledger ordered by SEGMENT_NUMBER.
+    VALUE_SET_DESCRIPTION is the name of the split segment column in Detail results.
+    """
+    ledger_segments: pd.DataFrame = registry.ledger_segments(p_ledger_id)
+    return list(zip(ledger_segments['VALUE_SET_NAME'], ledger_segments['VALUE_SET_DESCRIPTION']))
+
+
+def _period_keys() -> str:
+    """
+    Balance keys of the periods passed as the first two parameters (the period list, twice), with period_pos.
+    """
+    return (f"SELECT *, list_position(?, PeriodName) AS period_pos "
+            f"FROM {balance_key_table} WHERE list_contains(?, PeriodName)")
+
+
+def summarize_detail_balances(signature: str, p_values, p_ids, p_ledger_id, p_periods: list) -> pd.DataFrame:
+    """
+    Rolls stored Detail balances up to the account combination patterns that a Summary pull would return.
+    Segments selected with '%' are collapsed, segments with explicit values are kept.
+    The patterns are numbered on the combination dimension, the facts are aggregated by integer ids
+    and the pattern strings are joined only to the aggregated rows.
+
+    Parameters:
+    - signature (str): Signature of the stored Detail pull.
+    - p_values (list): Values of the flex dynamic dropdowns.
+    - p_ids (list): Ids of the flex dynamic dropdowns.
+    - p_ledger_id: Selected ledger.
+    - p_periods (list): Periods to summarize.
+
+    Returns:
+    - pd.DataFrame: One row per period and account combination pattern.
+    """
+    index_to_values: dict = {}
+    for dropdown_id, value in zip(p_ids, p_values):
+        index_to_values[dropdown_id['index']] = value if value else ['%']
+
+    keys: list = [f"k.{quote_identifier(column)}" for column in key_columns]
+    pattern_parts: list = []
+    kept_segments: list = []
+    for value_set_name, column_name in get_segment_columns(p_ledger_id):
+        if '%' in index_to_values.get(value_set_name, ['%']):
+            pattern_parts.append("'%'")
+        else:
+            pattern_parts.append(quote_identifier(column_name))
+            kept_segments.append(quote_identifier(column_name))
+    group_id: str = f"dense_rank() OVER (ORDER BY {', '.join(kept_segments)})" if kept_segments else "1"
+    sums: list = [f"SUM(f.{quote_identifier(column)}) AS {quote_identifier(column)}" for column in balance_columns]
+    outer_sums: list = [f"t.{quote_identifier(column)}" for column in balance_columns]
+    separator: str = registry.segment_separator(p_ledger_id)
+
+    query = f"""
+        WITH keys AS ({_period_keys()}),
+        patterns AS (
+            SELECT combination_id, {group_id} AS group_id,
+                   concat_ws('{separator}', {', '.join(pattern_parts)}) AS AccountCombination
+            FROM {combination_table_name(p_ledger_id)}
+        ),
+        totals AS (
+            SELECT f.key_id, p.group_id, MIN(f.rowid) AS row_pos, {', '.join(sums)}
+            FROM {fact_table_name(signature)} f
+            JOIN patterns p ON p.combination_id = f.combination_id
+            WHERE f.key_id IN (SELECT key_id FROM keys)
+            GROUP BY f.key_id, p.group_id
+        )
+        SELECT {', '.join(keys)}, l.AccountCombination, {', '.join(outer_sums)}
+        FROM totals t
+        JOIN keys k ON k.key_id = t.key_id
+        JOIN (SELECT DISTINCT group_id, AccountCombination FROM patterns) l ON l.group_id = t.group_id
+        ORDER BY k.period_pos, t.row_pos
+    """
+    return execute_sql_query(query, [p_periods, p_periods])
+
+
+def subtotal_detail_balances(signature: str, p_ledger_id, p_segment_columns: list, p_periods: list) -> pd.DataFrame:
+    """
+    Computes hierarchical subtotals (ROLLUP) of stored Detail balances over the chosen segment columns,
+    e.g. ['COMPANY', 'ACCOUNT'] gives company/account rows, company subtotals and a period total.
+    The ROLLUP runs on integer segment codes numbered in value order, the labels are joined afterwards.
+
+    Parameters:
+    - signature (str): Signature of the stored Detail pull.
+    - p_ledger_id: Ledger of the pull.
+    - p_segment_columns (list): Split segment column names in rollup order.
+    - p_periods (list): Periods to roll up.
+
+    Returns:
+    - pd.DataFrame: Balances per rollup level, rolled up segments are labeled 'Total'.
+    """
+    keys: list = [f"k.{quote_identifier(column)}" for column in key_columns]
+    segments: list = [quote_identifier(column) for column in p_segment_columns]
+    codes: list = [f"dense_rank() OVER (ORDER BY {segment}) AS g{i}" for i, segment in enumerate(segments)]
+    grouped: list = [f"c.g{i}" for i in range(len(segments))]
+    labels: list = [f"LEFT JOIN (SELECT DISTINCT g{i}, {segment} AS label FROM codes) l{i} ON l{i}.g{i} = g.g{i}"
+                    for i, segment in enumerate(segments)]
+    labeled: list = [f"COALESCE(l{i}.label, 'Total') AS {segment}" for i, segment in enumerate(segments)]
+    sums: list = [f"SUM(f.{quote_identifier(column)}) AS {quote_identifier(column)}" for column in balance_columns]
+    outer_sums: list = [f"g.{quote_identifier(column)}" for column in balance_columns]
+
+    query = f"""
+        WITH keys AS ({_period_keys()}),
+        codes AS (
+            SELECT combination_id, {', '.join(segments)}, {', '.join(codes)}
+            FROM {combination_table_name(p_ledger_id)}
+        ),
+        grouped AS (
+            SELECT f.key_id, {', '.join(grouped)}, GROUPING_ID({', '.join(grouped)}) AS SubtotalLevel,
+                   {', '.join(sums)}
+            FROM {fact_table_name(signature)} f
+            JOIN codes c ON c.combination_id = f.combination_id
+            WHERE f.key_id IN (SELECT key_id FROM keys)
+            GROUP BY f.key_id, ROLLUP({', '.join(grouped)})
+        )
+        SELECT {', '.join(keys)}, {', '.join(labeled)}, g.SubtotalLevel, {', '.join(outer_sums)}
+        FROM grouped g
+        JOIN keys k ON k.key_id = g.key_id
+        {' '.join(labels)}
+        ORDER BY k.period_pos, {', '.join(f'g.g{i} NULLS LAST' for i in range(len(segments)))}
+    """
+    return execute_sql_query(query, [p_periods, p_periods])
+
+
+def trend_detail_balances(signature: str, p_ledger_id, p_periods: list,
+                          p_measure: str = 'EndingBalance') -> pd.DataFrame:
+    """
+    Pivots stored Detail balances to one row per account combination and one column per period, with the
+    variances against the prior period (MoM) and the same period of the prior year (YoY) in amount and percent.
+    The variances are window functions over the (combination, period) series on integer ids, a combination
+    without balances in a period counts as 0, and only the compact pivoted table leaves DuckDB.
+    MoM columns follow every period but the first, YoY columns the periods whose prior year period is selected.
+
+    Parameters:
+    - signature (str): Signature of the stored Detail pull.
+    - p_ledger_id: Ledger of the pull.
+    - p_periods (list): Periods to pivot, a calendar range as returned by get_periods_list.
+    - p_measure (str): Balance column to pivot, one of balance_columns.
+
+    Returns:
+    - pd.DataFrame: The pivoted balances ordered by DetailAccountCombination.
+    """
+    if p_measure not in balance_columns:
+        raise ValueError(f"Unknown balance column '{p_measure}', expected one of {balance_columns}")
+    calendar: pd.DataFrame = registry.ledger_calendar(p_ledger_id).set_index('PeriodNameId')
+    years: list = [int(calendar.at[period, 'PeriodYear']) for period in p_periods]
+    numbers: list = [int(calendar.at[period, 'PeriodNumber']) for period in p_periods]
+    selected: set = set(zip(years, numbers))
+
+    # The balance keys without the period, normally one currency and amount type per pull
+    series_keys: list = [quote_identifier(column) for column in key_columns if column != 'PeriodName']
+    segments: list = [quote_identifier(column) for _, column in get_segment_columns(p_ledger_id)]
+    pivoted: list = []
+    for position, (period, year, number) in enumerate(zip(p_periods, years, numbers), start=1):
+        label: str = period.replace('.', ' ')  # AG Grid reads dots in field names as nested paths
+        in_period: str = f"FILTER (WHERE v.period_pos = {position})"
+        pivoted.append(f"first(v.amount) {in_period} AS {quote_identifier(label)}")
+        priors: list = ([('MoM', 'prior_period')] if position > 1 else []) + (
+            [('YoY', 'prior_year')] if (year - 1, number) in selected else [])
+        for name, prior in priors:
+            pivoted.append(f"first(v.amount - v.{prior}) {in_period} AS {quote_identifier(f'{label} {name}')}")
+            pivoted.append(f"first(round(100 * (v.amount - v.{prior}) / abs(nullif(v.{prior}, 0)), 2)) {in_period} "
+                           f"AS {quote_identifier(f'{label} {name} %')}")
+
+    query = f"""
+        WITH keys AS (
+            SELECT *, dense_rank() OVER (ORDER BY {', '.join(series_keys)}) AS series_id
+            FROM ({_period_keys()})
+        ),
+        calendar AS (
+            SELECT unnest(?::INTEGER[]) AS period_pos, unnest(?::INTEGER[]) AS PeriodYear,
+                   unnest(?::INTEGER[]) AS PeriodNumber
+        ),
+        amounts AS (
+            SELECT k.series_id, f.combination_id, k.period_pos, SUM(f.{quote_identifier(p_measure)}) AS amount
+            FROM {fact_table_name(signature)} f
+            JOIN keys k ON k.key_id = f.key_id
+            GROUP BY k.series_id, f.combination_id, k.period_pos
+        ),
+        variances AS (
+            SELECT r.series_id, r.combination_id, c.period_pos, coalesce(a.amount, 0) AS amount,
+                   lag(coalesce(a.amount, 0)) OVER (PARTITION BY r.series_id, r.combination_id
+                                                    ORDER BY c.period_pos) AS prior_period,
+                   first(coalesce(a.amount, 0)) OVER (PARTITION BY r.series_id, r.combination_id, c.PeriodNumber
+                                                      ORDER BY c.PeriodYear
+                                                      RANGE BETWEEN 1 PRECEDING AND 1 PRECEDING) AS prior_year
+            FROM (SELECT DISTINCT series_id, combination_id FROM amounts) r
+            CROSS JOIN calendar c
+            LEFT JOIN amounts a ON a.series_id = r.series_id AND a.combination_id = r.combination_id
+                                   AND a.period_pos = c.period_pos
+        )
+        SELECT d.DetailAccountCombination, d.AccountName, {', '.join(f'd.{segment}' for segment in segments)},
+               {', '.join(f's.{column}' for column in series_keys)}, {', '.join(pivoted)}
+        FROM variances v
+        JOIN (SELECT DISTINCT series_id, {', '.join(series_keys)} FROM keys) s ON s.series_id = v.series_id
+        JOIN {combination_table_name(p_ledger_id)} d ON d.combination_id = v.combination_id
+        GROUP BY ALL
+        ORDER BY d.DetailAccountCombination, {', '.join(f's.{column}' for column in series_keys)}
+    """
+    return execute_sql_query(query, [p_periods, p_periods, list(range(1, len(p_periods) + 1)), years, numbers])
@@ -0,0 +1,282 @@
+import argparse
+import hashlib
+import json
+import logging
+import shutil
+import tarfile
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator, Optional
+
+import duckdb
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+manifest_name = 'manifest.json'
+lg_list_file = 'lg_list.parquet'
+snapshot_db_file = 'snapshot.duckdb'
+bundle_format: int = 1
+# Transient tables of running pulls and spilled results, and the request history, are not exported
+excluded_prefixes: tuple = ('spill_', 'ext_')
+excluded_tables: tuple = ('extraction_units', 'extraction_staging', 'balance_requests')
+# Catalog and table prefixes of the balance cache, see packages.balance_cache, and the prefix of the sequences
+# of its dimension ids
+balance_cache_catalog = 'balance_cache'
+balance_cache_prefixes: tuple = ('fact_', 'dim_', 'bal_')
+sequence_prefix = 'seq_'
+
+
+class OfflineModeError(RuntimeError):
+    """
+    Raised when a request needs the Fusion API while the app runs from a snapshot bundle.
+    """
+
+
+def _sha256(p_path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(p_path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _exported_tables(conn: duckdb.DuckDBPyConnection) -> list:
+    tables: list = [table_name for (table_name,) in conn.execute(
+        "SELECT table_name FROM duckdb_tables() WHERE NOT internal AND schema_name = 'main' "
+        "ORDER BY table_name").fetchall()]
+    return [table_name for table_name in tables
+            if not table_name.startswith(excluded_prefixes) and table_name not in excluded_tables]
+
+
+@contextmanager
+def _export_connection(p_db_path: Optional[str]) -> Iterator[duckdb.DuckDBPyConnection]:
+    if p_db_path is not None:
+        with duckdb.connect(database=str(p_db_path), read_only=True) as conn:
+            yield conn
+        return
+    # Imported here, packages.config imports this module
+    from packages.replica import read_connection
+    with read_connection() as conn:
+        yield conn
+
+
+def export_snapshot(p_bundle_path: str, p_db_path: Optional[str], p_lg_list: pd.DataFrame) -> dict:
+    """
+    Writes a snapshot bundle: every metadata and balance cache table of the DuckDB database as a ZSTD
+    compressed Parquet file, the views presenting the cached balances, the parsed lg_list.json and a
+    manifest with row counts and checksums, in one tar file. The tables are read in one transaction,
+    so pulls finishing meanwhile are either completely in the bundle or not at all.
+
+    Parameters:
+    - p_bundle_path (str): Path of the bundle to write.
+    - p_db_path (str): DuckDB database to export, opened read-only, e.g. a replica. None exports the database
+      of the running app through its own connection, see packages.replica.read_connection.
+    - p_lg_list (pd.DataFrame): Parsed lg_list.json.
+
+    Returns:
+    - dict: The manifest.
+    """
+    started: float = time.monotonic()
+    with tempfile.TemporaryDirectory() as work_dir:
+        work_path: Path = Path(work_dir)
+        tables: list = []
+        with _export_connection(p_db_path) as conn:
+            conn.execute("BEGIN TRANSACTION")
+            for table_name in _exported_tables(conn):
+                file_name: str = f'{table_name}.parquet'
+                conn.execute(f"COPY {table_name} TO '{(work_path / file_name).as_posix()}' "
+                             f"(FORMAT PARQUET, COMPRESSION ZSTD)")
+                tables.append({'name': table_name, 'file': file_name,
+                               'rows': conn.execute(f"SELECT count(*) FROM {table_name}").fetchone()[0]})
+            views: list = [{'name': view_name, 'sql': sql} for view_name, sql in conn.execute(
+                "SELECT view_name, sql FROM duckdb_views() WHERE NOT internal AND schema_name = 'main' "
+                "ORDER BY view_name").fetchall()]
+            cached: list = []
+            if 'balance_cache' in [table['name'] for table in tables]:
+                cached = [{'signature': signature, 'ledger_id': ledger_id, 'periods': periods}
+                          for signature, ledger_id, periods in conn.execute(
+                              "SELECT signature, any_value(ledger_id), list(period_name ORDER BY period_name) "
+                              "FROM balance_cache GROUP BY signature ORDER BY signature").fetchall()]
+            conn.execute("COMMIT")
+        with duckdb.connect() as conn:
+            conn.register('lg_list', p_lg_list)
+            conn.execute(f"COPY lg_list TO '{(work_path / lg_list_file).as_posix()}' "
+                         f"(FORMAT PARQUET, COMPRESSION ZSTD)")
+        for table in tables:
+            table['bytes'] = (work_path / table['file']).stat().st_size
+            table['sha256'] = _sha256(work_path / table['file'])
+        manifest: dict = {
+            'format': bundle_format,
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'duckdb_version': duckdb.__version__,
+            'tables': tables,
+            'views': views,
+            'lg_list': {'file': lg_list_file, 'sha256': _sha256(work_path / lg_list_file),
+                        'ledgers': sorted(int(ledger_id) for ledger_id in p_lg_list['ledger_id'].unique())},
+            'cached_balances': cached,
+        }
+        (work_path / manifest_name).write_text(json.dumps(manifest, indent=2, default=str), encoding='utf-8')
+        # Parquet files are compressed already, the tar only packs them
+        with tarfile.open(p_bundle_path, 'w') as bundle:
+            bundle.add(work_path / manifest_name, arcname=manifest_name)
+            bundle.add(work_path / lg_list_file, arcname=lg_list_file)
+            for table in tables:
+                bundle.add(work_path / table['file'], arcname=table['file'])
+    logger.info(f"Snapshot of {len(tables)} tables and {len(cached)} cached selections written to "
+                f"'{p_bundle_path}' in {time.monotonic() - started:.1f}s")
+    return manifest
+
+
+def read_manifest(p_bundle_path: str) -> dict:
+    with tarfile.open(p_bundle_path, 'r') as bundle:
+        return json.load(bundle.extractfile(manifest_name))
+
+
+def _restore_dir(p_bundle_path: str, p_snapshot_dir: str) -> Path:
+    # A bundle is restored once, the same bundle file is recognized by its path, size and modification time
+    bundle: Path = Path(p_bundle_path).resolve()
+    stat = bundle.stat()
+    key: str = hashlib.sha1(f'{bundle}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8')).hexdigest()[:12]
+    return Path(p_snapshot_dir).resolve() / f'{bundle.stem}-{key}'
+
+
+def _extract_bundle(p_bundle_path: str, p_directory: Path) -> dict:
+    """
+    Unpacks a bundle into p_directory and verifies the checksums of its files.
+
+    Returns:
+    - dict: The manifest.
+    """
+    with tarfile.open(p_bundle_path, 'r') as bundle:
+        bundle.extractall(p_directory, filter='data')
+    manifest: dict = json.loads((p_directory / manifest_name).read_text(encoding='utf-8'))
+    if manifest.get('format') != bundle_format:
+        raise ValueError(f"Unsupported snapshot bundle format {manifest.get('format')} in '{p_bundle_path}'")
+    for entry in manifest['tables'] + [manifest['lg_list']]:
+        if _sha256(p_directory / entry['file']) != entry['sha256']:
+            raise ValueError(f"Checksum mismatch of '{entry['file']}' in snapshot bundle '{p_bundle_path}'")
+    return manifest
+
+
+def _drop_existing(conn: duckdb.DuckDBPyConnection, p_name: str):
+    # DROP VIEW IF EXISTS fails on a table of the name, and DROP TABLE IF EXISTS on a view
+    for (object_type,) in conn.execute(
+            "SELECT 'TABLE' FROM duckdb_tables() WHERE table_name = ? AND schema_name = 'main' AND NOT internal "
+            "UNION ALL SELECT 'VIEW' FROM duckdb_views() WHERE view_name = ? AND schema_name = 'main' AND NOT internal",
+            [p_name, p_name]).fetchall():
+        conn.execute(f"DROP {object_type} {p_name}")
+
+
+def _drop_balance_cache(conn: duckdb.DuckDBPyConnection):
+    """
+    Drops the cached balances with their dimensions and the sequences of the dimension ids. The fact tables
+    of one database do not fit the dimensions of another, their ids differ.
+    """
+    names: list = [name for (name,) in conn.execute(
+        "SELECT view_name FROM duckdb_views() WHERE schema_name = 'main' AND NOT internal "
+        "UNION ALL SELECT table_name FROM duckdb_tables() WHERE schema_name = 'main' AND NOT internal").fetchall()]
+    for name in names:
+        if name == balance_cache_catalog or name.startswith(balance_cache_prefixes):
+            _drop_existing(conn, name)
+    for (sequence_name,) in conn.execute("SELECT sequence_name FROM duckdb_sequences() WHERE schema_name = 'main' "
+                                         "AND starts_with(sequence_name, ?)", [sequence_prefix]).fetchall():
+        conn.execute(f"DROP SEQUENCE {sequence_name}")
+
+
+def _load_tables(conn: duckdb.DuckDBPyConnection, p_directory: Path, manifest: dict):
+    for table in manifest['tables']:
+        _drop_existing(conn, table['name'])
+        conn.execute(f"CREATE TABLE {table['name']} AS "
+                     f"SELECT * FROM read_parquet('{(p_directory / table['file']).as_posix()}')")
+    for view in manifest['views']:
+        _drop_existing(conn, view['name'])
+        conn.execute(view['sql'])
+
+
+def restore_snapshot(p_bundle_path: str, p_snapshot_dir: str) -> tuple:
+    """
+    Restores a snapshot bundle into a DuckDB database of its own under p_snapshot_dir, for the offline mode.
+    Restoring the same bundle again reuses the database restored before, so starting from a bundle
+    after the first time only opens the files.
+
+    Parameters:
+    - p_bundle_path (str): Bundle written by export_snapshot.
+    - p_snapshot_dir (str): Directory of the restored bundles.
+
+    Returns:
+    - tuple: (DuckDB database path, parsed lg_list path) of the restored bundle.
+    """
+    target: Path = _restore_dir(p_bundle_path, p_snapshot_dir)
+    if (target / manifest_name).exists():
+        return str(target / snapshot_db_file), str(target / lg_list_file)
+    started: float = time.monotonic()
+    staging: Path = target.with_name(target.name + '.partial')
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir(parents=True)
+    manifest: dict = _extract_bundle(p_bundle_path, staging)
+    with duckdb.connect(database=str(staging / snapshot_db_file), read_only=False) as conn:
+        _load_tables(conn, staging, manifest)
+    for table in manifest['tables']:
+        (staging / table['file']).unlink()
+    shutil.rmtree(target, ignore_errors=True)
+    staging.rename(target)
+    logger.info(f"Snapshot '{p_bundle_path}' of {manifest['created_at']} restored to '{target}' "
+                f"in {time.monotonic() - started:.1f}s")
+    return str(target / snapshot_db_file), str(target / lg_list_file)
+
+
+def import_snapshot(p_bundle_path: str, p_db_path: str) -> dict:
+    """
+    Loads the tables and views of a snapshot bundle into the DuckDB database, replacing tables and views of
+    the same name, so a new installation starts with the metadata and cached balances of the bundle
+    instead of pulling them again. A bundle with cached balances replaces the balance cache of the database
+    as a whole, see _drop_balance_cache. lg_list.json is not written, the installation keeps its own.
+
+    Returns:
+    - dict: The manifest.
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        manifest: dict = _extract_bundle(p_bundle_path, Path(work_dir))
+        # Imported here, packages.persist_metadata imports this module
+        from packages.persist_metadata import bump_catalog_version, read_catalog_version
+        with duckdb.connect(database=str(p_db_path), read_only=False) as conn:
+            # The bundle carries the catalog version of the database it was exported from, the imported
+            # metadata gets a version greater than that one and than the one the registries have seen
+            local_version: int = read_catalog_version(conn)
+            if any(table['name'] == balance_cache_catalog for table in manifest['tables']):
+                _drop_balance_cache(conn)
+            _load_tables(conn, Path(work_dir), manifest)
+            bump_catalog_version(conn, local_version)
+    logger.info(f"Snapshot '{p_bundle_path}' of {manifest['created_at']} imported into '{p_db_path}'")
+    return manifest
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Exports the metadata and cached balances to a snapshot bundle "
+                                                 "or imports a bundle into DUCKDB_DB_PATH. "
+                                                 "Start the app offline from a bundle with OFFLINE_SNAPSHOT=<bundle>.")
+    parser.add_argument('action', choices=['export', 'import'])
+    parser.add_argument('bundle', help="path of the bundle, e.g. glwalker-snapshot.tar")
+    args = parser.parse_args()
+
+    from packages.config import duckdb_db_path, ldf, replica_dir
+
+    if args.action == 'export':
+        try:
+            export_snapshot(args.bundle, str(Path.cwd() / duckdb_db_path), ldf)
+        except duckdb.IOException as e:
+            # ledgers.duckdb is open by the running app, a multi-worker deployment publishes replicas of it
+            from packages.replica import current_replica
+            replica: Optional[str] = current_replica()
+            if replica is None:
+                parser.exit(1, f"{e}\nThe app holds the database, download the snapshot from the running app "
+                               f"instead: http://<app host>/snapshot.tar\n")
+            logger.info(f"The app holds the database, exporting the latest replica {replica}")
+            export_snapshot(args.bundle, str(Path.cwd() / replica_dir / replica), ldf)
+    else:
+        import_snapshot(args.bundle, str(Path.cwd() / duckdb_db_path))
@@ -0,0 +1,224 @@
+import logging
+import re
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+import duckdb
+import pandas as pd
+import psutil
+
+from packages.config import duckdb_db_path, request_memory_budget, process_memory_budget, job_wait_timeout
+from packages.db_connection import DuckDBConnection
+from packages.duck_select import execute_sql_query, quote_identifier
+from packages.jobs import submit_job, wait_for_job, get_job_result
+from packages.replica import is_reader, read_connection
+
+logger = logging.getLogger(__name__)
+
+spill_table_pattern = re.compile(r'^spill_(\d+)_[0-9a-f]+$')
+spill_ttl: int = 24 * 60 * 60  # seconds a spilled result is kept, as long as the job result referencing it
+numeric_types: tuple = ('TINYINT', 'SMALLINT', 'INTEGER', 'BIGINT', 'HUGEINT', 'FLOAT', 'DOUBLE')
+
+
+class SpilledResult:
+    """
+    Balances result kept in a DuckDB table instead of a DataFrame because it exceeded the memory budget.
+    The grid pages through it and the CSV export streams it from DuckDB, see read_spilled and export_spilled.
+    """
+
+    def __init__(self, table_name: str, row_count: int, columns: list):
+        self.table_name = table_name
+        self.row_count = row_count
+        self.columns = columns
+
+    @property
+    def empty(self) -> bool:
+        return self.row_count == 0
+
+
+class MemoryBudget:
+    """
+    Tracks the size of the DataFrames a request holds. The budget is exceeded when they are larger than
+    REQUEST_MEMORY_BUDGET_MB or when the process uses more than PROCESS_MEMORY_BUDGET_MB.
+    """
+
+    def __init__(self, request_budget: int = request_memory_budget, process_budget: int = process_memory_budget):
+        self.request_budget = request_budget
+        self.process_budget = process_budget
+        self.held_bytes: int = 0
+
+    def add(self, df: pd.DataFrame):
+        self.held_bytes += int(df.memory_usage(deep=True).sum())
+
+    def reset(self):
+        self.held_bytes = 0
+
+    def exceeded(self) -> bool:
+        return self.held_bytes > self.request_budget or process_memory() > self.process_budget
+
+    def fits(self, p_bytes: int) -> bool:
+        """
+        Checks whether p_bytes more could be loaded into memory within the budget.
+        """
+        return self.held_bytes + p_bytes <= self.request_budget and process_memory() + p_bytes <= self.process_budget
+
+
+def process_memory() -> int:
+    return psutil.Process().memory_info().rss
+
+
+def new_spill_table() -> str:
+    """
+    Returns a new spill table name, dropping the spill tables older than spill_ttl.
+    """
+    drop_expired_spills()
+    return f'spill_{int(time.time())}_{uuid.uuid4().hex[:12]}'
+
+
+def align_columns(conn: duckdb.DuckDBPyConnection, table_name: str, source: str):
+    """
+    Prepares a table for INSERT BY NAME from source: columns missing in the table are added, integer columns
+    receiving decimals are widened to DOUBLE and other type conflicts to VARCHAR. Pages of the same pull
+    can differ, e.g. an amount column that is whole numbers only on the first page.
+    """
+    table_types: dict = dict(conn.execute(
+        "SELECT column_name, data_type FROM duckdb_columns() WHERE table_name = ?", [table_name]).fetchall())
+    for column_name, source_type, *_ in conn.execute(f"DESCRIBE SELECT * FROM {source}").fetchall():
+        table_type: Optional[str] = table_types.get(column_name)
+        if table_type is None:
+            conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {quote_identifier(column_name)} {source_type}")
+        elif table_type != source_type and table_type != 'VARCHAR':
+            numeric: bool = all(data_type in numeric_types for data_type in (table_type, source_type))
+            if numeric and table_type == 'DOUBLE':
+                continue
+            conn.execute(f"ALTER TABLE {table_name} ALTER {quote_identifier(column_name)} "
+                         f"TYPE {'DOUBLE' if numeric else 'VARCHAR'}")
+
+
+def spill_query(sql: str, params: Optional[list] = None) -> SpilledResult:
+    """
+    Materializes the query result in a new spill table without loading it into pandas. A web worker of
+    a multi-worker deployment has the writer process create it and waits for the replica showing it.
+    An offline start spills into the database restored from the snapshot bundle too, see restore_snapshot,
+    the bundle itself is never written.
+    """
+    if is_reader():
+        job: dict = wait_for_job(submit_job('spill', _spill_job, {'sql': sql, 'params': params}), job_wait_timeout)
+        if job['status'] != 'done':
+            raise RuntimeError(f"Spilling the result in the writer process {job['status']}: {job.get('error')}")
+        return get_job_result(job['id'])
+    table_name: str = new_spill_table()
+    with DuckDBConnection(Path.cwd() / duckdb_db_path) as conn:
+        conn.execute(f"CREATE TABLE {table_name} AS {sql}", params)
+    return spilled_result(table_name)
+
+
+def _spill_job(sql: str, params: Optional[list], p_progress=None) -> SpilledResult:
+    # Job of the writer process for the spill_query of a web worker
+    return spill_query(sql, params)
+
+
+def spilled_result(table_name: str) -> Optional[SpilledResult]:
+    """
+    Returns the spilled result of a spill table, None if the table is gone, e.g. dropped after spill_ttl.
+    """
+    columns_df: pd.DataFrame = execute_sql_query(
+        "SELECT column_name FROM duckdb_columns() WHERE table_name = ? ORDER BY column_index", [table_name])
+    if columns_df.empty:
+        return None
+    count_df: pd.DataFrame = execute_sql_query(f"SELECT count(*) AS row_count FROM {table_name}")
+    if count_df.empty:  # dropped meanwhile
+        return None
+    return SpilledResult(table_name, int(count_df['row_count'].iloc[0]), columns_df['column_name'].tolist())
+
+
+def estimate_bytes(sql: str, params: Optional[list], p_rows: int, p_sample_rows: int = 1000) -> int:
+    """
+    Estimates the DataFrame size of p_rows rows of the query from the first p_sample_rows rows.
+    """
+    if not p_rows:
+        return 0
+    sample: pd.DataFrame = execute_sql_query(f"SELECT * FROM ({sql}) LIMIT {p_sample_rows}", params)
+    if sample.empty:
+        return 0
+    return int(sample.memory_usage(deep=True).sum() / len(sample) * p_rows)
+
+
+def read_spilled(result: SpilledResult, p_start: int, p_end: int, p_sort_model: Optional[list] = None) -> pd.DataFrame:
+    """
+    Reads rows p_start to p_end - 1 of a spilled result.
+
+    Parameters:
+    - result (SpilledResult): Spilled result to read.
+    - p_start (int): First row.
+    - p_end (int): Row after the last one.
+    - p_sort_model (list): AG Grid sort model, [{'colId': ..., 'sort': 'asc' | 'desc'}, ...].
+
+    Returns:
+    - pd.DataFrame: The requested rows.
+    """
+    order_by: list = [f"{quote_identifier(sort['colId'])} {'DESC' if sort['sort'] == 'desc' else 'ASC'}"
+                      for sort in p_sort_model or [] if sort['colId'] in result.columns]
+    # rowid keeps the pulled order and makes the pages of equal sort keys stable
+    order_by.append('rowid')
+    return execute_sql_query(
+        f"SELECT * FROM {result.table_name} ORDER BY {', '.join(order_by)} LIMIT ? OFFSET ?",
+        [max(p_end - p_start, 0), p_start])
+
+
+def export_spilled(table_name: str, p_path: Path):
+    """
+    Writes a spill table to a CSV file, DuckDB streams it without loading it into pandas.
+    """
+    with read_connection() as conn:
+        conn.execute(f"COPY (SELECT * FROM {table_name} ORDER BY rowid) TO '{p_path.as_posix()}' "
+                     f"(HEADER, DELIMITER ',')")
+
+
+def is_spill_table(table_name: str) -> bool:
+    return bool(spill_table_pattern.match(table_name or ''))
+
+
+def drop_expired_spills():
+    """
+    Drops the spill tables created more than spill_ttl seconds ago, left to the writer process in a
+    multi-worker deployment.
+    """
+    if is_reader():
+        return
+    tables_df: pd.DataFrame = execute_sql_query(
+        "SELECT table_name FROM duckdb_tables() WHERE table_name LIKE 'spill_%'")
+    expired: list = [table_name for table_name in (tables_df['table_name'] if not tables_df.empty else [])
+                     if is_spill_table(table_name)
+                     and int(spill_table_pattern.match(table_name).group(1)) < time.time() - spill_ttl]
+    if not expired:
+        return
+    try:
+        with DuckDBConnection(Path.cwd() / duckdb_db_path) as conn:
+            for table_name in expired:
+                conn.execute(f"DROP TABLE IF EXISTS {table_name}")
+        logger.info(f"Dropped {len(expired)} expired spill tables")
+    except duckdb.Error as e:
+        logger.error(f"Failed to drop expired spill tables: {e}")
+
+
+def drop_spilled(table_name: str):
+    """
+    Drops a spill table that is no longer referenced, e.g. replaced by a copy with more columns.
+    """
+    try:
+        with DuckDBConnection(Path.cwd() / duckdb_db_path) as conn:
+            conn.execute(f"DROP TABLE IF EXISTS {table_name}")
+    except duckdb.Error as e:
+        logger.error(f"Failed to drop spill table {table_name}: {e}")
+
+
+def head_of_spilled(result: SpilledResult) -> pd.DataFrame:
+    """
+    Returns the first rows of a spilled result that fit the request memory budget.
+    """
+    row_bytes: int = estimate_bytes(f"SELECT * FROM {result.table_name}", None, 1)
+    rows: int = result.row_count if not row_bytes else min(result.row_count, request_memory_budget // row_bytes)
+    return read_spilled(result, 0, rows)
@@ -0,0 +1,134 @@
+import logging
+
+import pandas as pd
+
+from packages.config import grid_transport
+
+logger = logging.getLogger(__name__)
+
+# Decodes the payloads of grid_payload into the main AG Grid table, registered as a clientside callback in main.py
+decode_grid_payload_js: str = """
+function(payload, gridId) {
+    const noUpdate = window.dash_clientside.no_update;
+    if (!payload) {
+        return [noUpdate, noUpdate];
+    }
+    const decodeRows = function(encoded) {
+        if (Array.isArray(encoded)) {
+            return encoded;
+        }
+        const columns = encoded.data.map(function(column) {
+            if (column === null || Array.isArray(column)) {
+                return column;
+            }
+            return column.codes.map(function(code) { return code < 0 ? null : column.values[code]; });
+        });
+        const rows = new Array(encoded.rowCount);
+        for (let i = 0; i < encoded.rowCount; i++) {
+            const row = {};
+            for (let j = 0; j < encoded.columns.length; j++) {
+                row[encoded.columns[j]] = columns[j] === null ? null : columns[j][i];
+            }
+            rows[i] = row;
+        }
+        return rows;
+    };
+    if (payload.rowData !== undefined) {
+        return [decodeRows(payload.rowData), noUpdate];
+    }
+    const transaction = {};
+    for (const action in payload.transaction) {
+        transaction[action] = decodeRows(payload.transaction[action]);
+    }
+    if (!payload.keys) {
+        return [noUpdate, transaction];
+    }
+    // Updated and removed rows are matched to the shown rows by their key columns and applied to them in place,
+    // the grid keeps its filters, sort order and scroll position
+    const api = dash_ag_grid.getApi(gridId);
+    const rowKey = function(data) {
+        return JSON.stringify(payload.keys.map(function(key) { return data[key]; }));
+    };
+    const shown = new Map();
+    api.forEachNode(function(node) {
+        if (node.data) {
+            shown.set(rowKey(node.data), node.data);
+        }
+    });
+    const keyed = {add: transaction.add || [], update: [], remove: []};
+    (transaction.update || []).forEach(function(row) {
+        const current = shown.get(rowKey(row));
+        if (current) {
+            keyed.update.push(Object.assign(current, row));
+        } else {
+            keyed.add.push(row);
+        }
+    });
+    (transaction.remove || []).forEach(function(row) {
+        const current = shown.get(rowKey(row));
+        if (current) {
+            keyed.remove.push(current);
+        }
+    });
+    api.applyTransaction(keyed);
+    return [noUpdate, noUpdate];
+}
+"""
+
+
+def encode_columns(df: pd.DataFrame) -> dict:
+    """
+    Column oriented encoding of a DataFrame: the column names are sent once and every column as one list,
+    instead of repeating every column name on every row like df.to_dict("records"). String columns with
+    repeated values (ledger, currency, period, segment codes) are dictionary encoded as their distinct values
+    and one integer code per row, -1 for missing values. Columns without any value are sent as null.
+
+    Parameters:
+    - df (pd.DataFrame): Rows to send.
+
+    Returns:
+    - dict: {'columns': [...], 'rowCount': n, 'data': [list | {'values': [...], 'codes': [...]} | None, ...]}
+    """
+    data: list = []
+    for column in df.columns:
+        series: pd.Series = df[column]
+        if series.isna().all():
+            data.append(None)
+        elif series.dtype == object or isinstance(series.dtype, pd.StringDtype):
+            codes, uniques = pd.factorize(series)
+            if len(uniques) * 2 <= len(series):
+                data.append({'values': uniques.tolist(), 'codes': codes.tolist()})
+            else:
+                data.append(series.tolist())
+        else:
+            data.append(series.tolist())
+    return {'columns': [str(column) for column in df.columns], 'rowCount': len(df), 'data': data}
+
+
+def encode_rows(df: pd.DataFrame):
+    """
+    Rows of a DataFrame in the GRID_TRANSPORT format: column oriented (columns, the default),
+    see encode_columns, or the records AG Grid takes (records).
+    """
+    if grid_transport == 'records':
+        return df.to_dict("records")
+    return encode_columns(df)
+
+
+def grid_payload(df: pd.DataFrame) -> dict:
+    """
+    Payload of the 'grid-payload' store replacing the rows of the main grid with df.
+    """
+    return {'rowData': encode_rows(df)}
+
+
+def transaction_payload(p_keys: list = None, **p_rows: pd.DataFrame) -> dict:
+    """
+    Payload of the 'grid-payload' store applying a row transaction to the main grid,
+    e.g. transaction_payload(add=df) adds the rows of df. Updated and removed rows are found in the grid
+    by the values of their p_keys columns, the grid rows have no ids.
+    """
+    payload: dict = {'transaction': {action: encode_rows(df) for action, df in p_rows.items()}}
+    if p_keys:
+        payload['keys'] = p_keys
+    return payload
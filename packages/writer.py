@@ -0,0 +1,32 @@
+import logging
+
+from packages.cache_warmer import start_cache_warmer
+from packages.config import base_api_url, username, password, duckdb_db_path, ldf, multi_worker
+from packages.duck_select import execute_sql_query
+from packages.jobs import serve_queues
+from packages.load_metadata import load_metadata
+from packages.replica import become_writer, publish_replica
+
+logger = logging.getLogger(__name__)
+
+
+def run_writer():
+    """
+    Runs the writer process of a multi-worker deployment: the only process opening ledgers.duckdb, it loads
+    the metadata, runs the pulls and writes queued by the web workers and the cache warmer, and publishes
+    the replicas the web workers read, see packages.replica.
+    """
+    become_writer()
+    df_currencies = execute_sql_query("SELECT CurrencyCode, Name FROM currencies")
+    if df_currencies is None or df_currencies.empty:
+        load_metadata(ldf, base_api_url, username, password, duckdb_db_path)
+    publish_replica()
+    start_cache_warmer()
+    serve_queues()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    if not multi_worker:
+        raise SystemExit("Set MULTI_WORKER=true in the .env file of the writer and the web workers.")
+    run_writer()
@@ -0,0 +1,16 @@
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+# packages.config reads the environment and the lg_list.json of the working directory when it is imported,
+# the tests run in a directory of their own with the sample ledgers and no Fusion API
+root_dir: Path = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(root_dir))
+os.environ.setdefault('BASE_API_URL', 'http://127.0.0.1:9')
+os.environ.setdefault('ORACLE_FUSION_USERNAME', 'test')
+os.environ.setdefault('ORACLE_FUSION_PASSWORD', 'test')
+work_dir: Path = Path(tempfile.mkdtemp(prefix='glwalker-tests-'))
+shutil.copy(root_dir / 'lg_list_sample.json', work_dir / 'lg_list.json')
+os.chdir(work_dir)
@@ -0,0 +1,61 @@
+import threading
+
+import pandas as pd
+import pytest
+
+from packages.extraction import StagingTakenOver, checkpoint_pages, claim_extraction, completed_units
+
+claims: int = 6
+rounds: int = 10  # the conflicts are intermittent
+
+
+def claim_together(p_extractions: list) -> tuple:
+    """
+    Claims the extractions on one thread each, started together. Returns the staging tables and the errors.
+    """
+    barrier: threading.Barrier = threading.Barrier(len(p_extractions))
+    stagings: list = [None] * len(p_extractions)
+    errors: list = []
+
+    def claim(position: int, extraction: str):
+        barrier.wait()
+        try:
+            stagings[position] = claim_extraction(extraction, 60)
+        except Exception as e:
+            errors.append(e)
+
+    threads: list = [threading.Thread(target=claim, args=(position, extraction))
+                     for position, extraction in enumerate(p_extractions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stagings, errors
+
+
+@pytest.mark.parametrize('attempt', range(rounds))
+def test_concurrent_claims_on_new_database(attempt, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    stagings, errors = claim_together([f'extraction{position}' for position in range(claims)])
+    assert errors == []
+    assert len(set(stagings)) == claims
+
+
+@pytest.mark.parametrize('attempt', range(rounds))
+def test_concurrent_claims_of_one_extraction(attempt, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    stagings, errors = claim_together(['extraction'] * claims)
+    assert errors == []
+    assert len(set(stagings)) == claims
+
+    # Only the last claim stores pages, the others were taken over
+    page: tuple = (0, 'Jan-24', 0, '101.000', 0, False, pd.DataFrame({'Amount': [1.0]}))
+    owners: list = []
+    for staging in stagings:
+        try:
+            checkpoint_pages('extraction', staging, [page])
+            owners.append(staging)
+        except StagingTakenOver:
+            pass
+    assert len(owners) == 1
+    assert completed_units('extraction') == {('Jan-24', '101.000'): (0, False)}